@@ -9,15 +9,58 @@ in strutured file system corresponding to the DICOM hierarchy:
 Author: Jon E Nesvold
 """
 # internals
-from config import arg_parser
-from src.helpers import get_partition_idx, check_make_folder
-from src.tcia_api import get_series_list, get_instance_series
+from config import arg_parser, config
+from src.helpers import check_make_folder
+from src.tcia_api import dataset_path, download_series
+from src.client import TciaClient
+from src.scheduler import SeriesTask, sort_work_queue
+from src.manifest import Manifest
+from src.cache import MetadataCache
+from src.session import configure_session, close_session
+from src.retry import configure_retry
+from src.bandwidth import configure_bandwidth
+from src.metrics import metrics, PrometheusFileWriter
+from src.extraction import ExtractionPool
+from src.store import DicomStore
+from src.layout import plan_layout, make_folders
+from src.archive import TarShardWriter
+from src.catalog import Catalog
+from src.filters import SeriesFilter, PriorityClasses, cap_total_size
+from src.planner import summarize, probe_throughput, recommend_workers, pick_workers, estimate_runtime, format_bytes, format_seconds
+from src.sync import diff_series, clear_series
+from src.shard import filter_shard, manifest_name, find_manifests, merge_manifests
 from config.logger import log
 # externals
-from typing import List, NoReturn
+import os
+import sys
+import json
+from time import time
+from timeit import default_timer
+from tqdm import tqdm
+from typing import Dict, List, NoReturn, Optional, Tuple
 import concurrent.futures as cf
 from multiprocessing import cpu_count
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+
+
+@dataclass
+class CollectionState:
+    """The state of a single collection in a run, kept apart from the other collections.
+    Attributes
+    ----------
+    name : str
+        The name of the collection.
+    data_path : os.PathLike
+        The folder the collection is stored in.
+    tasks : List[SeriesTask]
+        The series of the collection, as the client streamed them.
+    manifest : Manifest
+        The manifest of the completed series of the collection.
+    """
+    name: str
+    data_path: os.PathLike
+    tasks: List[SeriesTask]
+    manifest: Manifest
 
 
 @dataclass
@@ -27,7 +70,10 @@ class RequestController:
     Attributes
     ----------
     dataset_name : str
-        Let the process know which dataset to use via `dataset_name`.
+        Let the process know which dataset to use via `dataset_name`, several can be given comma separated.
+        None for the default dataset, unless a `collections_file` is given.
+    collections_file : str
+        A file with one collection per line, fetched in the same run as the `dataset_name`.
     workers : int
         Set the number of `workers` to use in the concurrency.
     thread_num : int
@@ -35,79 +81,559 @@ class RequestController:
     use_cpu_count : bool
         Set `use_cpu_count` to true if you want to scale up the amount of worker with
         the CPU core count.
+    resume : bool
+        Set `resume` to true to skip the series that are recorded in the manifest.
+    sync : bool
+        Set `sync` to true to fetch fresh metadata and download only the new or changed series.
+    plan : bool
+        Set `plan` to true to estimate the size and runtime of the pull instead of downloading.
+    modality : str
+        Only fetch the series of these comma separated modalities.
+    series_description : str
+        Only fetch the series whose SeriesDescription matches this case insensitive regex.
+    patients : str
+        Only fetch these comma separated PatientIDs, or the ones in this file.
+    max_series_per_patient : int
+        Fetch at most this many series per patient, 0 for all.
+    max_series_mb : float
+        Skip the series larger than this many MB, 0 for no limit.
+    max_total_gb : float
+        Stop queueing series once this many GB are queued, 0 for no limit.
+    priority_patients : str
+        Queue the series of these comma separated PatientIDs, or the ones in this file, first.
+    priority_modalities : str
+        Queue the series of these comma separated modalities next, in the given order.
+    metadata_cache : bool
+        Set `metadata_cache` to true to cache the getPatient and getSeries responses.
+    cache_ttl : float
+        The time to live of the cached metadata in seconds.
+    offline_metadata : bool
+        Set `offline_metadata` to true to build the series information from the cache alone.
+    store : bool
+        Set `store` to true to keep every dicom file once in the content-addressed store.
+    store_link : str
+        Link the dataset trees into the store with a `hardlink` or a `symlink`.
+    output : str
+        Write the series to the folder `tree` or stream them into `tar` shards.
+    tar_shard_mb : float
+        The size in MB a tar shard grows to before the next one is started.
+    catalog : bool
+        Set `catalog` to true to write the series and instance headers to a sqlite catalog.
+    shard : Tuple[int, int]
+        Fetch only this (index, number of shards) share of the collection, None for all.
+    shard_by : str
+        Hash the `series` UIDs or the `patient` IDs into the shards.
+    merge_shards : str
+        Comma separated manifests or folders to verify against the collection instead of downloading.
+    engine : str
+        Choose the download `engine`, either `thread` or `async`.
+    max_in_flight : int
+        The maximum number of getImage requests in flight at once for the async engine.
+    extract_mode : str
+        Choose the `extract_mode`, either `spool` or `disk`.
+    extract_workers : int
+        The number of extraction processes, 0 to extract on the download threads.
+    extract_queue : int
+        How many downloaded zips may wait for the extraction, with either engine.
+    metadata_workers : int
+        Set the number of patients to request the series information for concurrently.
+    max_retries : int
+        How many times a throttled or failed request is retried.
+    series_attempts : int
+        How many rounds a series that fails the verification is downloaded in.
+    rate_limit : float
+        The highest number of requests per second, 0 to disable the rate limiting.
+    bandwidth_limit : float
+        The budget for all the downloads together in MB/s, 0 for no limit.
+    bandwidth_file : str
+        A file holding the budget in MB/s, read again when it changes or on a SIGHUP.
+    metrics_path : str
+        The folder to write the metrics to, the dataset folder if empty.
+    pool_size : int
+        The maximum number of pooled connections kept alive per host.
+    pool_block : bool
+        Set `pool_block` to true to make the `pool_size` a hard per-host limit.
+    keep_alive : bool
+        Set `keep_alive` to false to close the connection after every request.
     """
-    dataset_name: str = arg_parser.args['dataset_name']
-    workers: int = arg_parser.args['workers']
-    thread_num: int = arg_parser.args['thread_num']
-    use_cpu_count: int = arg_parser.args['use_cpu_count']
+    dataset_name: Optional[str] = None
+    collections_file: str = config.COLLECTIONS_FILE
+    workers: int = config.WORKERS
+    thread_num: int = config.THREAD_NUM
+    use_cpu_count: int = config.USE_CPU_COUNT
+    resume: bool = config.RESUME
+    sync: bool = config.SYNC
+    plan: bool = config.PLAN
+    modality: str = config.MODALITY
+    series_description: str = config.SERIES_DESCRIPTION
+    patients: str = config.PATIENTS
+    max_series_per_patient: int = config.MAX_SERIES_PER_PATIENT
+    max_series_mb: float = config.MAX_SERIES_MB
+    max_total_gb: float = config.MAX_TOTAL_GB
+    priority_patients: str = config.PRIORITY_PATIENTS
+    priority_modalities: str = config.PRIORITY_MODALITIES
+    metadata_cache: bool = config.USE_METADATA_CACHE
+    cache_ttl: float = config.METADATA_CACHE_TTL
+    offline_metadata: bool = config.OFFLINE_METADATA
+    store: bool = config.USE_STORE
+    store_link: str = config.STORE_LINK
+    output: str = config.OUTPUT_MODE
+    tar_shard_mb: float = config.TAR_SHARD_MB
+    catalog: bool = config.USE_CATALOG
+    shard: Optional[Tuple[int, int]] = None
+    shard_by: str = config.SHARD_BY
+    merge_shards: str = config.MERGE_SHARDS
+    engine: str = config.ENGINE
+    max_in_flight: int = config.MAX_IN_FLIGHT
+    extract_mode: str = config.EXTRACT_MODE
+    extract_workers: int = config.EXTRACT_WORKERS
+    extract_queue: int = config.EXTRACT_QUEUE_SIZE
+    metadata_workers: int = config.METADATA_WORKERS
+    max_retries: int = config.MAX_RETRIES
+    series_attempts: int = config.SERIES_ATTEMPTS
+    rate_limit: float = config.RATE_LIMIT
+    bandwidth_limit: float = config.BANDWIDTH_LIMIT
+    bandwidth_file: str = config.BANDWIDTH_FILE
+    metrics_path: str = config.METRICS_PATH
+    pool_size: int = config.POOL_MAXSIZE
+    pool_block: bool = config.POOL_BLOCK
+    keep_alive: bool = config.KEEP_ALIVE
+
+    @classmethod
+    def from_args(cls, argv: Optional[List[str]] = None) -> 'RequestController':
+        """
+        This method builds a controller from the CLI arguments, `sys.argv` if no `argv` is given
+        """
+        args = arg_parser.parse_args(argv)
+        return cls(**{f.name: args[f.name] for f in fields(cls)})
+
+    def collection_names(self) -> List[str]:
+        """
+        This method returns the collections to fetch, from the comma separated
+        `dataset_name` and from the `collections_file` with one collection per line
+        """
+        names = [name.strip() for name in (self.dataset_name or '').split(',') if name.strip()]
+        if self.collections_file:
+            with open(self.collections_file, 'r') as fp:
+                names += [line.strip() for line in fp if line.strip() and not line.startswith('#')]
+        elif self.dataset_name is None:
+            names = [config.DATASET_NAME]
+        # keep the order, but fetch every collection once
+        return list(dict.fromkeys(names))
+
+    def output_folder(self) -> os.PathLike:
+        """
+        This method returns the folder for the run-wide reports, the dataset folder
+        if there is only one collection
+        """
+        return self.collections[0].data_path if len(self.collections) == 1 else config.RAW_DATA
 
     def fetch_series(self) -> NoReturn:
         """
         This method controls the series list request
         """
-        self.data_path, self.patient_dict = get_series_list(self.dataset_name)
+        # a sync always asks NBIA, the cache is only refreshed
+        cache = MetadataCache(
+                        config.METADATA_CACHE_PATH,
+                        ttl=0 if self.sync and not self.offline_metadata else self.cache_ttl,
+                        max_entries=config.METADATA_CACHE_MAX_ENTRIES
+                        ) if self.metadata_cache or self.offline_metadata else None
+        client = TciaClient(workers=self.metadata_workers, cache=cache, offline=self.offline_metadata)
+        self.series_filter = SeriesFilter.from_args(
+                                        modality=self.modality,
+                                        series_description=self.series_description,
+                                        patients=self.patients,
+                                        max_series_per_patient=self.max_series_per_patient,
+                                        max_series_mb=self.max_series_mb
+                                        )
+        self.collections: List[CollectionState] = []
+        for name in self.collection_names():
+            log.info(f'Fetching the series list of {name}')
+            tasks = [record.to_task(collection=name) for record in tqdm(client.iter_series(name, series_filter=self.series_filter), unit=' series')]
+            if not tasks and self.series_filter.active:
+                # the collection is listed, the filter just leaves nothing of it to fetch
+                log.warning(f'no series of the dataset {name} match the filter, it is skipped')
+                continue
+            if not tasks:
+                log.error(f'response is empty, check if the dataset {name} limited or if patientID is listed')
+                raise ValueError('can only process data that contains patientID')
+            data_path = dataset_path(name)
 
-        # Create the folder for the dataset
-        check_make_folder(folder=self.data_path, verbose=True)
+            if not self.plan:
+                # Create the folder for the dataset, a plan leaves the disk as it is
+                check_make_folder(folder=data_path, verbose=True)
 
-        if len(self.patient_dict) > 50:
-            log.warning(f'There are {len(self.patient_dict)} patients in this dataset')
+            n_patients = len({task.patient for task in tasks})
+            if n_patients > 50:
+                log.warning(f'There are {n_patients} patients in the dataset {name}')
 
-        log.info(f'the dataset will be stored here: {self.data_path}')
+            log.info(f'the dataset will be stored here: {data_path}')
+            self.collections.append(CollectionState(
+                                            name=name,
+                                            data_path=data_path,
+                                            tasks=tasks,
+                                            manifest=Manifest(os.path.join(
+                                                        data_path,
+                                                        manifest_name(config.MANIFEST_NAME, self.shard)
+                                                        ))
+                                            ))
+        self.collections_by_name = {state.name: state for state in self.collections}
+
+    def build_queue(self) -> List[SeriesTask]:
+        """
+        This method builds one work queue over all the collections, largest series first
+        """
+        work_queue = []
+        self.sync_reports = {}
+        for state in self.collections:
+            tasks = state.tasks
+            n_total = len(tasks)
+            if self.shard is not None:
+                tasks = filter_shard(tasks, self.shard, self.shard_by)
+                log.info(f'{state.name}: shard {self.shard[0]}/{self.shard[1]} holds {len(tasks)} of {n_total} series')
+            if self.sync:
+                tasks = self.sync_collection(state, tasks)
+            elif self.resume and len(state.manifest):
+                n_sharded = len(tasks)
+                tasks = [task for task in tasks if task.series_uid not in state.manifest]
+                log.info(f'{state.name}: resuming, {n_sharded - len(tasks)} of {n_sharded} series are already completed')
+            work_queue += tasks
+        priority = PriorityClasses.from_args(self.priority_patients, self.priority_modalities)
+        if priority.active:
+            # the priority classes fill the cap first, the getSeries order is kept within a class
+            work_queue = sorted(work_queue, key=priority)
+        # the cap is filled per series in the queue order, a series that does not fit is skipped and
+        # the smaller ones after it are still tried, so a patient may be cut by the cap
+        work_queue = cap_total_size(work_queue, int(self.max_total_gb * 1024 * config.MEGABYTE))
+        return sort_work_queue(work_queue, priority if priority.active else None)
+
+    def sync_collection(self, state: CollectionState, tasks: List[SeriesTask]) -> List[SeriesTask]:
+        """
+        This method diffs the series of a collection against its manifest and local tree,
+        writes the delta to the dataset folder and returns the series to download, a plan
+        is a dry run that leaves the manifest, the tree and the report untouched
+        """
+        # with a filter the series outside of it are not known, so nothing is reported as removed
+        remote_uids = None if self.series_filter.active else {task.series_uid for task in state.tasks}
+        delta = diff_series(tasks, state.manifest, state.data_path, remote_uids, adopt=not self.plan)
+        report = delta.report()
+        self.sync_reports[state.name] = report
+        if not self.plan:
+            clear_series(delta.changed, state.data_path)
+            with open(os.path.join(state.data_path, config.SYNC_REPORT_NAME), 'w') as fp:
+                json.dump(report, fp, indent=2)
+        log.info(
+            f'{state.name}: {len(delta.new)} new, {len(delta.changed)} changed, {len(delta.missing)} missing '
+            f'locally, {len(delta.unchanged)} unchanged and {len(delta.removed)} removed from NBIA'
+            )
+        return delta.to_fetch
 
     def fetch_instances(self) -> NoReturn:
         """
-        This method controls the influx of intances from the dataset
+        This method controls the influx of intances from the dataset, the series that fail
+        the verification or the download are queued again for up to `series_attempts` rounds
         """
-        UID_LIST = []
         max_workers: int = cpu_count() * self.workers if self.use_cpu_count else self.workers
-        # NOTE: if keeps staying flaky, try executor.submit with a list comprehension
+        self.work_queue: List[SeriesTask] = self.build_queue()
+        log.info(f'{len(self.work_queue)} series are queued, largest first')
+        self.shard_writers = self.open_shards() if self.output == 'tar' else None
+        self.catalogs = {
+            state.name: Catalog(os.path.join(state.data_path, manifest_name(config.CATALOG_NAME, self.shard)), state.name)
+            for state in self.collections
+            } if self.catalog else None
+        # the shards hold the files themselves, there is no tree to link or lay out
+        self.dicom_store = DicomStore(config.STORE_PATH, self.store_link) if self.store and not self.shard_writers else None
+        self.layout = None
+        if self.shard_writers is None:
+            # every folder of the queue is created before the first download
+            self.layout = plan_layout(self.work_queue, {state.name: state.data_path for state in self.collections})
+            make_folders(self.layout.values())
+        tasks = self.work_queue
+        try:
+            for attempt in range(1, self.series_attempts + 1):
+                if attempt > 1:
+                    log.warning(f'queueing {len(tasks)} failed series again, attempt {attempt}/{self.series_attempts}')
+                started = time()
+                self.run_queue(tasks, max_workers)
+                # only a record of this round counts, an older ok entry may stand for a series
+                # that is fetched again because it changed or the run does not resume
+                tasks = [
+                    task for task in tasks
+                    if not self.collections_by_name[task.collection].manifest.completed_since(task.series_uid, started)
+                    ]
+                if not tasks:
+                    break
+        finally:
+            for writer in (self.shard_writers or {}).values():
+                writer.close()
+            for catalog in (self.catalogs or {}).values():
+                catalog.close()
+        self.failed_series = [task.series_uid for task in tasks]
+        if tasks:
+            log.warning(f'{len(tasks)} series failed {self.series_attempts} attempts, run again to resume them')
+
+    def open_shards(self) -> Dict[str, TarShardWriter]:
+        """
+        This method opens a tar shard writer in the shard folder of every collection, the
+        shards of a node shard are named after it such that the nodes do not collide
+        """
+        suffix = '' if self.shard is None else f'-shard-{self.shard[0]}-of-{self.shard[1]}'
+        return {
+            state.name: TarShardWriter(
+                                os.path.join(state.data_path, config.TAR_FOLDER_NAME),
+                                prefix=f'{state.name}{suffix}',
+                                shard_bytes=int(self.tar_shard_mb * config.MEGABYTE),
+                                index_name=os.path.splitext(config.TAR_INDEX_NAME)[0] + f'{suffix}.jsonl',
+                                read_headers=self.catalog
+                                )
+            for state in self.collections
+            }
+
+    def run_queue(self, tasks: List[SeriesTask], max_workers: int) -> NoReturn:
+        """
+        This method downloads one round of series with the chosen engine
+        """
+        if self.engine == 'async':
+            self.fetch_instances_async(tasks, extract_workers=self.extract_workers or max_workers)
+            return
+
+        # the tar shards are written on the download threads, there is nothing to extract
+        self.extraction_pool = ExtractionPool(
+                                        self.extract_workers,
+                                        self.extract_queue
+                                        ) if self.extract_workers > 0 and self.shard_writers is None else None
+        # NOTE: the thread pool takes the tasks in submission order, so the largest go first
         with cf.ThreadPoolExecutor(
                             max_workers=max_workers,
                             thread_name_prefix='tcia_api'
                             ) as executor:
-            for patient, patient_info in self.patient_dict.items():
-                sedecs_list: List[str] = get_partition_idx(
-                                        full_list=patient_info.get('SeriesDescription'),
-                                        thread_num=self.thread_num
-                                        )
-                study_list: List[str] = get_partition_idx(
-                                        full_list=patient_info.get('StudyInstanceUID'),
-                                        thread_num=self.thread_num
-                                        )
-                series_list: List[str] = get_partition_idx(
-                                        full_list=patient_info.get('SeriesInstanceUID'),
-                                        thread_num=self.thread_num
-                                        )
-                UID_LIST.append(tuple((
-                                            series_list, study_list,
-                                            sedecs_list, patient,
-                                            self.data_path
-                                            )))
-            executor.map(lambda p: get_instance_series(*p), UID_LIST)
+            futures = {
+                executor.submit(self.download_task, task, default_timer()): task
+                for task in tasks
+                }
+            for future in tqdm(cf.as_completed(futures), total=len(futures)):
+                if future.exception() is not None:
+                    log.error(
+                        f'download failed for series {futures[future].series_uid}',
+                        exc_info=future.exception()
+                        )
+        if self.extraction_pool is not None:
+            log.info('waiting for the extraction processes to finish')
+            self.extraction_pool.shutdown()
+
+    def plan_run(self) -> Dict:
+        """
+        This method sizes the pull from the series metadata and a throughput probe, and
+        writes the plan to the report folder, no image data is downloaded
+        """
+        work_queue = self.build_queue()
+        summary = summarize(work_queue)
+        log.info('probing the throughput towards NBIA with metadata requests')
+        probe = probe_throughput(self.collections[0].name)
+        estimates = recommend_workers(summary, probe, self.rate_limit)
+        workers = pick_workers(estimates)
+        plan = {
+            **summary,
+            'probe': probe,
+            'estimated_seconds': {str(w): round(seconds, 1) for w, seconds in estimates.items()},
+            'recommended_workers': workers
+            }
+        # a dataset that was never fetched has no folder yet, its plan goes to the raw data folder
+        plan_folder = self.output_folder() if os.path.isdir(self.output_folder()) else config.RAW_DATA
+        check_make_folder(plan_folder)
+        with open(os.path.join(plan_folder, config.PLAN_NAME), 'w') as fp:
+            json.dump(plan, fp, indent=2)
+
+        largest = '\n'.join(
+            f'                    {p["patient"]}: {format_bytes(p["bytes"])} in {p["series"]} series'
+            for p in summary['largest_patients']
+            )
+        current = cpu_count() * self.workers if self.use_cpu_count else self.workers
+        log.pipe(f"""
+                ###############################################
+                ## Plan for {', '.join(state.name for state in self.collections)}
+                ###############################################
+                Series: {summary['series']} ({summary['series_without_size']} without a FileSize, estimated)
+                Patients: {summary['patients']}
+                Images: {summary['images']}
+                Total size: {format_bytes(summary['bytes'])}
+                Largest series: {format_bytes(summary['largest_series_bytes'])}
+                Largest patients:
+{largest}
+                Latency: {probe['latency_seconds'] * 1000:.0f} ms
+                Single stream: {format_bytes(probe['single_stream_bytes_per_second'])}/s
+                Link: {f"{format_bytes(probe['link_bytes_per_second'])}/s" if probe['saturated'] else 'not saturated by the probe'}
+                Estimated runtime with {current} workers: {format_seconds(estimate_runtime(summary, probe, current, self.rate_limit))}
+                Estimated runtime with {workers} workers: {format_seconds(estimates[workers])}
+                Recommended: --workers {workers} (or --engine async --max_in_flight {workers})
+                """)
+        return plan
+
+    def verify_shards(self) -> bool:
+        """
+        This method merges the manifests of the shards and verifies that they cover the
+        whole collection, the report is written to the dataset folder
+        """
+        manifests = find_manifests(self.merge_shards.split(','), config.MANIFEST_NAME)
+        expected = {
+            task.series_uid
+            for state in self.collections
+            for task in state.tasks
+            }
+        report = merge_manifests(manifests, expected)
+        with open(os.path.join(self.output_folder(), config.SHARD_REPORT_NAME), 'w') as fp:
+            json.dump(report, fp, indent=2)
+        log.info(f'merged {len(manifests)} manifests: {report["completed"]} of {report["expected"]} series completed')
+        if report['duplicates']:
+            log.warning(f'{len(report["duplicates"])} series were fetched by more than one shard')
+        if report['complete']:
+            log.success('the shards cover the whole collection')
+        else:
+            log.fail(f'{len(report["missing"])} series are missing, see {config.SHARD_REPORT_NAME}')
+        return report['complete']
+
+    def download_task(self, task: SeriesTask, queued: float) -> NoReturn:
+        """
+        This method runs a single series on a worker thread, `queued` is the time the task
+        was submitted such that the queue wait can be observed
+        """
+        metrics.observe('queue_wait_seconds', default_timer() - queued)
+        state = self.collections_by_name[task.collection]
+        download_series(
+                    task,
+                    state.data_path,
+                    state.manifest,
+                    self.extract_mode,
+                    self.extraction_pool,
+                    self.dicom_store,
+                    self.layout,
+                    self.shard_writers[task.collection] if self.shard_writers else None,
+                    self.catalogs[task.collection] if self.catalogs else None
+                    )
+
+    def fetch_instances_async(self, tasks: List[SeriesTask], extract_workers: int) -> NoReturn:
+        """
+        This method hands the series to the asyncio engine, the extraction runs on
+        `extract_workers` threads
+        """
+        # the asyncio engine and aiohttp are only loaded when they are used
+        from src.async_engine import fetch_instances_async
+        fetch_instances_async(
+                        tasks,
+                        {state.name: (state.data_path, state.manifest) for state in self.collections},
+                        max_in_flight=self.max_in_flight,
+                        extract_workers=extract_workers,
+                        extract_queue=self.extract_queue,
+                        keep_alive=self.keep_alive,
+                        extract_mode=self.extract_mode,
+                        store=self.dicom_store,
+                        layout=self.layout,
+                        shards=self.shard_writers,
+                        catalogs=self.catalogs
+                        )
 
     def run(self) -> NoReturn:
         log.pipe(f"""
                 ###############################################
                 ## Running the API requester with the following
                 ###############################################
-                Dataset name: {self.dataset_name}
+                Collections: {', '.join(self.collection_names())}
                 Workers: {self.workers}
                 Concurrent Threads: {self.thread_num}
+                Engine: {self.engine}
+                Extract mode: {self.extract_mode}
+                Extract workers: {self.extract_workers}
+                Resume from manifest: {self.resume}
+                Sync: {self.sync}
+                Modality: {self.modality or 'all'}
+                Series description: {self.series_description or 'all'}
+                Patients: {self.patients or 'all'}
+                Max series per patient: {self.max_series_per_patient or 'all'}
+                Max series size: {f'{self.max_series_mb} MB' if self.max_series_mb else 'none'}
+                Max total size: {f'{self.max_total_gb} GB' if self.max_total_gb else 'none'}
+                Priority patients: {self.priority_patients or 'none'}
+                Priority modalities: {self.priority_modalities or 'none'}
+                Shard: {'all' if self.shard is None else f'{self.shard[0]}/{self.shard[1]} by {self.shard_by}'}
+                Offline metadata: {self.offline_metadata}
+                Store: {f'{config.STORE_PATH} ({self.store_link})' if self.store else 'off'}
+                Output: {self.output if self.output == 'tree' else f'tar shards of {self.tar_shard_mb:g} MB'}
+                Catalog: {config.CATALOG_NAME if self.catalog else 'off'}
+                Metadata workers: {self.metadata_workers}
                 Using CPU core count: {self.use_cpu_count}
                 Note!
                 if Using CPU cores is True then:
                     max_workers = {self.workers * cpu_count()}
                 if not:
                     max_workers = {self.workers}
+                Connection pool size per host: {self.pool_size}
+                Max retries: {self.max_retries}
+                Series attempts: {self.series_attempts}
+                Rate limit: {self.rate_limit} req/s
+                Bandwidth limit: {f'{self.bandwidth_limit} MB/s' if self.bandwidth_limit else 'none'}{f' (from {self.bandwidth_file})' if self.bandwidth_file else ''}
+                Keep-alive: {self.keep_alive}
                 TCIA-API-Requester 0.1.0-beta1
                 """)
-        log.info('Fetching series')
-        self.fetch_series()
-        log.info('Fetching instances')
-        self.fetch_instances()
+        configure_retry(max_retries=self.max_retries, rate_limit=self.rate_limit)
+        configure_session(
+                    pool_maxsize=self.pool_size,
+                    pool_block=self.pool_block,
+                    keep_alive=self.keep_alive
+                    )
+        t1 = default_timer()
+        metrics_writer = None
+        bandwidth_control = configure_bandwidth(self.bandwidth_limit, self.bandwidth_file)
+        try:
+            log.info('Fetching series')
+            self.fetch_series()
+            if self.merge_shards:
+                # the exit code tells a wrapper script whether the collection is complete
+                sys.exit(0 if self.verify_shards() else 1)
+            if not self.collections:
+                log.warning('no series of any dataset match the filter, there is nothing to fetch')
+                return
+            if self.plan:
+                self.plan_run()
+                return
+            metrics_folder = self.metrics_path or self.output_folder()
+            check_make_folder(metrics_folder)
+            metrics_writer = PrometheusFileWriter(
+                                            metrics,
+                                            os.path.join(metrics_folder, config.METRICS_PROM_NAME),
+                                            interval=config.METRICS_INTERVAL
+                                            )
+            metrics_writer.start()
+            log.info('Fetching instances')
+            self.fetch_instances()
+        finally:
+            close_session()
+            if bandwidth_control is not None:
+                bandwidth_control.stop()
+            if metrics_writer is not None:
+                metrics_writer.stop()
+                summary = metrics.write_summary(
+                                    os.path.join(metrics_folder, config.METRICS_SUMMARY_NAME),
+                                    extra={
+                                        'collections': [state.name for state in self.collections],
+                                        'engine': self.engine,
+                                        'series_queued': len(getattr(self, 'work_queue', [])),
+                                        'series_failed': getattr(self, 'failed_series', []),
+                                        'sync': {
+                                            name: {key: value if isinstance(value, int) else len(value)
+                                                   for key, value in report.items()}
+                                            for name, report in getattr(self, 'sync_reports', {}).items()
+                                            },
+                                        'runtime_seconds': round(default_timer() - t1, 3)
+                                        }
+                                    )
+                log.info(f'performance summary:\n{json.dumps(summary, indent=2)}')
         log.pipe('Data extracted and saved, you are all set (⌐■_■)')
 
 
+def main(argv: Optional[List[str]] = None) -> NoReturn:
+    """The CLI entry point, the arguments are parsed here and not at import.
+    """
+    RequestController.from_args(argv).run()
+
+
 if __name__ == '__main__':
-    RequestController().run()
+    main()
@@ -0,0 +1,85 @@
+"""
+This script benchmarks the cold start of the TAr modules with `python -X importtime`. Every
+module is imported in a fresh interpreter a few times, the median cumulative import time is
+checked against its budget, and the modules that must never be loaded at import (the user
+agent lookup, the asyncio engine and pydicom) are checked for. The exit code is 1 if a check fails,
+such that it can guard a CI job.
+Run it from the TAr folder like the controller:
+$ poetry run python bench/bench_import.py --repeat 5
+"""
+# externals
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+from typing import Dict, List, NoReturn, Tuple
+
+# the median cumulative import time in milliseconds each module has to stay below
+BUDGET_MS = {
+    'config.config': 25,
+    'config.arg_parser': 250,
+    'src.tcia_api': 300,
+    'api_request_controller': 400,
+    }
+# modules that are slow or go online, they are loaded on first use only
+FORBIDDEN = ['fake_useragent', 'aiohttp', 'pydicom']
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_times(module: str) -> List[Tuple[str, int, int]]:
+    """Import `module` in a fresh interpreter and return the (name, self, cumulative)
+    times in microseconds of every module it loaded.
+    """
+    proc = subprocess.run(
+                    [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                    capture_output=True,
+                    text=True,
+                    check=True
+                    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            rows.append((match.group(4), int(match.group(1)), int(match.group(2))))
+    return rows
+
+
+def bench_module(module: str, repeat: int) -> Dict:
+    """Return the median cumulative time of `module`, its slowest imports and the
+    forbidden modules it pulled in.
+    """
+    runs = [import_times(module) for _ in range(repeat)]
+    totals = [next(cum for name, _, cum in rows if name == module) for rows in runs]
+    slowest = sorted(runs[-1], key=lambda row: row[1], reverse=True)[:5]
+    loaded = {name.split('.')[0] for name, _, _ in runs[-1]}
+    return {
+        'median_ms': statistics.median(totals) / 1000,
+        'slowest': [(name, self_us / 1000) for name, self_us, _ in slowest],
+        'forbidden': sorted(loaded & set(FORBIDDEN))
+        }
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0, help='scale the budgets, e.g. on a slow CI runner')
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget in BUDGET_MS.items():
+        result = bench_module(module, args.repeat)
+        budget *= args.scale
+        ok = result['median_ms'] <= budget and not result['forbidden']
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {module:<26} {result['median_ms']:8.1f} ms (budget {budget:.0f} ms)")
+        if result['forbidden']:
+            print(f"     loaded at import: {', '.join(result['forbidden'])}")
+        if not ok:
+            for name, self_ms in result['slowest']:
+                print(f'     {self_ms:8.1f} ms  {name}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
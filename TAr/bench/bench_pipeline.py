@@ -0,0 +1,144 @@
+"""
+This script benchmarks the whole `RequestController.run` pipeline against the local mock
+NBIA server, from the getPatient request to the extracted dicom files. Every worker count
+runs in a fresh interpreter, such that the peak RSS is its own, and the series/sec, MB/sec,
+peak RSS and p95 request and download times are reported.
+Run it from the TAr folder like the controller:
+$ poetry run python bench/bench_pipeline.py --workers 1,4,16 --latency 0.05 --bandwidth 20
+"""
+# externals
+import os
+import sys
+import json
+import argparse
+import resource
+import tempfile
+import subprocess
+from typing import Dict, NoReturn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# internals
+from bench.mock_nbia import MockNBIA  # noqa: E402
+
+
+def run_child(options: Dict) -> NoReturn:
+    """Run the pipeline once in this interpreter and print the result as a json line.
+    """
+    import logging
+    from config import config
+    from config.logger import log
+    from src.metrics import metrics
+
+    log.setLevel(logging.WARNING)
+    config.BASE_URL = options['base_url']
+    config.URL_SERIES = os.path.join(config.BASE_URL, config.QUERY_SERIES)
+    config.URL_PATIENT = os.path.join(config.BASE_URL, config.QUERY_PATIENT)
+    config.URL_IMG = os.path.join(config.BASE_URL, config.QUERY_IMGS)
+    config.RAW_DATA = options['data_path']
+    config.DCM_RAW_DATASET_PATH = os.path.join(config.RAW_DATA, 'raw-{collection}-dicom')
+
+    from api_request_controller import RequestController
+    RequestController(
+                dataset_name=options['collection'],
+                workers=options['workers'],
+                engine=options['engine'],
+                max_in_flight=options['workers'],
+                extract_workers=options['extract_workers'],
+                rate_limit=options['rate_limit'],
+                resume=False,
+                metadata_cache=False,
+                metrics_path=options['data_path']
+                ).run()
+
+    summary = metrics.summary()
+    with open(os.path.join(options['data_path'], config.METRICS_SUMMARY_NAME), 'r') as fp:
+        runtime = json.load(fp)['runtime_seconds']
+    downloads = summary.get('download_bytes', {})
+    print(json.dumps({
+        'series': downloads.get('count', 0),
+        'bytes': downloads.get('sum', 0),
+        'runtime_seconds': runtime,
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'p95_request_seconds': summary.get('image_request_seconds', {}).get('p95', 0.0),
+        'p95_download_seconds': summary.get('download_seconds', {}).get('p95', 0.0)
+        }))
+
+
+def bench(options: Dict, verbose: bool) -> Dict:
+    """Run the pipeline in a fresh interpreter and return its result.
+    """
+    with tempfile.TemporaryDirectory(prefix='tar_bench_') as data_path:
+        proc = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), '--child', json.dumps({**options, 'data_path': data_path})],
+                        stdout=subprocess.PIPE,
+                        stderr=None if verbose else subprocess.DEVNULL,
+                        text=True,
+                        check=True
+                        )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,4,16', help='comma separated worker counts')
+    parser.add_argument('--engine', default='thread', choices=['thread', 'async'])
+    parser.add_argument('--extract_workers', type=int, default=0)
+    parser.add_argument('--rate_limit', type=float, default=0.0, help='req/s, 0 to switch the bucket off')
+    parser.add_argument('--patients', type=int, default=10)
+    parser.add_argument('--series', type=int, default=4)
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--image_kb', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='MB/s per response')
+    parser.add_argument('--link_bandwidth', type=float, default=0.0, help='MB/s for all responses')
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('--throttle_rate', type=float, default=0.0)
+    parser.add_argument('--json', default='', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the runs')
+    parser.add_argument('--child', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(json.loads(args.child))
+
+    results = {}
+    with MockNBIA(
+            patients=args.patients,
+            series=args.series,
+            images=args.images,
+            image_size=args.image_kb * 1024,
+            latency=args.latency,
+            bandwidth=args.bandwidth,
+            link_bandwidth=args.link_bandwidth,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate
+            ) as mock:
+        # warm up the zips of the mock, such that the first run does not pay for them
+        mock.zip_for(args.images)
+        mock.zip_for(2 * args.images)
+        print(f"{'workers':>8} {'series/s':>10} {'MB/s':>8} {'peak RSS MB':>12} {'p95 req s':>10} {'p95 dl s':>9}")
+        for workers in (int(w) for w in args.workers.split(',')):
+            result = bench({
+                        'base_url': f'{mock.base_url}/v1',
+                        'collection': 'bench',
+                        'workers': workers,
+                        'engine': args.engine,
+                        'extract_workers': args.extract_workers,
+                        'rate_limit': args.rate_limit
+                        }, args.verbose)
+            runtime = max(result['runtime_seconds'], 1e-6)
+            result['series_per_second'] = result['series'] / runtime
+            result['mb_per_second'] = result['bytes'] / 1024 / 1024 / runtime
+            results[workers] = result
+            print(f"{workers:>8} {result['series_per_second']:>10.1f} {result['mb_per_second']:>8.1f} "
+                  f"{result['peak_rss_mb']:>12.1f} {result['p95_request_seconds']:>10.3f} "
+                  f"{result['p95_download_seconds']:>9.3f}")
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+This script benchmarks the pooled session against plain `requests.get` calls. A local
+stand-in HTTP server answers with a small json payload, much like the getSeries endpoint,
+and the requests/sec are reported for both the sequential and the threaded case.
+Run it from the TAr folder like the controller:
+$ poetry run python bench/bench_session.py --requests 2000 --workers 8
+"""
+# externals
+import os
+import sys
+import json
+import argparse
+import threading
+import requests
+import concurrent.futures as cf
+from timeit import default_timer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, NoReturn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# internals
+from config import config  # noqa: E402
+from src.helpers import api_request  # noqa: E402
+from src.session import configure_session, close_session  # noqa: E402
+from src.retry import configure_retry  # noqa: E402
+
+PAYLOAD = json.dumps([{'SeriesInstanceUID': '1.2.3', 'StudyInstanceUID': '4.5.6'}] * 10).encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the same json payload over HTTP/1.1 such that the
+    connections can be kept alive.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> NoReturn:
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+    def log_message(self, *args) -> NoReturn:
+        pass
+
+
+def plain_get(url: str) -> Dict:
+    """The old way, a fresh connection for every request, with the user agent of the session."""
+    return requests.get(url, params={'Collection': 'bench'}, headers={'User-Agent': config.USER_AGENT}, verify=True).json()
+
+
+def pooled_get(url: str) -> Dict:
+    """The new way, over the shared session."""
+    return api_request(url, params={'Collection': 'bench'})[0]
+
+
+def measure(fn: Callable, url: str, n_requests: int, workers: int) -> float:
+    """Return the requests/sec for `n_requests` calls to `fn` spread over `workers` threads.
+    """
+    t1 = default_timer()
+    if workers > 1:
+        with cf.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda _: fn(url), range(n_requests)))
+    else:
+        for _ in range(n_requests):
+            fn(url)
+    return n_requests / (default_timer() - t1)
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', default=1000, type=int)
+    parser.add_argument('--workers', default=8, type=int)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/getSeries'
+    configure_session(pool_maxsize=args.workers)
+    # the rate limit would cap the pooled side, only the connection reuse is compared here
+    configure_retry(rate_limit=0)
+
+    try:
+        for workers in (1, args.workers):
+            before = measure(plain_get, url, args.requests, workers)
+            after = measure(pooled_get, url, args.requests, workers)
+            print(f'workers={workers:<3} requests.get: {before:8.1f} req/s | '
+                  f'pooled session: {after:8.1f} req/s | speedup: {after / before:.2f}x')
+    finally:
+        close_session()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
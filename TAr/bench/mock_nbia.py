@@ -0,0 +1,309 @@
+"""
+This script is a local stand-in for the NBIA endpoints the TAr api requester uses. It serves
+getPatient, getSeries and getImage for synthetic collections, the images are zipped minimal
+dicom files with random pixel data, and the latency, the bandwidth, the error rate and the rate of 429 throttles can be
+set, such that the whole pipeline can be benchmarked without touching the real archive.
+Run it on its own from the TAr folder:
+$ poetry run python bench/mock_nbia.py --port 8000 --latency 0.05 --bandwidth 20
+or use `MockNBIA` as a context manager in a benchmark.
+"""
+# externals
+import io
+import json
+import time
+import random
+import struct
+import zipfile
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, NoReturn, Optional
+
+MEGABYTE = 1024 * 1024
+MODALITIES = ['MR', 'CT', 'PT', 'SEG']
+# the explicit VR little endian transfer syntax and the MR image storage SOP class
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+# the VRs with a 4 byte length in the explicit VR encoding
+LONG_VRS = {'OB', 'OW', 'SQ', 'UN', 'UT', 'UC', 'UR'}
+
+
+def dicom_element(group: int, element: int, vr: str, value) -> bytes:
+    """Encode a single data element in explicit VR little endian, strings are padded to an
+    even length and the US, UL values are packed.
+    """
+    if vr == 'US':
+        value = struct.pack('<H', value)
+    elif vr == 'UL':
+        value = struct.pack('<I', value)
+    elif isinstance(value, str):
+        value = value.encode('ascii')
+        value += (b'\0' if vr == 'UI' else b' ') * (len(value) % 2)
+    head = struct.pack('<HH', group, element) + vr.encode('ascii')
+    if vr in LONG_VRS:
+        return head + struct.pack('<HI', 0, len(value)) + value
+    return head + struct.pack('<H', len(value)) + value
+
+
+def dicom_image(sop_uid: str, number: int, size: int, rng: random.Random) -> bytes:
+    """A minimal MR image of about `size` bytes, 256 columns of 16 bit random pixels wide.
+    """
+    meta = b''.join([
+        dicom_element(0x0002, 0x0001, 'OB', b'\0\1'),
+        dicom_element(0x0002, 0x0002, 'UI', MR_IMAGE_STORAGE),
+        dicom_element(0x0002, 0x0003, 'UI', sop_uid),
+        dicom_element(0x0002, 0x0010, 'UI', EXPLICIT_VR_LITTLE_ENDIAN),
+        ])
+    header = b'\0' * 128 + b'DICM' + dicom_element(0x0002, 0x0000, 'UL', len(meta)) + meta
+    rows = max(1, (size - len(header) - 512) // 512)
+    header += b''.join([
+        dicom_element(0x0008, 0x0016, 'UI', MR_IMAGE_STORAGE),
+        dicom_element(0x0008, 0x0018, 'UI', sop_uid),
+        dicom_element(0x0008, 0x0070, 'LO', 'TAr mock'),
+        dicom_element(0x0020, 0x0013, 'IS', str(number)),
+        dicom_element(0x0020, 0x0032, 'DS', f'0\\0\\{number}'),
+        dicom_element(0x0028, 0x0002, 'US', 1),
+        dicom_element(0x0028, 0x0004, 'CS', 'MONOCHROME2'),
+        dicom_element(0x0028, 0x0010, 'US', rows),
+        dicom_element(0x0028, 0x0011, 'US', 256),
+        dicom_element(0x0028, 0x0030, 'DS', '0.5\\0.5'),
+        dicom_element(0x0028, 0x0100, 'US', 16),
+        dicom_element(0x0028, 0x0101, 'US', 16),
+        dicom_element(0x0028, 0x0102, 'US', 15),
+        dicom_element(0x0028, 0x0103, 'US', 0),
+        ])
+    return header + dicom_element(0x7FE0, 0x0010, 'OW', rng.randbytes(rows * 512))
+
+
+class LinkLimiter:
+    """A shared byte budget per second for all the responses, like the uplink of the server.
+    """
+    def __init__(self, bytes_per_second: float):
+        self.bytes_per_second = bytes_per_second
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, n_bytes: int) -> NoReturn:
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + n_bytes / self.bytes_per_second
+            wait = self._next - now
+        time.sleep(wait)
+
+
+class MockNBIA:
+    """A threaded stand-in NBIA server with synthetic collections.
+    Attributes
+    ----------
+    patients : int
+        The number of patients in every collection.
+    series : int
+        The number of series per patient.
+    images : int
+        The number of images per series, every other series holds twice as many.
+    image_size : int
+        The size of a single image in bytes.
+    latency : float
+        Seconds before every response is sent.
+    bandwidth : float
+        The rate of a single response in MB/s, 0 for no limit.
+    link_bandwidth : float
+        The rate of all the responses together in MB/s, 0 for no limit.
+    error_rate : float
+        The share of the requests answered with a 500 or 503.
+    throttle_rate : float
+        The share of the requests answered with a 429 and a Retry-After header.
+    retry_after : float
+        The Retry-After of the 429 responses in seconds.
+    port : int
+        The port to listen on, 0 for a free one.
+    """
+    def __init__(
+            self,
+            patients: int = 10,
+            series: int = 4,
+            images: int = 20,
+            image_size: int = 64 * 1024,
+            latency: float = 0.0,
+            bandwidth: float = 0.0,
+            link_bandwidth: float = 0.0,
+            error_rate: float = 0.0,
+            throttle_rate: float = 0.0,
+            retry_after: float = 0.0,
+            port: int = 0,
+            seed: int = 0
+            ):
+        self.patients = patients
+        self.series = series
+        self.images = images
+        self.image_size = image_size
+        self.latency = latency
+        self.bandwidth = bandwidth * MEGABYTE
+        self.link = LinkLimiter(link_bandwidth * MEGABYTE) if link_bandwidth else None
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self._zips: Dict[int, bytes] = {}
+        self._zip_lock = threading.Lock()
+        self.n_requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 256
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def series_list(self, collection: str, patient: int) -> List[Dict]:
+        """The getSeries response of a patient, the series alternate between the modalities.
+        """
+        series = []
+        for idx in range(self.series):
+            n_images = self.images * (2 if idx % 2 else 1)
+            series.append({
+                'SeriesInstanceUID': f'1.3.6.1.4.1.9328.{patient}.{idx}',
+                'StudyInstanceUID': f'1.3.6.1.4.1.9328.{patient}.{idx // 2}.0',
+                'PatientID': f'{collection}-{patient:04d}',
+                'Collection': collection,
+                'Modality': MODALITIES[idx % len(MODALITIES)],
+                'SeriesDescription': f'series {idx}',
+                'SeriesNumber': str(idx + 1),
+                'ImageCount': n_images,
+                'FileSize': n_images * self.image_size,
+                'SeriesDate': '2020-01-01',
+                'DateReleased': '2021-01-01 00:00:00.0',
+                })
+        return series
+
+    def zip_for(self, n_images: int) -> bytes:
+        """A zip of `n_images` dicom images, built once per image count."""
+        if n_images not in self._zips:
+            with self._zip_lock:
+                if n_images not in self._zips:
+                    rng = random.Random(n_images)
+                    buffer = io.BytesIO()
+                    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zf:
+                        for idx in range(n_images):
+                            sop_uid = f'1.3.6.1.4.1.9328.9.{n_images}.{idx + 1}'
+                            zf.writestr(f'1-{idx + 1:03d}.dcm', dicom_image(sop_uid, idx + 1, self.image_size, rng))
+                    self._zips[n_images] = buffer.getvalue()
+        return self._zips[n_images]
+
+    def _handler(self) -> type:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) -> NoReturn:
+                pass
+
+            def send_status(self, status: int, headers: Optional[Dict[str, str]] = None) -> NoReturn:
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def send_body(self, body: bytes, content_type: str) -> NoReturn:
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                chunk_size = 64 * 1024
+                for start in range(0, len(body), chunk_size):
+                    chunk = body[start:start + chunk_size]
+                    if mock.link is not None:
+                        mock.link.take(len(chunk))
+                    if mock.bandwidth:
+                        time.sleep(len(chunk) / mock.bandwidth)
+                    self.wfile.write(chunk)
+
+            def do_GET(self) -> NoReturn:
+                mock.n_requests += 1
+                if mock.latency:
+                    time.sleep(mock.latency)
+                draw = mock.random.random()
+                if draw < mock.throttle_rate:
+                    return self.send_status(429, {'Retry-After': str(mock.retry_after)})
+                if draw < mock.throttle_rate + mock.error_rate:
+                    return self.send_status(mock.random.choice([500, 503]))
+
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                endpoint = url.path.rsplit('/', 1)[-1]
+                collection = query.get('Collection', 'mock')
+                if endpoint == 'getPatient':
+                    patients = [{'PatientId': f'{collection}-{p:04d}'} for p in range(mock.patients)]
+                    return self.send_body(json.dumps(patients).encode(), 'application/json')
+                if endpoint == 'getSeries':
+                    if 'PatientID' in query:
+                        patients = [int(query['PatientID'].rsplit('-', 1)[-1])]
+                    else:
+                        patients = range(mock.patients)
+                    series = [s for p in patients for s in mock.series_list(collection, p)]
+                    if 'Modality' in query:
+                        series = [s for s in series if s['Modality'] == query['Modality']]
+                    return self.send_body(json.dumps(series).encode(), 'application/json')
+                if endpoint == 'getImage':
+                    idx = int(query['SeriesInstanceUID'].rsplit('.', 1)[-1])
+                    return self.send_body(mock.zip_for(mock.images * (2 if idx % 2 else 1)), 'application/zip')
+                self.send_status(404)
+
+        return Handler
+
+    def start(self) -> 'MockNBIA':
+        threading.Thread(target=self.server.serve_forever, name='mock_nbia', daemon=True).start()
+        return self
+
+    def stop(self) -> NoReturn:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'MockNBIA':
+        return self.start()
+
+    def __exit__(self, *exc) -> NoReturn:
+        self.stop()
+
+
+def main() -> NoReturn:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--patients', type=int, default=10)
+    parser.add_argument('--series', type=int, default=4)
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--image_kb', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before every response')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='MB/s per response, 0 for no limit')
+    parser.add_argument('--link_bandwidth', type=float, default=0.0, help='MB/s for all responses, 0 for no limit')
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('--throttle_rate', type=float, default=0.0)
+    parser.add_argument('--retry_after', type=float, default=0.0)
+    args = parser.parse_args()
+
+    mock = MockNBIA(
+            patients=args.patients,
+            series=args.series,
+            images=args.images,
+            image_size=args.image_kb * 1024,
+            latency=args.latency,
+            bandwidth=args.bandwidth,
+            link_bandwidth=args.link_bandwidth,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+            retry_after=args.retry_after,
+            port=args.port
+            )
+    print(f'serving the mock NBIA at {mock.base_url}/v1, point config.BASE_URL there')
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
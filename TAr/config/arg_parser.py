@@ -1,22 +1,36 @@
 """
 This script parses arguments for the CLI. The parser has been written
-such that it can be easily expanded via the dict.
+such that it can be easily expanded via the dict. Nothing is parsed at
+import, the CLI entry point calls `parse_args` explicitly.
 """
 
 import argparse
+from typing import Any, Dict, List, Optional
 from config import config
 from src.helpers import str2bool
+from src.shard import parse_shard
 
 DEFAULT_DICT = {
                 'dataset_name': {
-                    'default': config.DATASET_NAME,
+                    # None tells an explicit -d apart from the default when a collections file is given
+                    'default': None,
                     'arg1': '-d',
                     'arg2': '--dataset_name',
-                    'help': 'Specifiy which dataset to fetch from the cancer archive. \
+                    'help': f'Specifiy which dataset to fetch from the cancer archive, several datasets \
+                             can be given comma separated, {config.DATASET_NAME} if neither -d nor -cf is given. \
                              This arg is used in following script: `tcia-api.py`',
                     'required': False,
                     'action': 'store',
                     'type': str},
+                'collections_file': {
+                    'default': config.COLLECTIONS_FILE,
+                    'arg1': '-cf',
+                    'arg2': '--collections_file',
+                    'help': 'A file with one dataset per line, all fetched in one run with shared pools. \
+                             Lines starting with # are skipped. This arg is used in following script: `api_request_controller.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str},
                 'workers': {
                     'default': config.WORKERS,
                     'arg1': '-w',
@@ -32,8 +46,8 @@ DEFAULT_DICT = {
                     'arg1': '-tn',
                     'arg2': '--thread_num',
                     'help': 'Specifiy how many concurrent processes to start at the same time. \
-                             Its advisable to use a high number for large datasets. \
-                             This arg is used in following script: `tcia-api.py`',
+                             Not used anymore since the downloads run from a series-level work queue, \
+                             the concurrency is set by the workers alone. Kept for compatibility.',
                     'required': False,
                     'action': 'store',
                     'type': int},
@@ -45,20 +59,393 @@ DEFAULT_DICT = {
                              This arg is used in following script: `tcia_api.py`',
                     'required': False,
                     'action': 'store_false',
+                    'type': str2bool},
+                'resume': {
+                    'default': config.RESUME,
+                    'arg1': '-r',
+                    'arg2': '--resume',
+                    'help': 'Skip the series that are already recorded as completed in the manifest \
+                             of the dataset folder. Set to false to download everything again. \
+                             This arg is used in following script: `api_request_controller.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str2bool},
+                'sync': {
+                    'default': config.SYNC,
+                    'arg1': '-sy',
+                    'arg2': '--sync',
+                    'help': 'Diff the remote series list against the manifest and the local tree, and download \
+                             only the new or changed series. The delta is written to the dataset folder. \
+                             This arg is used in following script: `api_request_controller.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str2bool},
+                'plan': {
+                    'default': config.PLAN,
+                    'arg1': '-pl',
+                    'arg2': '--plan',
+                    'help': 'Dry run: print the size of the pull, the largest patients, a runtime estimate \
+                             and the recommended workers, without downloading any image data. \
+                             This arg is used in following script: `planner.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str2bool},
+                'modality': {
+                    'default': config.MODALITY,
+                    'arg1': '-mo',
+                    'arg2': '--modality',
+                    'help': 'Only fetch the series of these modalities, comma separated e.g. MR,CT. A single \
+                             modality is filtered by NBIA already. This arg is used in following script: `filters.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str},
+                'series_description': {
+                    'default': config.SERIES_DESCRIPTION,
+                    'arg1': '-sd',
+                    'arg2': '--series_description',
+                    'help': 'Only fetch the series whose SeriesDescription matches this case insensitive regex. \
+                             This arg is used in following script: `filters.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str},
+                'patients': {
+                    'default': config.PATIENTS,
+                    'arg1': '-pt',
+                    'arg2': '--patients',
+                    'help': 'Only fetch these PatientIDs, comma separated or a file with one per line. \
+                             This arg is used in following script: `filters.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str},
+                'max_series_per_patient': {
+                    'default': config.MAX_SERIES_PER_PATIENT,
+                    'arg1': '-msp',
+                    'arg2': '--max_series_per_patient',
+                    'help': 'Fetch at most this many series per patient, 0 for all. \
+                             This arg is used in following script: `filters.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': int},
+                'max_series_mb': {
+                    'default': config.MAX_SERIES_MB,
+                    'arg1': '-msm',
+                    'arg2': '--max_series_mb',
+                    'help': 'Skip the series larger than this many MB, 0 for no limit. \
+                             This arg is used in following script: `filters.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': float},
+                'max_total_gb': {
+                    'default': config.MAX_TOTAL_GB,
+                    'arg1': '-mtg',
+                    'arg2': '--max_total_gb',
+                    'help': 'Stop queueing series once this many GB are queued, 0 for no limit. \
+                             This arg is used in following script: `api_request_controller.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': float},
+                'priority_patients': {
+                    'default': config.PRIORITY_PATIENTS,
+                    'arg1': '-ppt',
+                    'arg2': '--priority_patients',
+                    'help': 'Queue the series of these comma separated PatientIDs, or the ones in this file, first. \
+                             This arg is used in following script: `filters.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str},
+                'priority_modalities': {
+                    'default': config.PRIORITY_MODALITIES,
+                    'arg1': '-pmo',
+                    'arg2': '--priority_modalities',
+                    'help': 'Queue the series of these comma separated modalities next, in the given order. \
+                             This arg is used in following script: `filters.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str},
+                'metadata_cache': {
+                    'default': config.USE_METADATA_CACHE,
+                    'arg1': '-mc',
+                    'arg2': '--metadata_cache',
+                    'help': 'Cache the getPatient and getSeries responses on disk and reuse them \
+                             while they are fresh, off by default such that a run sees the newly released \
+                             series. This arg is used in following script: `tcia_api.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str2bool},
+                'cache_ttl': {
+                    'default': config.METADATA_CACHE_TTL,
+                    'arg1': '-ttl',
+                    'arg2': '--cache_ttl',
+                    'help': 'Set the time to live of the cached metadata in seconds. \
+                             This arg is used in following script: `cache.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': float},
+                'offline_metadata': {
+                    'default': config.OFFLINE_METADATA,
+                    'arg1': '-om',
+                    'arg2': '--offline_metadata',
+                    'help': 'Build the series information from the metadata cache alone, without any \
+                             getPatient or getSeries requests. This arg is used in following script: `tcia_api.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str2bool},
+                'store': {
+                    'default': config.USE_STORE,
+                    'arg1': '-st',
+                    'arg2': '--store',
+                    'help': 'Keep every dicom file once in the content-addressed store and link the dataset \
+                             trees into it, a series already in the store is linked instead of downloaded. \
+                             This arg is used in following script: `store.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str2bool},
+                'store_link': {
+                    'default': config.STORE_LINK,
+                    'arg1': '-sl',
+                    'arg2': '--store_link',
+                    'help': 'Link the dataset trees into the store with a `hardlink` or a `symlink`. \
+                             This arg is used in following script: `store.py`',
+                    'required': False,
+                    'action': 'store',
+                    'choices': config.STORE_LINKS,
+                    'type': str},
+                'output': {
+                    'default': config.OUTPUT_MODE,
+                    'arg1': '-out',
+                    'arg2': '--output',
+                    'help': 'Write the series to the patient/study/series/sedesc `tree`, or stream them into \
+                             sequential `tar` shards with a json lines index in the dataset folder. \
+                             This arg is used in following script: `archive.py`',
+                    'required': False,
+                    'action': 'store',
+                    'choices': config.OUTPUT_MODES,
+                    'type': str},
+                'catalog': {
+                    'default': config.USE_CATALOG,
+                    'arg1': '-cat',
+                    'arg2': '--catalog',
+                    'help': 'Read the headers of every verified series up to the pixel data and write a row per \
+                             series and per instance to the sqlite catalog in the dataset folder, needs pydicom. \
+                             This arg is used in following script: `catalog.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str2bool},
+                'tar_shard_mb': {
+                    'default': config.TAR_SHARD_MB,
+                    'arg1': '-tsm',
+                    'arg2': '--tar_shard_mb',
+                    'help': 'Start a new tar shard once the current one holds this many MB. \
+                             This arg is used in following script: `archive.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': float},
+                'shard': {
+                    'default': config.SHARD,
+                    'arg1': '-s',
+                    'arg2': '--shard',
+                    'help': 'Fetch only the i-th of N shards of the collection, given as i/N, e.g. 0/4. \
+                             The series are assigned to the shards by a stable hash of their UID. \
+                             This arg is used in following script: `shard.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': parse_shard},
+                'shard_by': {
+                    'default': config.SHARD_BY,
+                    'arg1': '-sb',
+                    'arg2': '--shard_by',
+                    'help': 'Hash the `series` UIDs or the `patient` IDs into the shards, the latter keeps \
+                             all the series of a patient on one node. This arg is used in following script: `shard.py`',
+                    'required': False,
+                    'action': 'store',
+                    'choices': config.SHARD_BY_OPTIONS,
+                    'type': str},
+                'merge_shards': {
+                    'default': config.MERGE_SHARDS,
+                    'arg1': '-ms',
+                    'arg2': '--merge_shards',
+                    'help': 'Comma separated manifest files or folders from the shards. Instead of downloading, \
+                             verify that they together cover the whole collection. \
+                             This arg is used in following script: `shard.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str},
+                'engine': {
+                    'default': config.ENGINE,
+                    'arg1': '-e',
+                    'arg2': '--engine',
+                    'help': 'Choose the download engine, `thread` runs the downloads in a thread pool \
+                             while `async` runs them on an asyncio event loop. \
+                             This arg is used in following script: `api_request_controller.py`',
+                    'required': False,
+                    'action': 'store',
+                    'choices': config.ENGINES,
+                    'type': str},
+                'max_in_flight': {
+                    'default': config.MAX_IN_FLIGHT,
+                    'arg1': '-mif',
+                    'arg2': '--max_in_flight',
+                    'help': 'Set the maximum number of getImage requests in flight at once for the async engine. \
+                             This arg is used in following script: `async_engine.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': int},
+                'extract_mode': {
+                    'default': config.EXTRACT_MODE,
+                    'arg1': '-em',
+                    'arg2': '--extract_mode',
+                    'help': 'Choose how the series zips are extracted, `spool` unpacks them from a temp buffer \
+                             that stays in memory below a threshold, `disk` writes the zip next to the dicom files first. \
+                             This arg is used in following script: `tcia_api.py`',
+                    'required': False,
+                    'action': 'store',
+                    'choices': config.EXTRACT_MODES,
+                    'type': str},
+                'extract_workers': {
+                    'default': config.EXTRACT_WORKERS,
+                    'arg1': '-ew',
+                    'arg2': '--extract_workers',
+                    'help': 'Set the number of processes that extract the series zips, separate from the \
+                             download workers. 0 extracts on the download thread. With the async engine \
+                             it sets the number of extraction threads. This arg is used in following script: `extraction.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': int},
+                'extract_queue': {
+                    'default': config.EXTRACT_QUEUE_SIZE,
+                    'arg1': '-eq',
+                    'arg2': '--extract_queue',
+                    'help': 'Set how many downloaded zips may wait for the extraction processes before \
+                             the downloads are held back, for both engines. This arg is used in following scripts: \
+                             `extraction.py`, `async_engine.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': int},
+                'metadata_workers': {
+                    'default': config.METADATA_WORKERS,
+                    'arg1': '-mw',
+                    'arg2': '--metadata_workers',
+                    'help': 'Set the number of patients to request the series information for concurrently. \
+                             This arg is used in following script: `tcia_api.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': int},
+                'max_retries': {
+                    'default': config.MAX_RETRIES,
+                    'arg1': '-mr',
+                    'arg2': '--max_retries',
+                    'help': 'Set how many times a throttled or failed request is retried with backoff. \
+                             This arg is used in following script: `retry.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': int},
+                'series_attempts': {
+                    'default': config.SERIES_ATTEMPTS,
+                    'arg1': '-sa',
+                    'arg2': '--series_attempts',
+                    'help': 'Set how many rounds a series is downloaded in when it fails the checksum, \
+                             image count or zip CRC verification. \
+                             This arg is used in following script: `api_request_controller.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': int},
+                'rate_limit': {
+                    'default': config.RATE_LIMIT,
+                    'arg1': '-rl',
+                    'arg2': '--rate_limit',
+                    'help': 'Set the highest number of requests per second, the rate shrinks when NBIA \
+                             throttles and grows back on success. Set to 0 to disable. \
+                             This arg is used in following script: `retry.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': float},
+                'bandwidth_limit': {
+                    'default': config.BANDWIDTH_LIMIT,
+                    'arg1': '-bw',
+                    'arg2': '--bandwidth_limit',
+                    'help': 'Set the budget for all the downloads together in MB/s, 0 for no limit. \
+                             This arg is used in following script: `bandwidth.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': float},
+                'bandwidth_file': {
+                    'default': config.BANDWIDTH_FILE,
+                    'arg1': '-bf',
+                    'arg2': '--bandwidth_file',
+                    'help': 'Set a file holding the budget in MB/s, it is read again when it changes or on a \
+                             SIGHUP, such that the budget can be changed while running. \
+                             This arg is used in following script: `bandwidth.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str},
+                'metrics_path': {
+                    'default': config.METRICS_PATH,
+                    'arg1': '-mp',
+                    'arg2': '--metrics_path',
+                    'help': 'Set the folder for the Prometheus text file and the json summary of the \
+                             performance metrics, defaults to the dataset folder. \
+                             This arg is used in following script: `metrics.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str},
+                'pool_size': {
+                    'default': config.POOL_MAXSIZE,
+                    'arg1': '-ps',
+                    'arg2': '--pool_size',
+                    'help': 'Set the maximum number of pooled connections kept alive per host. \
+                             Should be at least the number of max_workers to avoid throwaway connections. \
+                             This arg is used in following script: `session.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': int},
+                'pool_block': {
+                    'default': config.POOL_BLOCK,
+                    'arg1': '-pb',
+                    'arg2': '--pool_block',
+                    'help': 'Set to true to make the pool size a hard per-host limit, threads will then \
+                             wait for a free connection. This arg is used in following script: `session.py`',
+                    'required': False,
+                    'action': 'store',
+                    'type': str2bool},
+                'keep_alive': {
+                    'default': config.KEEP_ALIVE,
+                    'arg1': '-ka',
+                    'arg2': '--keep_alive',
+                    'help': 'Set to false to close the connection after every request. \
+                             This arg is used in following script: `session.py`',
+                    'required': False,
+                    'action': 'store',
                     'type': str2bool}
                     }
 
-parser = argparse.ArgumentParser(description=__doc__)
+# NOTE: nothing is parsed at import, the CLI entry point calls `parse_args` explicitly
+def build_parser() -> argparse.ArgumentParser:
+    """Build the argument parser from the `DEFAULT_DICT`.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    for v in DEFAULT_DICT.values():
+        parser.add_argument(
+                    v['arg1'],
+                    v['arg2'],
+                    help=v['help'],
+                    default=v['default'],
+                    required=v['required'],
+                    choices=v.get('choices'),
+                    type=v['type']
+                    )
+    return parser
 
-for v in DEFAULT_DICT.values():
-    parser.add_argument(
-                v['arg1'],
-                v['arg2'],
-                help=v['help'],
-                default=v['default'],
-                required=v['required'],
-                type=v['type']
-                )
 
-# Convert everythin to a dictionary
-args = vars(parser.parse_args())
+def parse_args(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Parse the CLI arguments, `sys.argv` if no `argv` is given.
+    Parameters
+    ----------
+    argv : List[str]
+        The arguments to parse, without the program name.
+    Returns
+    -------
+    Dict[str, Any]
+        The arguments by their long name.
+    """
+    # Convert everythin to a dictionary
+    return vars(build_parser().parse_args(argv))
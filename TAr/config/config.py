@@ -6,9 +6,7 @@ are used in various modules, classes and controllers.
 
 # externals
 import os
-from fake_useragent import UserAgent
-# internals
-from src.helpers import nested_dict
+from typing import Any
 
 
 # paths
@@ -24,6 +22,39 @@ NII_PREPROC_DATASET_PATH = os.path.join(PREPROC_DATA, 'preproc-{collection}-nift
 JSON_FILE_PATH = os.path.join(RAW_DATA, 'json_files')
 NII_JSON_PATH = os.path.join(JSON_FILE_PATH, 'nifti_{project_name}.json')
 HEADER_JSON_PATH = os.path.join(JSON_FILE_PATH, 'header_{project_name}.json')
+# cache for the getPatient and getSeries responses
+METADATA_CACHE_PATH = os.path.join(JSON_FILE_PATH, 'metadata_cache')
+METADATA_CACHE_TTL = 24 * 60 * 60
+METADATA_CACHE_MAX_ENTRIES = 100000
+# the manifest of completed series is kept in the dataset folder
+MANIFEST_NAME = 'manifest.jsonl'
+# the content-addressed store every dicom file is kept in once, the dataset trees link into it
+USE_STORE = False
+STORE_PATH = os.path.join(RAW_DATA, 'dicom-store')
+# either `hardlink` or `symlink`, a hardlink across filesystems falls back to a symlink
+STORE_LINK = 'hardlink'
+STORE_LINKS = ['hardlink', 'symlink']
+# write the series to the patient/study/series/sedesc `tree`, or stream them into `tar` shards
+OUTPUT_MODE = 'tree'
+OUTPUT_MODES = ['tree', 'tar']
+TAR_SHARD_MB = 1024
+TAR_FOLDER_NAME = 'shards'
+TAR_INDEX_NAME = 'index.jsonl'
+# the sqlite catalog of the series and instances, the headers are read with pydicom
+USE_CATALOG = False
+CATALOG_NAME = 'catalog.sqlite'
+CATALOG_HEADER_FIELDS = [
+    'SOPInstanceUID', 'SOPClassUID', 'InstanceNumber', 'AcquisitionDate', 'AcquisitionTime',
+    'Manufacturer', 'Rows', 'Columns', 'BitsAllocated', 'PixelSpacing', 'SliceThickness',
+    'SliceLocation', 'ImagePositionPatient', 'ImageOrientationPatient', 'TransferSyntaxUID'
+    ]
+# the header of an image in a tar shard is read from this many bytes unless the pixel data starts later
+CATALOG_HEADER_BYTES = 64 * 1024
+# the metrics are written to the dataset folder unless another folder is given
+METRICS_PATH = ''
+METRICS_PROM_NAME = 'metrics.prom'
+METRICS_SUMMARY_NAME = 'metrics_summary.json'
+METRICS_INTERVAL = 15
 
 # config for the TCIA API requests
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -47,11 +78,69 @@ non_imgs = 0
 
 # Default params for the TAr
 DATASET_NAME = 'Brain-Tumor-Progression'
+COLLECTIONS_FILE = ''
 WORKERS = 5
 THREAD_NUM = 5
+METADATA_WORKERS = 8
+# the download engine, either the thread pool or the asyncio event loop
+ENGINE = 'thread'
+ENGINES = ['thread', 'async']
+MAX_IN_FLIGHT = 100
+ASYNC_READ_TIMEOUT = 300
 USE_CPU_COUNT = False
+RESUME = True
+# refresh a collection by downloading only the new or changed series
+SYNC = False
+SYNC_REPORT_NAME = 'sync_report.json'
+# the getSeries fields that tell when a series was changed, the first one present is used
+SYNC_DATE_FIELDS = ['DateReleased', 'TimeStamp']
+# run only the i-th of N shards of a collection, e.g. '0/4'
+SHARD = ''
+SHARD_BY = 'series'
+SHARD_BY_OPTIONS = ['series', 'patient']
+MERGE_SHARDS = ''
+SHARD_REPORT_NAME = 'shard_merge_report.json'
+# select the series before any getImage request, empty or 0 does not filter
+MODALITY = ''
+SERIES_DESCRIPTION = ''
+PATIENTS = ''
+MAX_SERIES_PER_PATIENT = 0
+MAX_SERIES_MB = 0
+MAX_TOTAL_GB = 0
+USE_METADATA_CACHE = False
+OFFLINE_METADATA = False
+
+# Connection pool for the requests towards NBIA
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 32
+POOL_BLOCK = False
+KEEP_ALIVE = True
+
+# Retries and rate limiting for the requests towards NBIA
+REQUEST_TIMEOUT = (10, 300)
+MAX_RETRIES = 5
+RETRY_STATUS = [429, 500, 502, 503, 504]
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_AFTER_MAX = 600.0
+# requests per second, the bucket halves on throttling and grows back on success
+RATE_LIMIT = 50.0
+RATE_LIMIT_MIN = 0.5
+RATE_INCREASE = 0.5
+RATE_DECREASE = 0.5
+# the budget for all the downloads together in MB/s, 0 for no limit, it can be changed while
+# running through the control file, which is checked every few seconds and on a SIGHUP
+BANDWIDTH_LIMIT = 0.0
+BANDWIDTH_FILE = ''
+BANDWIDTH_POLL_SECONDS = 5.0
+BANDWIDTH_BURST_SECONDS = 0.5
+# the patients and then the modalities to queue first, comma separated or a file each
+PRIORITY_PATIENTS = ''
+PRIORITY_MODALITIES = ''
 
 CHAR_TO_REMOVE = ['#', '%', '-', '*', '@', '!']
+# the folders of a work queue are created up front on this many threads
+LAYOUT_WORKERS = 8
 
 # Parameters for to use in the base URL
 get_patient_params = {
@@ -64,11 +153,70 @@ get_series_params = {
                     'PatientID': 'placeholder'
                     }
 
-USER_AGENT = UserAgent().chrome
+# the user agent is looked up on first use, fake_useragent is slow to load and may go online
+FALLBACK_USER_AGENT = (
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+    )
 # List used in the data handling
-series_instances_dict = nested_dict()
-SERIES_INSTANCES_LIST = ['SeriesInstanceUID', 'StudyInstanceUID', 'SeriesDescription']
+SERIES_INSTANCES_LIST = [
+    'SeriesInstanceUID', 'StudyInstanceUID', 'SeriesDescription', 'ImageCount', 'FileSize', 'DateReleased', 'TimeStamp',
+    'Modality'
+    ]
 CONVERSION_ITEMS = ['img_array', 'patientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesDescription']
-conversion_info = nested_dict()
 
 MEGABYTE = 1024 * 1024
+# fixed buffer size used when streaming the image downloads to disk
+CHUNK_SIZE = MEGABYTE
+# the series zips are unpacked from a spooled buffer that stays in memory below this size
+EXTRACT_MODE = 'spool'
+EXTRACT_MODES = ['spool', 'disk']
+SPOOL_MAX_SIZE = 64 * MEGABYTE
+SPOOL_DIR = None
+# 0 extracts on the download thread, otherwise a process pool fed through a bounded queue
+EXTRACT_WORKERS = 0
+EXTRACT_QUEUE_SIZE = 16
+# the extraction processes are not forked from the download threads, which may hold locks
+EXTRACT_START_METHOD = 'forkserver'
+# the zips are hashed while streaming, a series failing the checks is queued again
+HASH_ALGORITHM = 'sha256'
+SERIES_ATTEMPTS = 3
+
+# the dry-run planner, the probe streams metadata only
+PLAN = False
+PLAN_NAME = 'plan.json'
+PLAN_TOP_PATIENTS = 10
+PLAN_PROBE_STREAMS = [1, 2, 4, 8, 16]
+PLAN_PROBE_SECONDS = 2.0
+# below this many bytes in total the probe only measures the latency
+PLAN_PROBE_MIN_BYTES = MEGABYTE
+PLAN_DEFAULT_LATENCY = 0.5
+PLAN_DEFAULT_BYTES_PER_SECOND = 5 * MEGABYTE
+PLAN_WORKER_CANDIDATES = [1, 2, 4, 8, 16, 32, 64]
+
+_user_agent = None
+
+
+def get_user_agent() -> str:
+    """Return the chrome user agent of fake_useragent, the fallback one if it can not be loaded.
+    """
+    global _user_agent
+    if _user_agent is None:
+        try:
+            from fake_useragent import UserAgent
+            _user_agent = UserAgent().chrome
+        except Exception:
+            _user_agent = FALLBACK_USER_AGENT
+    return _user_agent
+
+
+def __getattr__(name: str) -> Any:
+    """Build the expensive settings on first access instead of at import, such that the
+    config can be imported by library code at no cost.
+    """
+    if name == 'USER_AGENT':
+        return get_user_agent()
+    if name == 'conversion_info':
+        from src.helpers import nested_dict
+        globals()[name] = nested_dict()
+        return globals()[name]
+    raise AttributeError(f'module {__name__} has no attribute {name}')
@@ -0,0 +1,223 @@
+"""
+This script contains the tar shard output of the TAr api requester. Instead of extracting
+every series into the patient/study/series/sedesc tree, the members of the getImage zips are
+streamed into large sequential tar shards in the WebDataset layout, one sample per image keyed
+by `<patient>/<series>/<image>`. A json line per series in the index holds the shard and the
+offset and size of every image, such that a single image can be read without scanning a shard.
+"""
+# externals
+import os
+import glob
+import json
+import tarfile
+import threading
+import zlib
+from time import time
+from zipfile import ZipFile, BadZipFile, LargeZipFile
+from typing import Any, Dict, IO, NoReturn, Optional, Union
+# internals
+from config import config
+from config.logger import log
+from src.scheduler import SeriesTask
+from src.metrics import metrics
+from src.integrity import ExtractResult
+from src.catalog import HeadReader, read_head
+
+
+class TarShardWriter:
+    """Appends the series of a collection to tar shards of about `shard_bytes` each. The
+    series are written whole under a lock, such that a series never spans two shards and the
+    shards are written sequentially, however many workers download.
+    Attributes
+    ----------
+    folder : os.PathLike
+        The folder the shards and the index are written to.
+    prefix : str
+        The start of the shard names, the shard number is added to it.
+    shard_bytes : int
+        A new shard is started once the current one holds this many bytes.
+    index_name : str
+        The name of the json lines index in the `folder`.
+    read_headers : bool
+        Set `read_headers` to true to parse the dicom headers while the images are copied,
+        for the catalog.
+    """
+    def __init__(
+            self,
+            folder: os.PathLike,
+            prefix: str,
+            shard_bytes: int = int(config.TAR_SHARD_MB * config.MEGABYTE),
+            index_name: str = config.TAR_INDEX_NAME,
+            read_headers: bool = False
+            ):
+        self.folder = folder
+        self.prefix = prefix
+        self.shard_bytes = shard_bytes
+        self.read_headers = read_headers
+        self.index_path = os.path.join(folder, index_name)
+        self._lock = threading.Lock()
+        self._tar: Optional[tarfile.TarFile] = None
+        self._name = ''
+        os.makedirs(folder, exist_ok=True)
+        # a shard of an earlier run is closed, the numbering goes on after it
+        self._number = len(glob.glob(os.path.join(folder, f'{glob.escape(prefix)}-*.tar')))
+
+    def _open(self) -> tarfile.TarFile:
+        if self._tar is None:
+            self._name = f'{self.prefix}-{self._number:06d}.tar'
+            self._number += 1
+            self._tar = tarfile.open(os.path.join(self.folder, self._name), 'w', format=tarfile.PAX_FORMAT)
+            log.info(f'writing the tar shard {self._name}')
+        return self._tar
+
+    def _rollback(self, tar: tarfile.TarFile, offset: int) -> NoReturn:
+        """Cut a series that failed half way off the end of the shard. If the buffered rest of
+        the series cannot be written out either, e.g. on a full disk, the shard is cut by its
+        path and ended there, and the next series starts a new shard."""
+        try:
+            tar.fileobj.seek(offset)
+            tar.fileobj.truncate()
+            tar.offset = offset
+        except OSError:
+            path = os.path.join(self.folder, self._name)
+            try:
+                tar.fileobj.close()
+            except OSError:
+                pass
+            self._tar = None
+            os.truncate(path, offset)
+            with open(path, 'ab') as fp:
+                fp.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+
+    def write_series(self, task: SeriesTask, zip_source: Union[os.PathLike, IO[bytes]]) -> ExtractResult:
+        """Stream the members of a series zip into the current shard and index them. The CRC
+        of every member is checked while it is copied, a broken series is cut off the shard
+        again. A zip with fewer images than the ImageCount is not written at all.
+        Parameters
+        ----------
+        task : SeriesTask
+            The series the zip belongs to.
+        zip_source : Union[os.PathLike, IO[bytes]]
+            The path to the zip file or a seekable file object holding it.
+        Returns
+        -------
+        ExtractResult
+            The number of images and bytes written, the shard name, the offsets and headers
+            of the images, and the error if any.
+        """
+        with self._lock, metrics.timed('extract_seconds'):
+            tar = self._open()
+            start = tar.offset
+            members: Dict[str, Any] = {}
+            heads: Dict[str, bytes] = {}
+            try:
+                with ZipFile(zip_source) as zf:
+                    infos = [info for info in zf.infolist() if not info.is_dir()]
+                    if task.image_count and len(infos) < task.image_count:
+                        return ExtractResult(len(infos), 0)
+                    for info in infos:
+                        name = f'{task.patient}/{task.series_uid}/{os.path.basename(info.filename)}'
+                        member = tarfile.TarInfo(name)
+                        member.size = info.file_size
+                        member.mtime = time()
+                        with zf.open(info) as src:
+                            if self.read_headers:
+                                # the start of the image is kept while it is copied
+                                src = HeadReader(src)
+                                heads[os.path.basename(info.filename)] = src.head
+                            tar.addfile(member, src)
+                        # the data follows its header, which is padded to whole blocks
+                        data_offset = tar.offset - tarfile.BLOCKSIZE * -(-member.size // tarfile.BLOCKSIZE)
+                        members[os.path.basename(info.filename)] = [data_offset, member.size]
+            except (BadZipFile, LargeZipFile, ValueError, EOFError, zlib.error) as error:
+                self._rollback(tar, start)
+                log.error(f'writing series {task.series_uid} to {self._name} failed: {error}')
+                return ExtractResult(0, 0, f'the zip is broken: {error}')
+            except OSError as error:
+                name = self._name
+                self._rollback(tar, start)
+                log.error(f'writing series {task.series_uid} to {name} failed: {error}')
+                return ExtractResult(0, 0, f'the shard could not be written: {error}')
+            except Exception:
+                # a half written member would end the shard for sequential readers
+                self._rollback(tar, start)
+                raise
+
+            entry = {
+                'SeriesInstanceUID': task.series_uid,
+                'PatientID': task.patient,
+                'StudyInstanceUID': task.study_uid,
+                'SeriesDescription': task.description,
+                'Modality': task.modality,
+                'shard': self._name,
+                'offset': start,
+                'size': tar.offset - start,
+                'members': members
+                }
+            with open(self.index_path, 'a') as fp:
+                fp.write(json.dumps(entry) + '\n')
+            shard = self._name
+            if tar.offset >= self.shard_bytes:
+                self._close()
+            else:
+                # the series is readable from the shard once it is indexed
+                tar.fileobj.flush()
+        # the headers are parsed outside of the lock, an image whose header did not fit in its
+        # head is left out and read from the shard by the catalog
+        headers = {}
+        for name, head in heads.items():
+            header = read_head(bytes(head), members[name][1])
+            if header is not None:
+                headers[name] = header
+        return ExtractResult(
+                        len(members),
+                        sum(size for _, size in members.values()),
+                        shard=shard,
+                        members=members,
+                        headers=headers if self.read_headers else None
+                        )
+
+    def _close(self) -> NoReturn:
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def close(self) -> NoReturn:
+        """Finish the current shard with the end of archive blocks."""
+        with self._lock:
+            self._close()
+
+
+def load_index(folder: os.PathLike, index_name: str = config.TAR_INDEX_NAME) -> Dict[str, Dict[str, Any]]:
+    """Read the index of a shard folder, a later line for the same series wins.
+    """
+    index = {}
+    with open(os.path.join(folder, index_name), 'r') as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+                index[entry['SeriesInstanceUID']] = entry
+            except (ValueError, KeyError):
+                log.warning(f'skipping a broken line in the shard index of {folder}')
+    return index
+
+
+def read_image(folder: os.PathLike, entry: Dict[str, Any], name: str) -> bytes:
+    """Read a single image of a series from its shard with one seek.
+    Parameters
+    ----------
+    folder : os.PathLike
+        The folder of the shards.
+    entry : Dict[str, Any]
+        The index entry of the series.
+    name : str
+        The file name of the image in the series zip, e.g. `1-001.dcm`.
+    Returns
+    -------
+    bytes
+        The dicom file.
+    """
+    offset, size = entry['members'][name]
+    with open(os.path.join(folder, entry['shard']), 'rb') as fp:
+        fp.seek(offset)
+        return fp.read(size)
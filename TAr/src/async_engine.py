@@ -0,0 +1,269 @@
+"""
+This script contains the asyncio download engine for the TAr api requester. It is an
+alternative to the ThreadPoolExecutor in the request controller: all the getImage requests
+run on one event loop, a global semaphore caps how many are in flight and the zip extraction
+is handed to an executor such that it never blocks the network I/O.
+"""
+# externals
+import os
+import asyncio
+import concurrent.futures as cf
+from tempfile import SpooledTemporaryFile
+from timeit import default_timer
+from typing import IO, Iterable, Mapping, NoReturn, Optional, Tuple
+# internals
+from config import config
+from config.logger import log
+from src.scheduler import SeriesTask
+from src.manifest import Manifest
+from src.metrics import metrics
+from src.bandwidth import get_limiter
+from src.retry import get_bucket, get_max_retries, is_retryable, retry_after_seconds, backoff_delay
+from src.extraction import extract_zip, extract_zip_file
+from src.integrity import DownloadResult, ExtractResult, check_response, new_hasher
+from src.store import DicomStore
+from src.archive import TarShardWriter
+from src.catalog import Catalog
+from src.tcia_api import make_series_folder, record_series, log_download_rate
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# collection name -> (data_path, manifest)
+Targets = Mapping[str, Tuple[os.PathLike, Optional[Manifest]]]
+
+
+async def _download(session: 'aiohttp.ClientSession', siUID: str, fp: IO[bytes]) -> DownloadResult:
+    """Stream the getImage response into `fp`, going through the shared token bucket and
+    retrying with backoff like the synchronous requests. The zip is hashed while it is
+    written, the size, the digest and the response check are returned.
+    """
+    max_retries = get_max_retries()
+    # like the thread engine, the request time spans the retries until the headers arrive
+    t1 = default_timer()
+    for attempt in range(max_retries + 1):
+        bucket = get_bucket()
+        if bucket is not None:
+            await asyncio.sleep(bucket.reserve())
+        fp.seek(0)
+        fp.truncate()
+        try:
+            async with session.get(config.URL_IMG, params={'SeriesInstanceUID': siUID}) as resp:
+                if is_retryable(resp.status) and attempt < max_retries:
+                    retry_after = retry_after_seconds(resp.headers)
+                    delay = backoff_delay(attempt, retry_after)
+                    if bucket is not None:
+                        bucket.on_throttle(retry_after)
+                    log.warning(
+                        f'request came back with status code: {resp.status} for url: {resp.url}, '
+                        f'retry {attempt + 1}/{max_retries} in {delay:.1f} sec'
+                        )
+                else:
+                    metrics.observe('image_request_seconds', default_timer() - t1)
+                    resp.raise_for_status()
+                    n_bytes, hasher, limiter = 0, new_hasher(), get_limiter()
+                    async for chunk in resp.content.iter_chunked(config.CHUNK_SIZE):
+                        if limiter is not None:
+                            wait = limiter.reserve(len(chunk))
+                            if wait > 0:
+                                metrics.observe('bandwidth_wait_seconds', wait)
+                                await asyncio.sleep(wait)
+                        fp.write(chunk)
+                        hasher.update(chunk)
+                        n_bytes += len(chunk)
+                    if bucket is not None:
+                        bucket.on_success()
+                    return DownloadResult(n_bytes, hasher.hexdigest(), check_response(resp.headers, n_bytes))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == max_retries:
+                metrics.observe('image_request_seconds', default_timer() - t1)
+                raise
+            if bucket is not None:
+                bucket.on_throttle()
+            delay = backoff_delay(attempt)
+            log.warning(f'request for series {siUID} failed to connect, retry {attempt + 1}/{max_retries} in {delay:.1f} sec')
+        await asyncio.sleep(delay)
+
+
+async def _fetch_series(
+                session: 'aiohttp.ClientSession',
+                semaphore: asyncio.Semaphore,
+                extract_slots: asyncio.Semaphore,
+                executor: cf.Executor,
+                task: SeriesTask,
+                targets: Targets,
+                extract_mode: str,
+                store: Optional[DicomStore],
+                layout: Optional[Mapping[Tuple[str, str], os.PathLike]],
+                shards: Optional[Mapping[str, TarShardWriter]],
+                catalogs: Optional[Mapping[str, Catalog]]
+                ) -> NoReturn:
+    """Run a single series, a failure outside of the download is logged and the series is
+    recorded as failed, such that it is queued again and the other series go on like in the
+    thread engine.
+    """
+    try:
+        await _run_series(session, semaphore, extract_slots, executor, task, targets, extract_mode, store, layout, shards, catalogs)
+    except Exception as error:
+        log.error(f'series {task.series_uid} failed', exc_info=True)
+        manifest = targets[task.collection][1]
+        if manifest is not None:
+            try:
+                manifest.record(task.series_uid, status='failed', error=f'{type(error).__name__}: {error}')
+            except OSError:
+                log.error(f'could not record series {task.series_uid} as failed', exc_info=True)
+
+
+async def _run_series(
+                session: 'aiohttp.ClientSession',
+                semaphore: asyncio.Semaphore,
+                extract_slots: asyncio.Semaphore,
+                executor: cf.Executor,
+                task: SeriesTask,
+                targets: Targets,
+                extract_mode: str,
+                store: Optional[DicomStore],
+                layout: Optional[Mapping[Tuple[str, str], os.PathLike]],
+                shards: Optional[Mapping[str, TarShardWriter]],
+                catalogs: Optional[Mapping[str, Catalog]]
+                ) -> NoReturn:
+    """Stream a single series zip to a spooled buffer or to disk, extract it in the executor
+    and verify it. A series in the store is linked from there instead, with tar shards the
+    spooled zip is appended to the shards of its collection.
+    """
+    siUID = task.series_uid
+    data_path, manifest = targets[task.collection]
+    loop = asyncio.get_running_loop()
+    writer = shards.get(task.collection) if shards is not None else None
+    catalog = catalogs.get(task.collection) if catalogs is not None else None
+    if writer is not None:
+        extract_mode, sedesc_folder, store = 'spool', writer.folder, None
+    else:
+        sedesc_folder = layout.get((task.collection, siUID)) if layout is not None else None
+        if sedesc_folder is None:
+            sedesc_folder = make_series_folder(data_path, task.patient, task.study_uid, siUID, task.description)
+    if store is not None:
+        stored = await loop.run_in_executor(executor, store.link_series, task, sedesc_folder)
+        if stored is not None:
+            await loop.run_in_executor(executor, record_series, manifest, task, *stored, None, sedesc_folder, catalog)
+            return
+    fp, has_slot = None, False
+    queued = default_timer()
+    try:
+        async with semaphore:
+            metrics.observe('queue_wait_seconds', default_timer() - queued)
+            if extract_mode == 'spool':
+                fp = SpooledTemporaryFile(max_size=config.SPOOL_MAX_SIZE, dir=config.SPOOL_DIR)
+            else:
+                zip_path = os.path.join(sedesc_folder, f'uid{siUID[-9:]}.zip')
+                fp = open(zip_path, 'wb')
+            t1 = default_timer()
+            try:
+                download = await _download(session, siUID, fp)
+            except (aiohttp.ClientError, asyncio.TimeoutError, IOError):
+                log.error(f'request failed for series {siUID}', exc_info=True)
+                return
+            # the request slot is held until the zip may wait for the extraction, such that
+            # no more than `extract_queue` downloaded zips are held at once
+            await extract_slots.acquire()
+            has_slot = True
+        log_download_rate(siUID, download.n_bytes, default_timer() - t1)
+        # the semaphore is released, so the next download starts while this one is extracted
+        if writer is not None and download.error:
+            extracted = ExtractResult(0, 0)
+        elif writer is not None:
+            extracted = await loop.run_in_executor(executor, writer.write_series, task, fp)
+        elif extract_mode == 'spool':
+            extracted = await loop.run_in_executor(executor, extract_zip, fp, sedesc_folder, siUID)
+        else:
+            fp.close()
+            extracted = await loop.run_in_executor(executor, extract_zip_file, zip_path, sedesc_folder, siUID)
+    finally:
+        if fp is not None:
+            fp.close()
+        if has_slot:
+            extract_slots.release()
+    # the store moves the files and the catalog reads them, so they run in the executor as well
+    await loop.run_in_executor(executor, record_series, manifest, task, download, extracted, store, sedesc_folder, catalog)
+
+
+async def _fetch_all(
+                tasks: Iterable[SeriesTask],
+                targets: Targets,
+                max_in_flight: int,
+                extract_workers: int,
+                extract_queue: int,
+                keep_alive: bool,
+                extract_mode: str,
+                store: Optional[DicomStore],
+                layout: Optional[Mapping[Tuple[str, str], os.PathLike]],
+                shards: Optional[Mapping[str, TarShardWriter]],
+                catalogs: Optional[Mapping[str, Catalog]]
+                ) -> NoReturn:
+    """Run every task on the event loop with at most `max_in_flight` requests at once and
+    at most `extract_queue` downloaded zips waiting for or in the extraction.
+    """
+    semaphore = asyncio.Semaphore(max_in_flight)
+    extract_slots = asyncio.Semaphore(max(extract_queue, extract_workers))
+    connector = aiohttp.TCPConnector(limit=max_in_flight, force_close=not keep_alive)
+    headers = {'User-Agent': config.USER_AGENT}
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=config.ASYNC_READ_TIMEOUT)
+    with cf.ThreadPoolExecutor(
+                        max_workers=extract_workers,
+                        thread_name_prefix='tcia_extract'
+                        ) as executor:
+        async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
+            await asyncio.gather(*(
+                _fetch_series(session, semaphore, extract_slots, executor, task, targets, extract_mode, store, layout, shards, catalogs)
+                for task in tasks
+                ))
+
+
+def fetch_instances_async(
+                tasks: Iterable[SeriesTask],
+                targets: Targets,
+                max_in_flight: int = config.MAX_IN_FLIGHT,
+                extract_workers: int = config.WORKERS,
+                extract_queue: int = config.EXTRACT_QUEUE_SIZE,
+                keep_alive: bool = config.KEEP_ALIVE,
+                extract_mode: str = config.EXTRACT_MODE,
+                store: Optional[DicomStore] = None,
+                layout: Optional[Mapping[Tuple[str, str], os.PathLike]] = None,
+                shards: Optional[Mapping[str, TarShardWriter]] = None,
+                catalogs: Optional[Mapping[str, Catalog]] = None
+                ) -> NoReturn:
+    """Download and extract all the series with the asyncio engine.
+    Parameters
+    ----------
+    tasks : Iterable[SeriesTask]
+        The series to fetch, the semaphore is acquired in this order.
+    targets : Targets
+        The data path and the manifest, if any, for every collection in `tasks`.
+    max_in_flight : int
+        The global cap on concurrent getImage requests.
+    extract_workers : int
+        The number of threads the zip extraction is handed to.
+    extract_queue : int
+        How many downloaded zips may wait for or be in the extraction, a finished download
+        holds its request slot until there is room.
+    keep_alive : bool
+        Set `keep_alive` to false to close the connection after every request.
+    extract_mode : str
+        Either `spool` to unpack from a spooled temp buffer or `disk` to write the zip first.
+    store : DicomStore
+        If given, the series in the `store` are linked and the downloaded ones are added to it.
+    layout : Mapping[Tuple[str, str], os.PathLike]
+        The sedesc folders by collection and SeriesInstanceUID that were created up front.
+    shards : Mapping[str, TarShardWriter]
+        If given, the series are written to the tar shards of their collection instead of the tree.
+    catalogs : Mapping[str, Catalog]
+        If given, the headers of the verified series are read into the catalog of their collection.
+    Returns
+    -------
+    NoReturn
+    """
+    if aiohttp is None:
+        raise ImportError('the async engine needs aiohttp, install it with `poetry install -E async`')
+    asyncio.run(_fetch_all(tasks, targets, max_in_flight, extract_workers, extract_queue, keep_alive, extract_mode, store, layout, shards, catalogs))
@@ -0,0 +1,160 @@
+"""
+This script contains the bandwidth shaping for the TAr api requester. Every chunk of a
+getImage download takes its size from a global byte bucket, such that all the workers
+together stay below a budget in bytes/sec and the uplink is left to the other traffic on the
+node. The budget can be changed while the run is going through a control file, which is
+read again when it changes or when the process gets a SIGHUP.
+"""
+# externals
+import os
+import signal
+import threading
+from time import sleep, monotonic
+from typing import NoReturn, Optional
+# internals
+from config import config
+from config.logger import log
+from src.metrics import metrics
+
+
+class BandwidthLimiter:
+    """A thread-safe byte bucket, a rate of 0 lets everything through.
+    Attributes
+    ----------
+    rate : float
+        The budget in bytes per second.
+    """
+    def __init__(self, rate: float):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float) -> NoReturn:
+        """Change the budget, the bucket holds at most `BANDWIDTH_BURST_SECONDS` of it.
+        """
+        with self._lock:
+            self.rate = max(0.0, rate)
+            self.burst = self.rate * config.BANDWIDTH_BURST_SECONDS
+            self._tokens = min(self._tokens, self.burst)
+
+    def reserve(self, n_bytes: int) -> float:
+        """Take `n_bytes` from the bucket and return how many seconds the caller has to wait.
+        Tokens can go negative, that way the waiting callers are served in order.
+        """
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n_bytes
+            return max(0.0, -self._tokens / self.rate)
+
+    def consume(self, n_bytes: int) -> NoReturn:
+        """Block until `n_bytes` fit in the budget.
+        """
+        wait = self.reserve(n_bytes)
+        if wait > 0:
+            metrics.observe('bandwidth_wait_seconds', wait)
+            sleep(wait)
+
+
+def read_control_file(path: os.PathLike) -> Optional[float]:
+    """Read the budget in MB/s from the control file, None if it is missing or not a number.
+    """
+    try:
+        with open(path, 'r') as fp:
+            return float(fp.read().strip() or 0)
+    except (OSError, ValueError):
+        log.warning(f'could not read a bandwidth limit from {path}, keeping the current one')
+        return None
+
+
+class BandwidthControl(threading.Thread):
+    """Watches the control file and hands a new budget to the limiter, the file is read
+    when its mtime changes, checked every `interval` seconds, or right away on a SIGHUP.
+    Attributes
+    ----------
+    limiter : BandwidthLimiter
+        The limiter to adjust.
+    path : os.PathLike
+        The control file holding the budget in MB/s, 0 for no limit.
+    interval : float
+        Seconds between the checks of the file.
+    """
+    def __init__(self, limiter: BandwidthLimiter, path: os.PathLike, interval: float):
+        super().__init__(name='tcia_bandwidth', daemon=True)
+        self.limiter = limiter
+        self.path = path
+        self.interval = interval
+        self._mtime = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def reload(self) -> NoReturn:
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        limit = read_control_file(self.path)
+        if limit is not None and limit * config.MEGABYTE != self.limiter.rate:
+            self.limiter.set_rate(limit * config.MEGABYTE)
+            log.info(f'bandwidth limit set to {limit:g} MB/s' if limit > 0 else 'bandwidth limit switched off')
+
+    def _on_signal(self, signum: int, frame) -> NoReturn:
+        # force a read even if the mtime did not change, e.g. on a coarse mtime filesystem
+        self._mtime = None
+        self._wake.set()
+
+    def start(self) -> NoReturn:
+        self.reload()
+        # signal handlers can only be set from the main thread
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, self._on_signal)
+        super().start()
+
+    def run(self) -> NoReturn:
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.reload()
+
+    def stop(self) -> NoReturn:
+        self._stopped.set()
+        self._wake.set()
+        self.join()
+
+
+_limiter: Optional[BandwidthLimiter] = None
+
+
+def configure_bandwidth(limit: float, control_file: str = '') -> Optional[BandwidthControl]:
+    """Set the budget for all the downloads.
+    Parameters
+    ----------
+    limit : float
+        The budget in MB/s, 0 for no limit.
+    control_file : str
+        If given, the budget is read from this file while the run is going.
+    Returns
+    -------
+    Optional[BandwidthControl]
+        The started watcher of the `control_file`, to be stopped at the end of the run.
+    """
+    global _limiter
+    _limiter = BandwidthLimiter(limit * config.MEGABYTE) if limit > 0 or control_file else None
+    if not control_file:
+        return None
+    control = BandwidthControl(_limiter, control_file, interval=config.BANDWIDTH_POLL_SECONDS)
+    control.start()
+    return control
+
+
+def get_limiter() -> Optional[BandwidthLimiter]:
+    """Return the shared limiter, None if the bandwidth is not shaped.
+    """
+    return _limiter
@@ -0,0 +1,117 @@
+"""
+This script contains the local metadata cache for the TAr api requester. The json responses
+from getPatient and getSeries are stored per collection and patient, such that a new run does
+not have to crawl the whole collection again. Entries expire after a TTL and the oldest are
+evicted once the cache holds more than a maximum number of entries.
+"""
+# externals
+import os
+import json
+import threading
+from time import time
+from collections import OrderedDict
+from urllib.parse import quote
+from typing import Any, NoReturn, Optional
+# internals
+from config.logger import log
+
+PATIENTS_KEY = '_patients'
+
+
+class MetadataCache:
+    """A json file cache on disk with TTL expiry and size-bounded eviction.
+    Attributes
+    ----------
+    root : os.PathLike
+        The folder where the cache is stored, one sub folder per collection.
+    ttl : float
+        The time to live of an entry in seconds.
+    max_entries : int
+        The maximum number of entries to keep, the oldest are evicted first.
+    """
+    def __init__(self, root: os.PathLike, ttl: float, max_entries: int):
+        self.root = root
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # path -> mtime, ordered from oldest to newest
+        self._index: 'OrderedDict[str, float]' = OrderedDict()
+        self._load_index()
+
+    def _load_index(self) -> NoReturn:
+        if not os.path.isdir(self.root):
+            return
+        entries = []
+        for folder, _, files in os.walk(self.root):
+            for item in files:
+                if item.endswith('.json'):
+                    path = os.path.join(folder, item)
+                    entries.append((os.path.getmtime(path), path))
+        for mtime, path in sorted(entries):
+            self._index[path] = mtime
+
+    def _path(self, collection: str, key: str) -> os.PathLike:
+        return os.path.join(self.root, quote(collection.lower(), safe=''), f"{quote(key, safe='')}.json")
+
+    def _drop(self, path: os.PathLike) -> NoReturn:
+        self._index.pop(path, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get(self, collection: str, key: str, allow_stale: bool = False) -> Optional[Any]:
+        """Return the cached response, None if it is missing or expired.
+        Parameters
+        ----------
+        collection : str
+            The collection the response belongs to.
+        key : str
+            The PatientID, or `PATIENTS_KEY` for the patient list.
+        allow_stale : bool
+            Set `allow_stale` to true to return expired entries as well, used in offline mode.
+        Returns
+        -------
+        Any
+            The json response.
+        """
+        path = self._path(collection, key)
+        with self._lock:
+            mtime = self._index.get(path)
+            if mtime is None:
+                return None
+            if not allow_stale and time() - mtime > self.ttl:
+                self._drop(path)
+                return None
+        try:
+            with open(path, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            log.warning(f'dropping unreadable cache entry {path}')
+            with self._lock:
+                self._drop(path)
+            return None
+
+    def put(self, collection: str, key: str, data: Any) -> NoReturn:
+        """Store a response and evict the oldest entries if the cache is full.
+        Parameters
+        ----------
+        collection : str
+            The collection the response belongs to.
+        key : str
+            The PatientID, or `PATIENTS_KEY` for the patient list.
+        data : Any
+            The json response.
+        """
+        path = self._path(collection, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file first, such that a reader never sees half an entry
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._index.pop(path, None)
+            self._index[path] = time()
+            while len(self._index) > self.max_entries:
+                self._drop(next(iter(self._index)))
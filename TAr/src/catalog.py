@@ -0,0 +1,273 @@
+"""
+This script contains the metadata catalog of the TAr api requester. Every verified series is
+written to a SQLite database in the dataset folder while the run is going, one row per series
+with its getSeries metadata and one row per instance with the key header fields and where
+the file is on disk, or in which tar shard at which offset. The headers are read with pydicom
+up to the pixel data only, such that downstream jobs can query a collection without walking
+and parsing the tree again.
+"""
+# externals
+import io
+import os
+import sqlite3
+import threading
+from time import time
+from typing import Any, Dict, IO, Iterator, List, NoReturn, Optional, Tuple, Union
+# internals
+from config import config
+from config.logger import log
+from src.scheduler import SeriesTask
+from src.metrics import metrics
+from src.integrity import DownloadResult, ExtractResult
+
+# the tag of the pixel data as it is written in little endian, the header ends before it
+PIXEL_DATA_TAG = b'\xe0\x7f\x10\x00'
+
+SERIES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    SeriesInstanceUID TEXT PRIMARY KEY,
+    collection TEXT,
+    PatientID TEXT,
+    StudyInstanceUID TEXT,
+    Modality TEXT,
+    SeriesDescription TEXT,
+    ImageCount INTEGER,
+    FileSize INTEGER,
+    updated TEXT,
+    path TEXT,
+    shard TEXT,
+    files INTEGER,
+    bytes INTEGER,
+    digest TEXT,
+    cataloged REAL
+    )
+"""
+INSTANCE_COLUMNS = ['SeriesInstanceUID', 'name', 'path', 'shard', 'data_offset', 'size'] + config.CATALOG_HEADER_FIELDS
+INSTANCE_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS instances (
+    SeriesInstanceUID TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT,
+    shard TEXT,
+    data_offset INTEGER,
+    size INTEGER,
+    {', '.join(f'{field} TEXT' for field in config.CATALOG_HEADER_FIELDS)},
+    PRIMARY KEY (SeriesInstanceUID, name)
+    )
+"""
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS series_patient ON series (PatientID)',
+    'CREATE INDEX IF NOT EXISTS series_modality ON series (Modality)',
+    'CREATE INDEX IF NOT EXISTS instances_sop ON instances (SOPInstanceUID)',
+    ]
+
+_pydicom = None
+
+
+def _load_pydicom() -> Any:
+    """Import pydicom on first use, it is an optional dependency and slow to import."""
+    global _pydicom
+    if _pydicom is None:
+        try:
+            import pydicom
+        except ImportError:
+            raise ImportError('the catalog needs pydicom, install it with `poetry install -E catalog`')
+        _pydicom = pydicom
+    return _pydicom
+
+
+def _to_text(value: Any) -> Optional[str]:
+    """Keep a header value as text, the values of a multi-valued element are joined by a
+    backslash like in the dicom encoding."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (list, tuple)) or type(value).__name__ == 'MultiValue':
+        return '\\'.join(str(item) for item in value)
+    return str(value)
+
+
+def read_header(source: Union[os.PathLike, IO[bytes]]) -> Dict[str, Optional[str]]:
+    """Read the `CATALOG_HEADER_FIELDS` of a dicom file, the pixel data is not read.
+    Parameters
+    ----------
+    source : Union[os.PathLike, IO[bytes]]
+        The path to the dicom file or a file object holding it.
+    Returns
+    -------
+    Dict[str, Optional[str]]
+        The header fields as text, None for a field the file does not have.
+    """
+    pydicom = _load_pydicom()
+    dataset = pydicom.dcmread(
+                        source,
+                        stop_before_pixels=True,
+                        specific_tags=[field for field in config.CATALOG_HEADER_FIELDS if field != 'TransferSyntaxUID']
+                        )
+    header = {field: _to_text(dataset.get(field)) for field in config.CATALOG_HEADER_FIELDS}
+    header['TransferSyntaxUID'] = _to_text(getattr(dataset.file_meta, 'TransferSyntaxUID', None))
+    return header
+
+
+def _try_read_header(source: Union[os.PathLike, IO[bytes]]) -> Dict[str, Optional[str]]:
+    """Read the header fields, an empty dict if the file is not a readable dicom file."""
+    try:
+        return read_header(source)
+    except Exception:
+        # e.g. a license file in the zip, the file is listed without header fields
+        return {}
+
+
+def has_header(head: bytes, size: int) -> bool:
+    """Check if the start of an image holds its whole header, the element of the pixel data
+    (tag, VR and 4 byte length) is in it or the image is complete."""
+    position = head.find(PIXEL_DATA_TAG)
+    return len(head) >= size or 0 <= position <= len(head) - 12
+
+
+def read_head(head: bytes, size: int) -> Optional[Dict[str, Optional[str]]]:
+    """Read the header fields from the start of an image of `size` bytes, None if the
+    header does not fit in the `head`."""
+    if not has_header(head, size):
+        return None
+    return _try_read_header(io.BytesIO(head))
+
+
+class HeadReader:
+    """Wraps a file object and keeps its first `limit` bytes while it is read, such that the
+    header of an image can be parsed after it was copied without reading it again.
+    """
+    def __init__(self, fileobj: IO[bytes], limit: int = config.CATALOG_HEADER_BYTES):
+        self.fileobj = fileobj
+        self.limit = limit
+        self.head = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        if len(self.head) < self.limit:
+            self.head += data[:self.limit - len(self.head)]
+        return data
+
+
+def _read_member(fp: IO[bytes], offset: int, size: int) -> IO[bytes]:
+    """Read the header of an image in a tar shard, the first `CATALOG_HEADER_BYTES` are
+    enough unless the pixel data starts after them."""
+    fp.seek(offset)
+    data = fp.read(min(size, config.CATALOG_HEADER_BYTES))
+    if not has_header(data, size):
+        data += fp.read(size - len(data))
+    return io.BytesIO(data)
+
+
+class Catalog:
+    """The SQLite catalog of a collection. The rows of a series are replaced in a single
+    transaction under a lock, such that the workers can add series concurrently.
+    Attributes
+    ----------
+    path : os.PathLike
+        The database file.
+    collection : str
+        The collection the series belong to.
+    """
+    def __init__(self, path: os.PathLike, collection: str):
+        # fail before the downloads if pydicom is missing
+        _load_pydicom()
+        self.path = path
+        self.collection = collection
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            for statement in [SERIES_SCHEMA, INSTANCE_SCHEMA] + INDEXES:
+                self._db.execute(statement)
+
+    def _tree_instances(self, folder: os.PathLike) -> Iterator[Tuple[List[Any], Dict[str, Optional[str]]]]:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.endswith('.zip'):
+                    continue
+                yield [entry.name, entry.path, None, None, entry.stat().st_size], _try_read_header(entry.path)
+
+    def _shard_instances(self, folder: os.PathLike, extracted: ExtractResult) -> Iterator[Tuple[List[Any], Dict[str, Optional[str]]]]:
+        shard_path = os.path.join(folder, extracted.shard)
+        headers = extracted.headers or {}
+        fp = None
+        try:
+            for name, (offset, size) in extracted.members.items():
+                header = headers.get(name)
+                if header is None:
+                    # the header was not parsed while the image was copied, the shard is read
+                    fp = fp or open(shard_path, 'rb')
+                    header = _try_read_header(_read_member(fp, offset, size))
+                yield [name, shard_path, extracted.shard, offset, size], header
+        finally:
+            if fp is not None:
+                fp.close()
+
+    def read_instances(self, task: SeriesTask, folder: os.PathLike, extracted: ExtractResult) -> List[List[Any]]:
+        """Read the headers of the images of a series.
+        Parameters
+        ----------
+        task : SeriesTask
+            The series the images belong to.
+        folder : os.PathLike
+            The sedesc folder of the series, or the shard folder if it went to a tar shard.
+        extracted : ExtractResult
+            The result of the extraction, it holds the shard, the offsets and the headers
+            parsed while the images were copied in tar mode.
+        Returns
+        -------
+        List[List[Any]]
+            The instance rows in the order of `INSTANCE_COLUMNS`.
+        """
+        rows, n_unreadable = [], 0
+        instances = self._shard_instances(folder, extracted) if extracted.shard else self._tree_instances(folder)
+        for location, header in instances:
+            n_unreadable += not header
+            rows.append([task.series_uid] + location + [header.get(field) for field in config.CATALOG_HEADER_FIELDS])
+        if n_unreadable:
+            log.warning(f'{n_unreadable} files of series {task.series_uid} have no readable dicom header')
+        return rows
+
+    def add_series(
+            self,
+            task: SeriesTask,
+            download: DownloadResult,
+            extracted: ExtractResult,
+            folder: os.PathLike
+            ) -> NoReturn:
+        """Read the headers of a verified series and replace its rows in the catalog.
+        Parameters
+        ----------
+        task : SeriesTask
+            The series that was verified.
+        download : DownloadResult
+            The zip the series came in, its digest is kept.
+        extracted : ExtractResult
+            The number of images and bytes, and the shard and offsets in tar mode.
+        folder : os.PathLike
+            The sedesc folder of the series, or the shard folder if it went to a tar shard.
+        Returns
+        -------
+        NoReturn
+        """
+        with metrics.timed('catalog_seconds'):
+            # the headers are read outside of the lock, only the writes are serialized
+            rows = self.read_instances(task, folder, extracted)
+            series = [
+                task.series_uid, self.collection, task.patient, task.study_uid, task.modality,
+                task.description, task.image_count, task.file_size, task.updated,
+                os.fspath(folder), extracted.shard, extracted.n_files, extracted.n_bytes, download.digest, time()
+                ]
+            with self._lock, self._db:
+                self._db.execute('DELETE FROM instances WHERE SeriesInstanceUID = ?', (task.series_uid,))
+                self._db.execute(f'INSERT OR REPLACE INTO series VALUES ({", ".join("?" * len(series))})', series)
+                self._db.executemany(
+                            f'INSERT INTO instances ({", ".join(INSTANCE_COLUMNS)}) '
+                            f'VALUES ({", ".join("?" * len(INSTANCE_COLUMNS))})',
+                            rows
+                            )
+
+    def close(self) -> NoReturn:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,94 @@
+"""
+This script contains the public library API of the TAr api requester. The `TciaClient`
+streams the patients and series of a collection as compact records and downloads single
+series, without the CLI or the request controller:
+
+    from src.client import TciaClient
+    client = TciaClient(workers=8)
+    for record in client.iter_series('Brain-Tumor-Progression'):
+        if record.modality == 'MR':
+            client.download_series(record, 'data/raw/btp')
+"""
+# externals
+import os
+from typing import Iterable, Iterator, NoReturn, Optional
+# internals
+from config import config
+from src.cache import MetadataCache
+from src.manifest import Manifest
+from src.records import SeriesRecord
+from src.filters import SeriesFilter
+from src.tcia_api import get_patient_list, iter_patient_series, download_series as _download_series
+
+
+class TciaClient:
+    """A client for the NBIA endpoints of the cancer imaging archive. The requests go through
+    the shared session, the retries and the rate limit of the requester.
+    Attributes
+    ----------
+    workers : int
+        The number of patients to request the series information for concurrently.
+    cache : MetadataCache
+        The metadata cache for the getPatient and getSeries responses, if any.
+    offline : bool
+        Set `offline` to true to only read the metadata from the `cache`.
+    extract_mode : str
+        Either `spool` or `disk`, see `download_series`.
+    """
+    def __init__(
+            self,
+            workers: int = config.METADATA_WORKERS,
+            cache: Optional[MetadataCache] = None,
+            offline: bool = False,
+            extract_mode: str = config.EXTRACT_MODE
+            ):
+        self.workers = workers
+        self.cache = cache
+        self.offline = offline
+        self.extract_mode = extract_mode
+
+    def iter_patients(self, collection: str) -> Iterator[str]:
+        """Yield the PatientIDs of a collection.
+        """
+        for patient in get_patient_list(collection, cache=self.cache, offline=self.offline) or []:
+            yield patient.get('PatientId')
+
+    def iter_series(
+                self,
+                collection: str,
+                patients: Optional[Iterable[str]] = None,
+                series_filter: Optional[SeriesFilter] = None
+                ) -> Iterator[SeriesRecord]:
+        """Yield the series of a collection as they arrive, patient by patient.
+        Parameters
+        ----------
+        collection : str
+            The name of the collection.
+        patients : Iterable[str]
+            Only request the series of these PatientIDs, all the patients if None.
+        series_filter : SeriesFilter
+            Only yield the series that pass the filter, its patient list is used if no
+            `patients` are given.
+        Returns
+        -------
+        Iterator[SeriesRecord]
+            One record per series, in the patient order.
+        """
+        if patients is None and series_filter is not None and series_filter.patients:
+            patients = series_filter.patients
+        patients = self.iter_patients(collection) if patients is None else patients
+        query = series_filter.query() if series_filter is not None else None
+        series_lists = iter_patient_series(collection, patients, self.workers, self.cache, self.offline, query)
+        records = (SeriesRecord.from_json(entry) for _, series in series_lists for entry in series)
+        return records if series_filter is None else series_filter.apply(records)
+
+    def download_series(
+                    self,
+                    record: SeriesRecord,
+                    data_path: os.PathLike,
+                    manifest: Optional[Manifest] = None
+                    ) -> NoReturn:
+        """Download a series and extract its dicom files into the patient/study/series
+        folders under `data_path`, the series is recorded in the `manifest` if one is given.
+        """
+        _download_series(record.to_task(), data_path, manifest=manifest, extract_mode=self.extract_mode)
@@ -0,0 +1,175 @@
+"""
+This script contains the extraction stage of the TAr api requester. The series zips are
+either extracted on the download thread, or handed to an `ExtractionPool`: a process pool
+fed through a bounded queue, such that the decompression scales over all the cores while
+the download threads keep streaming.
+"""
+# externals
+import io
+import os
+import shutil
+import threading
+import zlib
+import multiprocessing
+import concurrent.futures as cf
+from timeit import default_timer
+from zipfile import ZipFile, BadZipFile, LargeZipFile
+from typing import Callable, IO, NoReturn, Tuple, Union
+# internals
+from config import config
+from config.logger import log
+from src.metrics import metrics
+from src.integrity import ExtractResult
+
+# the read size for copying a member out of the zip
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _is_flat(filename: str) -> bool:
+    """Check that a member name is a plain file name, anything else goes through the path
+    sanitizing of `ZipFile.extract`.
+    """
+    return filename not in ('', '.', '..') and '/' not in filename and '\\' not in filename
+
+
+def _create(path: os.PathLike) -> IO[bytes]:
+    """Open a new file for writing. A file that is already there is unlinked instead of
+    truncated, it may be a hardlink or a symlink into the store, whose object is shared.
+    """
+    try:
+        return open(path, 'xb')
+    except FileExistsError:
+        os.unlink(path)
+        return open(path, 'xb')
+
+
+def extract_zip(zip_source: Union[os.PathLike, IO[bytes]], folder: os.PathLike, name: str) -> ExtractResult:
+    """Extract a zip file into a folder. The CRC of every member is checked while it is
+    extracted, a mismatch fails the extraction.
+    Parameters
+    ----------
+    zip_source : Union[os.PathLike, IO[bytes]]
+        The path to the zip file or a seekable file object holding it.
+    folder : os.PathLike
+        The folder to extract the members to.
+    name : str
+        The `name` used in the log if the extraction fails.
+    Returns
+    -------
+    ExtractResult
+        The number of files and bytes extracted, zero files and the error if it failed.
+    """
+    try:
+        with metrics.timed('extract_seconds'), ZipFile(zip_source) as zf:
+            members = [member for member in zf.infolist() if not member.is_dir()]
+            for member in members:
+                if _is_flat(member.filename):
+                    # NBIA zips are flat, the target folder exists, so no per file folder check
+                    with zf.open(member) as src, _create(os.path.join(folder, member.filename)) as dst:
+                        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+                else:
+                    zf.extract(member, folder)
+    except (BadZipFile, LargeZipFile, ValueError, EOFError, zlib.error) as error:
+        log.error(f'zipefile extraction failed for {name}: {error}')
+        return ExtractResult(0, 0, f'the zip is broken: {error}')
+    return ExtractResult(len(members), sum(member.file_size for member in members))
+
+
+def extract_zip_file(zip_path: os.PathLike, folder: os.PathLike, name: str) -> ExtractResult:
+    """Extract a zip file on disk into a folder and remove it, a broken zip is removed too
+    such that the series is downloaded again.
+    """
+    result = extract_zip(zip_path, folder, name=name)
+    with metrics.timed('fs_seconds'):
+        os.remove(zip_path)
+    return result
+
+
+def _extract_job(payload: Union[bytes, str], folder: os.PathLike, name: str) -> Tuple[ExtractResult, float]:
+    """Runs in the extraction process. The `payload` is either the zip held in memory or the
+    path to a zip on disk, which is removed once it is extracted.
+    """
+    t1 = default_timer()
+    if isinstance(payload, bytes):
+        result = extract_zip(io.BytesIO(payload), folder, name)
+    else:
+        result = extract_zip_file(payload, folder, name)
+    return result, default_timer() - t1
+
+
+class ExtractionPool:
+    """A process pool for the zip extraction, connected to the download threads by a bounded
+    queue. When `queue_size` zips are waiting or being recorded, `submit` blocks the download
+    thread until one is done, which keeps the memory held by the waiting zips bounded. The
+    results are handed to `workers` threads that verify and record them, such that the pool
+    collects the next results while a series is recorded.
+    Attributes
+    ----------
+    workers : int
+        The number of extraction processes.
+    queue_size : int
+        The number of zips that may wait for or be in extraction at once.
+    """
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = max(queue_size, workers)
+        self._executor = cf.ProcessPoolExecutor(
+                                        max_workers=workers,
+                                        mp_context=multiprocessing.get_context(config.EXTRACT_START_METHOD)
+                                        )
+        self._recorder = cf.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tcia_record')
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._futures = set()
+        self._lock = threading.Lock()
+        self.n_failed = 0
+
+    def submit(
+            self,
+            payload: Union[bytes, str],
+            folder: os.PathLike,
+            name: str,
+            on_done: Callable[[ExtractResult], NoReturn]
+            ) -> NoReturn:
+        """Queue a zip for extraction.
+        Parameters
+        ----------
+        payload : Union[bytes, str]
+            The zip in memory or the path to it on disk.
+        folder : os.PathLike
+            The folder to extract the members to.
+        name : str
+            The `name` used in the log if the extraction fails.
+        on_done : Callable[[ExtractResult], NoReturn]
+            Called with the result of the extraction once the job is done.
+        """
+        self._slots.acquire()
+        future = self._executor.submit(_extract_job, payload, folder, name)
+        with self._lock:
+            self._futures.add(future)
+
+        def _record(future: cf.Future) -> NoReturn:
+            try:
+                result, elapsed = future.result()
+                metrics.observe('extract_seconds', elapsed)
+                on_done(result)
+            except Exception:
+                with self._lock:
+                    self.n_failed += 1
+                log.error(f'extraction failed for series {name}', exc_info=True)
+            finally:
+                self._slots.release()
+
+        def _done(future: cf.Future) -> NoReturn:
+            # runs on the management thread of the pool, which only hands the result on
+            with self._lock:
+                self._futures.discard(future)
+            self._recorder.submit(_record, future)
+
+        future.add_done_callback(_done)
+
+    def shutdown(self) -> NoReturn:
+        """Wait for the queued zips to be extracted and recorded, and stop the processes.
+        """
+        # the management thread has handed every result on once the processes are stopped
+        self._executor.shutdown(wait=True)
+        self._recorder.shutdown(wait=True)
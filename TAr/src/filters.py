@@ -0,0 +1,167 @@
+"""
+This script contains the series selection for the TAr api requester. The filters are applied
+as early as possible: the patient list limits the getSeries requests, a single modality is
+sent to NBIA as a getSeries parameter, and the rest (description, series per patient and
+size caps) is applied to the metadata, such that no getImage request is sent for a series
+that would be thrown away.
+"""
+# externals
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Pattern
+# internals
+from config import config
+from config.logger import log
+from src.records import SeriesRecord
+from src.scheduler import SeriesTask
+
+
+def split_list(value: str) -> List[str]:
+    """Split a comma separated argument, a path to a file is read with one value per line
+    and lines starting with # skipped.
+    """
+    if not value:
+        return []
+    if os.path.isfile(value):
+        with open(value, 'r') as fp:
+            return [line.strip() for line in fp if line.strip() and not line.startswith('#')]
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+@dataclass
+class SeriesFilter:
+    """The series to keep from a collection, an empty field does not filter.
+    Attributes
+    ----------
+    modalities : List[str]
+        Keep the series of these modalities, e.g. MR or CT.
+    description : Pattern
+        Keep the series whose SeriesDescription matches this regex.
+    patients : List[str]
+        Only request the series of these PatientIDs.
+    max_per_patient : int
+        Keep at most this many series per patient, in the getSeries order.
+    max_series_bytes : int
+        Skip the series whose FileSize is above this.
+    """
+    modalities: List[str]
+    description: Optional[Pattern]
+    patients: List[str]
+    max_per_patient: int = 0
+    max_series_bytes: int = 0
+
+    @classmethod
+    def from_args(
+            cls,
+            modality: str = config.MODALITY,
+            series_description: str = config.SERIES_DESCRIPTION,
+            patients: str = config.PATIENTS,
+            max_series_per_patient: int = config.MAX_SERIES_PER_PATIENT,
+            max_series_mb: float = config.MAX_SERIES_MB
+            ) -> 'SeriesFilter':
+        """Build the filter from the CLI arguments, the description regex is case insensitive.
+        """
+        return cls(
+                modalities=[m.upper() for m in split_list(modality)],
+                description=re.compile(series_description, re.IGNORECASE) if series_description else None,
+                patients=split_list(patients),
+                max_per_patient=max_series_per_patient,
+                max_series_bytes=int(max_series_mb * config.MEGABYTE)
+                )
+
+    @property
+    def active(self) -> bool:
+        return bool(
+                self.modalities or self.description or self.patients
+                or self.max_per_patient or self.max_series_bytes
+                )
+
+    def query(self) -> Dict[str, str]:
+        """The getSeries parameters NBIA filters on, it takes a single Modality only.
+        """
+        return {'Modality': self.modalities[0]} if len(self.modalities) == 1 else {}
+
+    def keep(self, record: SeriesRecord) -> bool:
+        """Check a single series against the modality, description and size filters.
+        """
+        if self.modalities and (record.modality or '').upper() not in self.modalities:
+            return False
+        if self.description is not None and not self.description.search(record.description or ''):
+            return False
+        if self.max_series_bytes and record.file_size > self.max_series_bytes:
+            return False
+        return True
+
+    def apply(self, records: Iterable[SeriesRecord]) -> Iterator[SeriesRecord]:
+        """Stream the records that pass the filter, counting the series per patient.
+        """
+        per_patient: Dict[str, int] = {}
+        for record in records:
+            if not self.keep(record):
+                continue
+            if self.max_per_patient:
+                n_kept = per_patient.get(record.patient, 0)
+                if n_kept >= self.max_per_patient:
+                    continue
+                per_patient[record.patient] = n_kept + 1
+            yield record
+
+
+@dataclass
+class PriorityClasses:
+    """The order the series are queued in, ahead of the size. The priority patients go
+    first, then the priority modalities in their given order, then the rest.
+    Attributes
+    ----------
+    patients : List[str]
+        The PatientIDs that go first.
+    modalities : List[str]
+        The modalities that go next, the first listed goes first.
+    """
+    patients: List[str]
+    modalities: List[str]
+
+    def __post_init__(self):
+        self._patients = set(self.patients)
+        self._modalities = {modality: rank for rank, modality in enumerate(self.modalities, start=1)}
+
+    @classmethod
+    def from_args(
+            cls,
+            priority_patients: str = config.PRIORITY_PATIENTS,
+            priority_modalities: str = config.PRIORITY_MODALITIES
+            ) -> 'PriorityClasses':
+        """Build the classes from the CLI arguments, comma separated or a file each.
+        """
+        return cls(
+                patients=split_list(priority_patients),
+                modalities=[m.upper() for m in split_list(priority_modalities)]
+                )
+
+    @property
+    def active(self) -> bool:
+        return bool(self.patients or self.modalities)
+
+    def __call__(self, task: SeriesTask) -> int:
+        """Return the class of a task, the lower the earlier it is queued.
+        """
+        if task.patient in self._patients:
+            return 0
+        return self._modalities.get(task.modality.upper(), len(self.modalities) + 1)
+
+
+def cap_total_size(tasks: List[SeriesTask], max_bytes: int) -> List[SeriesTask]:
+    """Keep the tasks in their given order as long as their total FileSize stays below
+    `max_bytes`, a series that does not fit is skipped and the next ones are tried.
+    """
+    if not max_bytes:
+        return tasks
+    kept, total = [], 0
+    for task in tasks:
+        if total + task.file_size > max_bytes:
+            continue
+        kept.append(task)
+        total += task.file_size
+    log.info(f'the size cap keeps {len(kept)} of {len(tasks)} series with {total / config.MEGABYTE:.1f} MB')
+    return kept
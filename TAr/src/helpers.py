@@ -1,18 +1,19 @@
-
 # externals
 import re
 import os
-import requests
-from requests.exceptions import HTTPError
 from time import time
 from timeit import default_timer
 from functools import wraps
 import argparse
 from collections import defaultdict
-from typing import NoReturn, Callable, Mapping, Dict, Any, Union, List
+from typing import NoReturn, Callable, Mapping, Dict, Any, Union, List, Optional, Tuple, IO
 # internals
 from config.logger import log
 from config import config
+from src.session import get_session
+from src.retry import call_with_retry
+from src.metrics import metrics
+from src.bandwidth import get_limiter
 
 START_TIME = default_timer()
 
@@ -88,8 +89,13 @@ def timer(orig_func: Callable) -> Callable:
     return wrapper
 
 
-def api_request(url: str, params: Dict[str, str], is_series: bool = True) -> Dict[str, Union[str, int, float]]:
-    """This is wrapper function for sending a simple request without opening a session.
+def api_request(
+            url: str,
+            params: Dict[str, str],
+            is_series: bool = True,
+            stream: bool = False
+            ) -> Dict[str, Union[str, int, float]]:
+    """This is wrapper function for sending a request over the shared, pooled session.
     Parameters
     ----------
     url : str
@@ -98,6 +104,9 @@ def api_request(url: str, params: Dict[str, str], is_series: bool = True) -> Dic
         Additoinal parameters to send with the base URL.
     is_series : bool
         If the fucntion is used for a series call, then set `is_series` True such that json is returned.
+    stream : bool
+        Set `stream` to true to defer the download of the body, it can then be consumed
+        in chunks with `iter_content` without holding the whole payload in memory.
     Returns
     -------
     resp Object
@@ -105,24 +114,87 @@ def api_request(url: str, params: Dict[str, str], is_series: bool = True) -> Dic
         depending on the whether it is from a instance call or series call respectivley.
     collection str
         The dataset name
+    Raises
+    ------
+    requests.RequestException
+        If the request still fails after all the retries.
     """
-    headers = {'User-Agent': config.USER_AGENT, 'Content-Type': 'application/json'}
-    try:
-        resp = requests.get(url, params=params, verify=True, headers=headers)
-    except HTTPError:
-        log.error(
-            f'request failed, this is the url: {resp.request.url}',
-            exc_info=True
-            )
-
-    if resp.status_code != 200:
-        log.warning(f'request came back with status code: {resp.status_code} for url: {resp.request.url}')
+    # retries with backoff on throttling and server errors, raises when they are used up
+    with metrics.timed('image_request_seconds' if stream else 'metadata_request_seconds'):
+        resp = call_with_retry(lambda: get_session().get(
+                                                    url,
+                                                    params=params,
+                                                    verify=True,
+                                                    stream=stream,
+                                                    timeout=config.REQUEST_TIMEOUT
+                                                    ))
 
     if is_series:
         return resp.json(), params.get('Collection').lower()
     else:
         return resp
-    
+
+
+def stream_to_fileobj(resp, fp: IO[bytes], chunk_size: int, hasher: Optional[Any] = None) -> Tuple[int, float]:
+    """Stream the body of a response into an open file object with a fixed size buffer.
+    The response is closed afterwards such that the connection is handed back to the pool.
+    Every chunk goes through the bandwidth limiter, if one is configured.
+    Parameters
+    ----------
+    resp : requests.Response
+        The response, it must be requested with `stream=True` to keep the memory flat.
+    fp : IO[bytes]
+        The binary file object to write the body to, e.g. a file or a spooled temp file.
+    chunk_size : int
+        The size of the buffer in bytes, this is the most that is held in memory at once.
+    hasher : hashlib hash
+        If given, every chunk is fed to the `hasher` on the way, such that the body is never read twice.
+    Returns
+    -------
+    int
+        The number of bytes written.
+    float
+        The elapsed time in seconds.
+    """
+    n_bytes = 0
+    limiter = get_limiter()
+    t1 = default_timer()
+    with resp:
+        try:
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                if limiter is not None:
+                    limiter.consume(len(chunk))
+                fp.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                n_bytes += len(chunk)
+        except IOError:
+            log.error(f'writing the response from {resp.url} failed after {n_bytes} bytes', exc_info=True)
+    return n_bytes, default_timer() - t1
+
+
+def stream_to_file(resp, filepath: os.PathLike, chunk_size: int, hasher: Optional[Any] = None) -> Tuple[int, float]:
+    """Stream the body of a response to disk with a fixed size buffer.
+    Parameters
+    ----------
+    resp : requests.Response
+        The response, it must be requested with `stream=True` to keep the memory flat.
+    filepath : os.PathLike
+        The `filepath` to write the body to.
+    chunk_size : int
+        The size of the buffer in bytes, this is the most that is held in memory at once.
+    hasher : hashlib hash
+        If given, every chunk is fed to the `hasher` on the way.
+    Returns
+    -------
+    int
+        The number of bytes written.
+    float
+        The elapsed time in seconds.
+    """
+    with open(filepath, 'wb') as fp:
+        return stream_to_fileobj(resp, fp, chunk_size, hasher)
+
 
 def get_partition_idx(full_list: List[str], thread_num: int) -> List[str]:
     """This function partitions a list into smaller sized lists which are then appended to
@@ -0,0 +1,98 @@
+"""
+This script contains the integrity checks for the TAr api requester. Nothing is read twice:
+the zip is hashed while it is streamed, the response is checked for a truncated or non-zip
+body, the CRC of every member is validated by the extraction itself, and the number of
+extracted images is compared with the ImageCount from getSeries. A series that fails any
+check is recorded as failed, such that the request controller queues it again.
+"""
+# externals
+import hashlib
+from typing import Dict, List, Mapping, NamedTuple, Optional
+# internals
+from config import config
+from src.scheduler import SeriesTask
+
+# the content types NBIA sends error pages and messages with instead of a zip
+ERROR_CONTENT_TYPES = ('text/', 'application/json', 'application/xml')
+
+
+class DownloadResult(NamedTuple):
+    """The outcome of streaming a getImage response.
+    Attributes
+    ----------
+    n_bytes : int
+        The size of the zip in bytes.
+    digest : str
+        The hex digest of the zip with the `HASH_ALGORITHM`, computed while streaming.
+    error : str
+        Why the download is broken, None if it is not.
+    """
+    n_bytes: int
+    digest: str
+    error: Optional[str] = None
+
+
+class ExtractResult(NamedTuple):
+    """The outcome of extracting a series zip.
+    Attributes
+    ----------
+    n_files : int
+        The number of files extracted.
+    n_bytes : int
+        The number of bytes extracted.
+    error : str
+        Why the extraction failed, e.g. a bad CRC, None if it did not.
+    shard : str
+        The tar shard the series was written to, None if it was extracted to the tree.
+    members : Dict[str, List[int]]
+        The offset and size of every image in the `shard`, by file name.
+    headers : Dict[str, Dict[str, Optional[str]]]
+        The catalog header fields of the images, by file name, parsed while they were copied.
+    """
+    n_files: int
+    n_bytes: int
+    error: Optional[str] = None
+    shard: Optional[str] = None
+    members: Optional[Dict[str, List[int]]] = None
+    headers: Optional[Dict[str, Dict[str, Optional[str]]]] = None
+
+
+def new_hasher() -> 'hashlib._Hash':
+    return hashlib.new(config.HASH_ALGORITHM)
+
+
+def check_response(headers: Mapping[str, str], n_bytes: int) -> Optional[str]:
+    """Check a streamed getImage response for an error page or a body cut short.
+    Parameters
+    ----------
+    headers : Mapping[str, str]
+        The response headers.
+    n_bytes : int
+        The number of bytes that were received.
+    Returns
+    -------
+    Optional[str]
+        Why the response is broken, None if it looks like a complete zip.
+    """
+    content_type = headers.get('Content-Type', '')
+    if content_type.startswith(ERROR_CONTENT_TYPES):
+        return f'the response is {content_type} instead of a zip'
+    expected = headers.get('Content-Length')
+    if expected is not None and expected.isdigit() and int(expected) != n_bytes:
+        return f'the response was truncated at {n_bytes} of {expected} bytes'
+    if n_bytes == 0:
+        return 'the response is empty'
+    return None
+
+
+def verify_series(task: SeriesTask, download: DownloadResult, extracted: ExtractResult) -> Optional[str]:
+    """Combine the checks of a series, the ImageCount from getSeries is the least number of
+    files the zip has to hold.
+    """
+    if download.error:
+        return download.error
+    if extracted.error:
+        return extracted.error
+    if task.image_count and extracted.n_files < task.image_count:
+        return f'{extracted.n_files} of {task.image_count} images were extracted'
+    return None
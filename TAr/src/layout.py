@@ -0,0 +1,177 @@
+"""
+This script contains the layout planner for the TAr api requester. The patient, study, series
+and sedesc folders of a whole work queue are computed once, the names are cleaned with
+translate tables that are built once per module, and the folders are created up front with a
+single mkdir per folder, on several threads, such that a network filesystem (NFS, Lustre)
+pays its metadata round-trips before the downloads start instead of in between them.
+"""
+# externals
+import os
+import concurrent.futures as cf
+from typing import Dict, Iterable, List, Mapping, Set, Tuple
+# internals
+from config import config
+from config.logger import log
+from src.scheduler import SeriesTask
+from src.metrics import metrics
+
+# built once, `str.translate` tables are cheap to apply but not to build
+_REMOVE_TABLE = str.maketrans('', '', ''.join(config.CHAR_TO_REMOVE))
+# the patient ids and series descriptions repeat over the series, they are cleaned once
+_patient_names: Dict[str, str] = {}
+_sedesc_names: Dict[str, str] = {}
+
+
+def patient_name(patient: str) -> str:
+    """Clean a PatientID for a folder name."""
+    name = _patient_names.get(patient)
+    if name is None:
+        name = _patient_names[patient] = patient.replace(' ', '-').lower().translate(_REMOVE_TABLE)
+    return name
+
+
+def sedesc_name(description: str) -> str:
+    """Clean a SeriesDescription for a folder name."""
+    name = _sedesc_names.get(description)
+    if name is None:
+        name = _sedesc_names[description] = description.translate(_REMOVE_TABLE).replace(' ', '-').lower()
+    return name
+
+
+def series_folders(
+                data_path: os.PathLike,
+                patient: str,
+                stUID: str,
+                siUID: str,
+                sdUID: str
+                ) -> Tuple[os.PathLike, os.PathLike, os.PathLike]:
+    """Build the patient, study and sedesc folder paths for a series without touching the disk.
+    Parameters
+    ----------
+    data_path : os.PathLike
+        The root folder of the dataset.
+    patient : str
+        The PatientID.
+    stUID : str
+        The StudyInstanceUID.
+    siUID : str
+        The SeriesInstanceUID.
+    sdUID : str
+        The SeriesDescription.
+    Returns
+    -------
+    Tuple[os.PathLike, os.PathLike, os.PathLike]
+        The patient folder, the study folder and the sedesc folder where the dicom files are placed.
+    """
+    patient_folder = os.path.join(data_path, f'patient-{patient_name(patient)}')
+    study_folder = f'{patient_folder}{os.sep}study-{stUID[-10:]}'
+    sedesc_folder = f'{study_folder}{os.sep}series-{siUID[-10:]}{os.sep}sedesc-{sedesc_name(sdUID)}'
+    return patient_folder, study_folder, sedesc_folder
+
+
+def plan_layout(
+            tasks: Iterable[SeriesTask],
+            data_paths: Mapping[str, os.PathLike]
+            ) -> Dict[Tuple[str, str], os.PathLike]:
+    """Compute the sedesc folder of every series in a work queue.
+    Parameters
+    ----------
+    tasks : Iterable[SeriesTask]
+        The work queue.
+    data_paths : Mapping[str, os.PathLike]
+        The dataset folder of every collection in `tasks`.
+    Returns
+    -------
+    Dict[Tuple[str, str], os.PathLike]
+        The sedesc folder by collection and SeriesInstanceUID, a series can be listed in
+        more than one collection.
+    """
+    return {
+        (task.collection, task.series_uid): series_folders(
+                                data_paths[task.collection],
+                                task.patient,
+                                task.study_uid,
+                                task.series_uid,
+                                task.description
+                                )[-1]
+        for task in tasks
+        }
+
+
+def _mkdir_tree(folders: List[str]) -> int:
+    """Create the folders of one subtree, parents before children, with one mkdir each.
+    Returns the number of folders created.
+    """
+    n_created = 0
+    for folder in folders:
+        try:
+            os.mkdir(folder)
+            n_created += 1
+        except FileExistsError:
+            pass
+    return n_created
+
+
+def make_folders(sedesc_folders: Iterable[os.PathLike], workers: int = config.LAYOUT_WORKERS) -> int:
+    """Create all the folders of a layout up front. Every folder between a dataset folder and
+    a sedesc folder is created with a single mkdir and no existence check, the subtrees of
+    the patients are created on `workers` threads.
+    Parameters
+    ----------
+    sedesc_folders : Iterable[os.PathLike]
+        The sedesc folders of the layout, four levels below their dataset folder.
+    workers : int
+        The number of threads the subtrees are created on.
+    Returns
+    -------
+    int
+        The number of folders that were created.
+    """
+    # patient folder -> the study, series and sedesc folders below it
+    trees: Dict[str, Set[str]] = {}
+    for sedesc_folder in sedesc_folders:
+        series_folder = os.path.dirname(sedesc_folder)
+        study_folder = os.path.dirname(series_folder)
+        trees.setdefault(os.path.dirname(study_folder), set()).update((study_folder, series_folder, sedesc_folder))
+
+    with metrics.timed('fs_seconds'):
+        for data_path in {os.path.dirname(patient_folder) for patient_folder in trees}:
+            os.makedirs(data_path, exist_ok=True)
+        n_created = _mkdir_tree(sorted(trees))
+        # a sorted subtree lists every parent before its children
+        with cf.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='tcia_layout') as executor:
+            n_created += sum(executor.map(_mkdir_tree, (sorted(tree) for tree in trees.values())))
+    log.info(f'created {n_created} folders for {len(trees)} patients up front')
+    return n_created
+
+
+def make_series_folder(
+                data_path: os.PathLike,
+                patient: str,
+                stUID: str,
+                siUID: str,
+                sdUID: str
+                ) -> os.PathLike:
+    """Build the patient/study/series/sedesc folder for a series that is not in a planned
+    layout and create it if needed.
+    Parameters
+    ----------
+    data_path : os.PathLike
+        The root folder of the dataset.
+    patient : str
+        The PatientID.
+    stUID : str
+        The StudyInstanceUID.
+    siUID : str
+        The SeriesInstanceUID.
+    sdUID : str
+        The SeriesDescription.
+    Returns
+    -------
+    os.PathLike
+        The sedesc folder where the dicom files of the series are placed.
+    """
+    sedesc_folder = series_folders(data_path, patient, stUID, siUID, sdUID)[-1]
+    with metrics.timed('fs_seconds'):
+        os.makedirs(sedesc_folder, exist_ok=True)
+    return sedesc_folder
@@ -0,0 +1,97 @@
+"""
+This script contains the on-disk manifest for the TAr api requester. Every series that is
+downloaded and extracted is appended as a json line to the manifest in the dataset folder,
+such that a restarted run can skip the finished series and only resume the missing ones.
+A series that failed the verification is recorded with the status `failed`, it does not
+count as completed and is queued again.
+"""
+# externals
+import os
+import json
+import threading
+from time import time
+from typing import Any, Dict, Iterator, NoReturn, Optional
+# internals
+from config.logger import log
+
+
+class Manifest:
+    """An append-only JSONL record of the completed series, held in a dict for O(1) lookups.
+    Attributes
+    ----------
+    path : os.PathLike
+        The `path` to the manifest file, it is created on the first record.
+    """
+    def __init__(self, path: os.PathLike):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._failed: Dict[str, Dict[str, Any]] = {}
+        self._load()
+
+    def _load(self) -> NoReturn:
+        """Read the existing manifest, a later line for the same series wins. A line that
+        was cut short by a crash is skipped.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as fp:
+            for line in fp:
+                try:
+                    self._add(json.loads(line))
+                except (ValueError, KeyError):
+                    log.warning(f'skipping a broken line in the manifest {self.path}')
+
+    def _add(self, entry: Dict[str, Any]) -> NoReturn:
+        """Keep an entry as completed or as failed, the entries written before the
+        verification existed have no status and count as completed.
+        """
+        series_uid = entry['SeriesInstanceUID']
+        if entry.get('status') == 'failed':
+            self._entries.pop(series_uid, None)
+            self._failed[series_uid] = entry
+        else:
+            self._failed.pop(series_uid, None)
+            self._entries[series_uid] = entry
+
+    def __contains__(self, series_uid: str) -> bool:
+        return series_uid in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._entries))
+
+    def get(self, series_uid: str) -> Optional[Dict[str, Any]]:
+        """Return the manifest entry for a series, None if it is not completed.
+        """
+        return self._entries.get(series_uid)
+
+    def completed_since(self, series_uid: str, since: float) -> bool:
+        """Check if a series was recorded as completed at or after the epoch time `since`,
+        an older entry does not count, e.g. from a previous run or a series that changed.
+        """
+        entry = self._entries.get(series_uid)
+        return entry is not None and entry.get('completed', 0) >= since
+
+    def failed(self) -> Dict[str, Dict[str, Any]]:
+        """Return the entries of the series whose last attempt failed the verification.
+        """
+        return dict(self._failed)
+
+    def record(self, series_uid: str, **info: Any) -> NoReturn:
+        """Mark a series as completed, or as failed with `status='failed'`, and append it to
+        the manifest file.
+        Parameters
+        ----------
+        series_uid : str
+            The SeriesInstanceUID of the completed series.
+        info : Any
+            Extra fields to store with the entry, e.g. the number of files and bytes.
+        """
+        entry = {'SeriesInstanceUID': series_uid, **info, 'completed': time()}
+        with self._lock:
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps(entry) + '\n')
+            self._add(entry)
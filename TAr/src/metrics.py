@@ -0,0 +1,239 @@
+"""
+This script contains the performance metrics for the TAr api requester. Every phase of a run
+(metadata requests, downloads, extraction, filesystem operations and queue wait) is observed
+into a histogram, and the failed series are counted. The metrics are exported in the
+Prometheus text format, e.g. for the node exporter textfile collector, and as a json summary
+at the end of the run.
+"""
+# externals
+import os
+import json
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from timeit import default_timer
+from typing import Dict, Iterator, NoReturn, Optional, Sequence, Union
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+MB_PER_SECOND_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+BYTES_BUCKETS = tuple(1024 * 1024 * mb for mb in (0.1, 1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+
+PREFIX = 'tar'
+# the phases of a run, with the help text and the buckets of their histograms
+PHASES = {
+    'metadata_request_seconds': ('Time for a getPatient or getSeries request.', SECONDS_BUCKETS),
+    'image_request_seconds': ('Time until the getImage response headers arrive.', SECONDS_BUCKETS),
+    'download_seconds': ('Time to stream the zip of a series.', SECONDS_BUCKETS),
+    'download_mb_per_second': ('Download rate of the zip of a series in MB/s.', MB_PER_SECOND_BUCKETS),
+    'download_bytes': ('Size of the zip of a series in bytes.', BYTES_BUCKETS),
+    'extract_seconds': ('Time to extract the zip of a series.', SECONDS_BUCKETS),
+    'fs_seconds': ('Time for the folder creation and file removal of a series.', SECONDS_BUCKETS),
+    'store_seconds': ('Time to move a series into the store or to link it from there.', SECONDS_BUCKETS),
+    'catalog_seconds': ('Time to read the headers of a series into the catalog.', SECONDS_BUCKETS),
+    'bandwidth_wait_seconds': ('Time a download chunk waits for the bandwidth budget.', SECONDS_BUCKETS),
+    'queue_wait_seconds': ('Time a series waits in the work queue before it is picked up.', SECONDS_BUCKETS),
+    }
+# the events of a run that are counted, with the help text of their counters
+COUNTERS = {
+    'failed_series': 'Series that failed the verification.',
+    }
+
+
+class Histogram:
+    """A thread-safe cumulative histogram like the Prometheus one.
+    Attributes
+    ----------
+    name : str
+        The metric `name` without the prefix.
+    help : str
+        The `help` text in the Prometheus export.
+    buckets : Sequence[float]
+        The upper bounds of the buckets, +Inf is added on top.
+    """
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> NoReturn:
+        with self._lock:
+            self._counts[bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+            self._max = max(self._max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by linear interpolation within the bucket, like
+        `histogram_quantile` in Prometheus.
+        """
+        with self._lock:
+            if self._count == 0:
+                return 0.0
+            rank = q * self._count
+            cumulative = 0
+            for idx, count in enumerate(self._counts):
+                if cumulative + count >= rank and count > 0:
+                    # the observed max is a tighter upper bound than the bucket edge
+                    upper = min(self.buckets[idx], self._max) if idx < len(self.buckets) else self._max
+                    lower = min(self.buckets[idx - 1], upper) if idx > 0 else 0.0
+                    return lower + (upper - lower) * (rank - cumulative) / count
+                cumulative += count
+            return self._max
+
+    def to_prometheus(self) -> str:
+        name = f'{PREFIX}_{self.name}'
+        lines = [f'# HELP {name} {self.help}', f'# TYPE {name} histogram']
+        with self._lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets, self._counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {self._count}')
+            lines.append(f'{name}_sum {self._sum}')
+            lines.append(f'{name}_count {self._count}')
+        return '\n'.join(lines)
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            count, total, maximum = self._count, self._sum, self._max
+        return {
+            'count': count,
+            'sum': round(total, 6),
+            'mean': round(total / count, 6) if count else 0.0,
+            'p50': round(self.quantile(0.5), 6),
+            'p95': round(self.quantile(0.95), 6),
+            'max': round(maximum, 6)
+            }
+
+
+class Counter:
+    """A thread-safe counter like the Prometheus one, it is exported as `<name>_total`.
+    Attributes
+    ----------
+    name : str
+        The metric `name` without the prefix and the `_total` suffix.
+    help : str
+        The `help` text in the Prometheus export.
+    """
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1) -> NoReturn:
+        with self._lock:
+            self._value += value
+
+    @property
+    def value(self) -> float:
+        with self._lock:
+            return self._value
+
+    def to_prometheus(self) -> str:
+        name = f'{PREFIX}_{self.name}_total'
+        return '\n'.join([f'# HELP {name} {self.help}', f'# TYPE {name} counter', f'{name} {self.value:g}'])
+
+    def summary(self) -> Dict[str, float]:
+        return {'total': self.value}
+
+
+class MetricsRegistry:
+    """Holds the histograms and the counters of a run, they are created on first use.
+    """
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        self._counters: Dict[str, Counter] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str) -> Histogram:
+        """Return the histogram for `name`, the help and buckets are taken from `PHASES`.
+        """
+        if name not in self._histograms:
+            with self._lock:
+                if name not in self._histograms:
+                    help, buckets = PHASES.get(name, ('', SECONDS_BUCKETS))
+                    self._histograms[name] = Histogram(name, help, buckets)
+        return self._histograms[name]
+
+    def counter(self, name: str) -> Counter:
+        """Return the counter for `name`, the help is taken from `COUNTERS`.
+        """
+        if name not in self._counters:
+            with self._lock:
+                if name not in self._counters:
+                    self._counters[name] = Counter(name, COUNTERS.get(name, ''))
+        return self._counters[name]
+
+    def observe(self, name: str, value: float) -> NoReturn:
+        self.histogram(name).observe(value)
+
+    def inc(self, name: str, value: float = 1) -> NoReturn:
+        self.counter(name).inc(value)
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        """Observe the runtime of the `with` block in seconds.
+        """
+        t1 = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, default_timer() - t1)
+
+    def reset(self) -> NoReturn:
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+    def _metrics(self) -> Dict[str, Union[Histogram, Counter]]:
+        return {**self._histograms, **self._counters}
+
+    def to_prometheus(self) -> str:
+        return '\n'.join(m.to_prometheus() for m in self._metrics().values()) + '\n'
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {name: m.summary() for name, m in self._metrics().items()}
+
+    def write_prometheus(self, path: os.PathLike) -> NoReturn:
+        """Write the Prometheus text file atomically, such that a scraper never reads half of it.
+        """
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def write_summary(self, path: os.PathLike, extra: Optional[Dict] = None) -> Dict:
+        summary = {**(extra or {}), 'metrics': self.summary()}
+        with open(path, 'w') as fp:
+            json.dump(summary, fp, indent=2)
+        return summary
+
+
+class PrometheusFileWriter(threading.Thread):
+    """Rewrites the Prometheus text file every `interval` seconds while a run is going.
+    """
+    def __init__(self, registry: MetricsRegistry, path: os.PathLike, interval: float):
+        super().__init__(name='tar_metrics', daemon=True)
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self) -> NoReturn:
+        while not self._stop_event.wait(self.interval):
+            self.registry.write_prometheus(self.path)
+
+    def stop(self) -> NoReturn:
+        self._stop_event.set()
+        self.join()
+        self.registry.write_prometheus(self.path)
+
+
+# the registry shared by all the modules of a run
+metrics = MetricsRegistry()
@@ -0,0 +1,187 @@
+"""
+This script contains the dry-run planner for the TAr api requester. The size of a pull is
+summed up from the getSeries metadata (FileSize, or the ImageCount where the size is not
+given), the link is measured with a short throughput probe on a metadata endpoint, and the
+runtime is estimated for a range of worker counts, such that a multi-TB pull can be sized
+before a single image is requested.
+"""
+# externals
+import statistics
+import concurrent.futures as cf
+from timeit import default_timer
+from typing import Dict, List, Mapping, Optional
+from requests.exceptions import RequestException
+# internals
+from config import config
+from config.logger import log
+from src.helpers import api_request
+from src.scheduler import SeriesTask
+
+
+def format_bytes(n_bytes: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(n_bytes) < 1024 or unit == 'TB':
+            return f'{n_bytes:.1f} {unit}'
+        n_bytes /= 1024
+
+
+def format_seconds(seconds: float) -> str:
+    hours, rest = divmod(int(seconds), 3600)
+    return f'{hours}h {rest // 60:02d}m {rest % 60:02d}s'
+
+
+def series_bytes(tasks: List[SeriesTask]) -> List[int]:
+    """Return the size of every series, the series without a FileSize are estimated from
+    their ImageCount and the mean bytes per image of the series that have both.
+    """
+    known = [task for task in tasks if task.file_size and task.image_count]
+    per_image = sum(t.file_size for t in known) / sum(t.image_count for t in known) if known else 0
+    return [task.file_size or int(task.image_count * per_image) for task in tasks]
+
+
+def summarize(tasks: List[SeriesTask], top: int = config.PLAN_TOP_PATIENTS) -> Dict:
+    """Sum up the series, images and bytes of a work queue and find the largest patients.
+    """
+    sizes = series_bytes(tasks)
+    patients: Dict[str, Dict[str, int]] = {}
+    for task, size in zip(tasks, sizes):
+        patient = patients.setdefault(f'{task.collection}/{task.patient}', {'series': 0, 'bytes': 0})
+        patient['series'] += 1
+        patient['bytes'] += size
+    largest = sorted(patients.items(), key=lambda item: item[1]['bytes'], reverse=True)[:top]
+    return {
+        'series': len(tasks),
+        'patients': len(patients),
+        'images': sum(task.image_count for task in tasks),
+        'bytes': sum(sizes),
+        'series_without_size': sum(1 for task in tasks if not task.file_size),
+        'largest_series_bytes': max(sizes, default=0),
+        'largest_patients': [{'patient': name, **info} for name, info in largest]
+        }
+
+
+def _probe_once(url: str, params: Mapping[str, str], seconds: float) -> Optional[Dict[str, float]]:
+    """Stream one metadata response for at most `seconds` and return its time to first
+    byte and its transfer rate, None if the request failed.
+    """
+    t1 = default_timer()
+    try:
+        resp = api_request(url, params=dict(params), is_series=False, stream=True)
+    except RequestException:
+        return None
+    latency = default_timer() - t1
+    n_bytes, t2 = 0, default_timer()
+    with resp:
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            n_bytes += len(chunk)
+            if default_timer() - t2 > seconds:
+                break
+    elapsed = default_timer() - t2
+    return {'latency': latency, 'bytes': n_bytes, 'seconds': elapsed}
+
+
+def probe_throughput(
+                collection: str,
+                streams: List[int] = config.PLAN_PROBE_STREAMS,
+                seconds: float = config.PLAN_PROBE_SECONDS
+                ) -> Dict:
+    """Measure the link towards NBIA without downloading image data. The collection-wide
+    getSeries response is the largest metadata NBIA serves, it is streamed on more and more
+    connections at once until the total rate stops growing, which is where the link is
+    saturated. The patient list is streamed instead if getSeries can not be probed.
+    Parameters
+    ----------
+    collection : str
+        The collection to probe with.
+    streams : List[int]
+        The numbers of parallel streams to measure, in increasing order.
+    seconds : float
+        The longest time a single stream is read.
+    Returns
+    -------
+    Dict
+        The median latency in seconds, the single stream rate and the highest total rate in
+        bytes/sec, and whether the link was saturated within the probed streams.
+    """
+    series_params = {k: v for k, v in config.get_series_params.items() if k != 'PatientID'}
+    targets = [
+        (config.URL_SERIES, {**series_params, 'Collection': collection}),
+        (config.URL_PATIENT, {**config.get_patient_params, 'Collection': collection})
+        ]
+
+    def measure(url: str, params: Mapping[str, str], n_streams: int) -> List[Dict[str, float]]:
+        with cf.ThreadPoolExecutor(max_workers=n_streams, thread_name_prefix='tcia_probe') as executor:
+            results = executor.map(lambda _: _probe_once(url, params, seconds), range(n_streams))
+            return [r for r in results if r is not None]
+
+    def total_rate(results: List[Dict[str, float]]) -> float:
+        elapsed = max((r['latency'] + r['seconds'] for r in results), default=0.0)
+        return sum(r['bytes'] for r in results) / elapsed if elapsed > 0 else 0.0
+
+    for url, params in targets:
+        # the first request may pay for the handshake, it is not counted
+        if not measure(url, params, 1):
+            continue
+        latencies, rates, saturated, n_bytes = [], {}, False, 0
+        for n_streams in streams:
+            results = measure(url, params, n_streams)
+            latencies += [r['latency'] for r in results]
+            n_bytes += sum(r['bytes'] for r in results)
+            rates[n_streams] = total_rate(results)
+            if len(rates) > 1 and rates[n_streams] < 1.25 * max(list(rates.values())[:-1]):
+                saturated = True
+                break
+        if latencies and n_bytes < config.PLAN_PROBE_MIN_BYTES:
+            log.warning('the probe responses are too small to measure the rate, it falls back to the default')
+            return _default_probe(statistics.median(latencies))
+        if latencies:
+            return {
+                'latency_seconds': statistics.median(latencies),
+                'single_stream_bytes_per_second': rates[streams[0]] / streams[0],
+                'link_bytes_per_second': max(rates.values()),
+                'saturated': saturated,
+                'rates': rates
+                }
+    log.warning('the throughput probe failed, the estimate falls back to the defaults')
+    return _default_probe(config.PLAN_DEFAULT_LATENCY)
+
+
+def _default_probe(latency: float) -> Dict:
+    return {
+        'latency_seconds': latency,
+        'single_stream_bytes_per_second': config.PLAN_DEFAULT_BYTES_PER_SECOND,
+        'link_bytes_per_second': 0.0,
+        'saturated': False,
+        'rates': {}
+        }
+
+
+def estimate_runtime(summary: Dict, probe: Dict, workers: int, rate_limit: float) -> float:
+    """Estimate the runtime in seconds with `workers` concurrent downloads. The runtime is
+    bound by the workers, which pay the latency once per series and stream at the single
+    stream rate, by the link once it is saturated, and by the rate limit on the requests.
+    A link that did not saturate within the probe is extrapolated.
+    """
+    single = probe['single_stream_bytes_per_second'] or config.PLAN_DEFAULT_BYTES_PER_SECOND
+    worker_bound = (summary['series'] * probe['latency_seconds'] + summary['bytes'] / single) / workers
+    link_bound = summary['bytes'] / probe['link_bytes_per_second'] if probe['saturated'] else 0.0
+    rate_bound = summary['series'] / rate_limit if rate_limit > 0 else 0.0
+    return max(worker_bound, link_bound, rate_bound)
+
+
+def recommend_workers(
+                summary: Dict,
+                probe: Dict,
+                rate_limit: float,
+                candidates: List[int] = config.PLAN_WORKER_CANDIDATES
+                ) -> Dict[int, float]:
+    """Estimate the runtime for every candidate worker count.
+    """
+    return {workers: estimate_runtime(summary, probe, workers, rate_limit) for workers in candidates}
+
+
+def pick_workers(estimates: Dict[int, float]) -> int:
+    """Pick the fewest workers that come within 10% of the fastest estimate.
+    """
+    best = min(estimates.values())
+    return min(workers for workers, seconds in estimates.items() if seconds <= 1.1 * best)
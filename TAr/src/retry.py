@@ -0,0 +1,198 @@
+"""
+This script contains the retry and rate limiting logic for the TAr api requester. Failed
+requests are retried with exponential backoff and full jitter, a Retry-After header from
+NBIA is honored, and every request takes a token from a global adaptive bucket. The bucket
+halves its rate when NBIA throttles or errors and slowly grows it back on success, such that
+the sustained throughput stays as high as NBIA allows without getting throttled.
+"""
+# externals
+import random
+import threading
+import requests
+from time import sleep, monotonic
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Callable, Mapping, NoReturn, Optional
+# internals
+from config import config
+from config.logger import log
+
+
+class AdaptiveTokenBucket:
+    """A thread-safe token bucket whose rate adapts to the error rate (AIMD).
+    Attributes
+    ----------
+    max_rate : float
+        The highest number of requests per second, the bucket starts here.
+    min_rate : float
+        The rate is never shrunk below `min_rate` requests per second.
+    """
+    def __init__(self, max_rate: float, min_rate: float):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.burst = max(1.0, max_rate)
+        self._tokens = self.burst
+        self._last = monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds the caller has to wait before sending.
+        Tokens can go negative, that way the waiting callers are served in order.
+        """
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate)
+            return max(wait, self._paused_until - now)
+
+    def acquire(self) -> NoReturn:
+        """Block until a token is available.
+        """
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+
+    def on_success(self) -> NoReturn:
+        """Grow the rate additively after a successful request.
+        """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + config.RATE_INCREASE)
+
+    def on_throttle(self, pause: float = 0.0) -> NoReturn:
+        """Shrink the rate multiplicatively after a throttled or failed request, and hold
+        every request back for `pause` seconds, e.g. from a Retry-After header.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * config.RATE_DECREASE)
+            self._paused_until = max(self._paused_until, monotonic() + pause)
+
+
+_BUCKET_LOCK = threading.Lock()
+_bucket: Optional[AdaptiveTokenBucket] = None
+_retry_settings = {}
+
+
+def configure_retry(max_retries: Optional[int] = None, rate_limit: Optional[float] = None) -> NoReturn:
+    """Set the retry count and the rate limit for all the requests.
+    Parameters
+    ----------
+    max_retries : int
+        How many times a failed request is retried.
+    rate_limit : float
+        The highest number of requests per second, set to 0 to switch the bucket off.
+    Returns
+    -------
+    NoReturn
+    """
+    global _bucket
+    with _BUCKET_LOCK:
+        if max_retries is not None:
+            _retry_settings['max_retries'] = max_retries
+        if rate_limit is not None:
+            _retry_settings['rate_limit'] = rate_limit
+            _bucket = None
+
+
+def get_bucket() -> Optional[AdaptiveTokenBucket]:
+    """Return the shared token bucket, None if rate limiting is switched off.
+    """
+    global _bucket
+    rate_limit = _retry_settings.get('rate_limit', config.RATE_LIMIT)
+    if rate_limit <= 0:
+        return None
+    if _bucket is None:
+        with _BUCKET_LOCK:
+            if _bucket is None:
+                _bucket = AdaptiveTokenBucket(max_rate=rate_limit, min_rate=config.RATE_LIMIT_MIN)
+    return _bucket
+
+
+def get_max_retries() -> int:
+    return _retry_settings.get('max_retries', config.MAX_RETRIES)
+
+
+def is_retryable(status_code: int) -> bool:
+    return status_code in config.RETRY_STATUS
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> float:
+    """Parse a Retry-After header, given either as seconds or as an HTTP date.
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def backoff_delay(attempt: int, retry_after: float = 0.0) -> float:
+    """Exponential backoff with full jitter, but never shorter than the Retry-After.
+    """
+    delay = random.uniform(0, min(config.BACKOFF_MAX, config.BACKOFF_BASE * 2 ** attempt))
+    return max(delay, min(retry_after, config.RETRY_AFTER_MAX))
+
+
+def call_with_retry(send: Callable[[], requests.Response]) -> requests.Response:
+    """Send a request through the token bucket and retry it on connection errors and
+    retryable status codes.
+    Parameters
+    ----------
+    send : Callable[[], requests.Response]
+        A function that sends the request once.
+    Returns
+    -------
+    requests.Response
+        The successful response.
+    Raises
+    ------
+    requests.HTTPError
+        If the final attempt came back with an error status.
+    requests.RequestException
+        If the final attempt failed to connect or timed out.
+    """
+    max_retries = get_max_retries()
+    for attempt in range(max_retries + 1):
+        bucket = get_bucket()
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            resp = send()
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+            if bucket is not None:
+                bucket.on_throttle()
+            delay = backoff_delay(attempt)
+            log.warning(f'request failed to connect, retry {attempt + 1}/{max_retries} in {delay:.1f} sec')
+            sleep(delay)
+            continue
+
+        if is_retryable(resp.status_code) and attempt < max_retries:
+            retry_after = retry_after_seconds(resp.headers)
+            if bucket is not None:
+                bucket.on_throttle(retry_after)
+            delay = backoff_delay(attempt, retry_after)
+            log.warning(
+                f'request came back with status code: {resp.status_code} for url: {resp.url}, '
+                f'retry {attempt + 1}/{max_retries} in {delay:.1f} sec'
+                )
+            resp.close()
+            sleep(delay)
+            continue
+
+        if not resp.ok:
+            resp.close()
+            resp.raise_for_status()
+        if bucket is not None:
+            bucket.on_success()
+        return resp
@@ -0,0 +1,55 @@
+"""
+This script contains the series-level work queue for the TAr api requester. Every
+(patient, study, series) in the dataset becomes its own task and the tasks are ordered
+largest first, such that the biggest series start early and the small ones fill up the
+gaps at the end. This balances the load evenly across the workers, no matter how many
+series a single patient has. Priority classes, if given, are ordered ahead of the size.
+"""
+# externals
+from typing import Callable, List, NamedTuple, Optional
+
+
+class SeriesTask(NamedTuple):
+    """A single series to download.
+    Attributes
+    ----------
+    patient : str
+        The PatientID the series belongs to.
+    study_uid : str
+        The StudyInstanceUID.
+    series_uid : str
+        The SeriesInstanceUID.
+    description : str
+        The SeriesDescription.
+    image_count : int
+        The number of images in the series according to getSeries.
+    file_size : int
+        The size of the series in bytes according to getSeries.
+    collection : str
+        The collection the series belongs to, such that one queue can hold several collections.
+    updated : str
+        When the series was last changed on NBIA, from the first of `SYNC_DATE_FIELDS` that getSeries holds.
+    modality : str
+        The Modality of the series.
+    """
+    patient: str
+    study_uid: str
+    series_uid: str
+    description: str
+    image_count: int = 0
+    file_size: int = 0
+    collection: str = ''
+    updated: str = ''
+    modality: str = ''
+
+
+def sort_work_queue(
+                tasks: List[SeriesTask],
+                priority: Optional[Callable[[SeriesTask], int]] = None
+                ) -> List[SeriesTask]:
+    """Order the tasks by size and then image count, largest first. With a `priority`, the
+    tasks are ordered by their priority class first, the lowest class goes first.
+    """
+    if priority is None:
+        return sorted(tasks, key=lambda task: (task.file_size, task.image_count), reverse=True)
+    return sorted(tasks, key=lambda task: (priority(task), -task.file_size, -task.image_count))
@@ -0,0 +1,103 @@
+"""
+This script holds the shared HTTP session for the TAr api requester. Every request
+towards the NBIA endpoint goes through one connection pool, such that the TCP and TLS
+handshakes are paid once per connection instead of once per patient, series and image.
+"""
+# externals
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from typing import NoReturn, Optional
+# internals
+from config import config
+
+_SESSION_LOCK = threading.Lock()
+_session: Optional[requests.Session] = None
+# settings given via `configure_session`, the rest falls back to the config
+_pool_settings = {}
+
+
+def configure_session(
+                pool_connections: Optional[int] = None,
+                pool_maxsize: Optional[int] = None,
+                pool_block: Optional[bool] = None,
+                keep_alive: Optional[bool] = None
+                ) -> NoReturn:
+    """Set the connection pool settings for the shared session. An already opened
+    session is closed such that the next call to `get_session` picks up the new settings.
+    Parameters
+    ----------
+    pool_connections : int
+        The number of per-host pools to keep, i.e. how many different hosts that are cached.
+    pool_maxsize : int
+        The maximum number of connections kept alive towards a single host.
+    pool_block : bool
+        If true, the `pool_maxsize` is a hard per-host limit and threads wait for a free
+        connection instead of opening a throwaway one.
+    keep_alive : bool
+        Set `keep_alive` to false to close the connection after each request.
+    Returns
+    -------
+    NoReturn
+    """
+    new_settings = {
+                'pool_connections': pool_connections,
+                'pool_maxsize': pool_maxsize,
+                'pool_block': pool_block,
+                'keep_alive': keep_alive
+                }
+    with _SESSION_LOCK:
+        _pool_settings.update({k: v for k, v in new_settings.items() if v is not None})
+    close_session()
+
+
+def _make_session() -> requests.Session:
+    """Build a session with a pooled adapter mounted for both http and https.
+    """
+    settings = {
+                'pool_connections': config.POOL_CONNECTIONS,
+                'pool_maxsize': config.POOL_MAXSIZE,
+                'pool_block': config.POOL_BLOCK,
+                'keep_alive': config.KEEP_ALIVE,
+                **_pool_settings
+                }
+    session = requests.Session()
+    adapter = HTTPAdapter(
+                    pool_connections=settings['pool_connections'],
+                    pool_maxsize=settings['pool_maxsize'],
+                    pool_block=settings['pool_block']
+                    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+                        'User-Agent': config.USER_AGENT,
+                        'Content-Type': 'application/json',
+                        'Connection': 'keep-alive' if settings['keep_alive'] else 'close'
+                        })
+    return session
+
+
+def get_session() -> requests.Session:
+    """Return the shared session and create it on first use. The underlying urllib3 pool
+    is thread-safe, so the same session is handed to every worker thread.
+    Returns
+    -------
+    requests.Session
+        The pooled session.
+    """
+    global _session
+    if _session is None:
+        with _SESSION_LOCK:
+            if _session is None:
+                _session = _make_session()
+    return _session
+
+
+def close_session() -> NoReturn:
+    """Close the shared session and release all the pooled connections.
+    """
+    global _session
+    with _SESSION_LOCK:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,116 @@
+"""
+This script contains the sharding for the TAr api requester. A collection can be split over
+several ingest nodes without any coordinator: every node runs with `--shard i/N` and keeps
+only the series whose stable hash falls in its shard. The manifests of the nodes are merged
+afterwards to verify that the shards together cover the whole collection.
+"""
+# externals
+import os
+import glob
+import hashlib
+import argparse
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+# internals
+from src.scheduler import SeriesTask
+from src.manifest import Manifest
+
+
+def parse_shard(value: str) -> Optional[Tuple[int, int]]:
+    """Parse the `i/N` shard argument, an empty value means no sharding.
+    """
+    if not value:
+        return None
+    try:
+        index, n_shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard must be given as i/N, got {value}')
+    if n_shards < 1 or not 0 <= index < n_shards:
+        raise argparse.ArgumentTypeError(f'shard index must be in 0..N-1, got {value}')
+    return index, n_shards
+
+
+def shard_of(key: str, n_shards: int) -> int:
+    """Map a key to a shard with a hash that is stable across processes and hosts, unlike
+    the builtin `hash` which is salted per process.
+    """
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % n_shards
+
+
+def shard_key(task: SeriesTask, shard_by: str) -> str:
+    return task.patient if shard_by == 'patient' else task.series_uid
+
+
+def filter_shard(tasks: Iterable[SeriesTask], shard: Tuple[int, int], shard_by: str = 'series') -> List[SeriesTask]:
+    """Keep the tasks that belong to a shard.
+    Parameters
+    ----------
+    tasks : Iterable[SeriesTask]
+        The full work queue.
+    shard : Tuple[int, int]
+        The shard index and the number of shards.
+    shard_by : str
+        Either `series` to spread the series evenly, or `patient` to keep all the series of
+        a patient on the same node.
+    Returns
+    -------
+    List[SeriesTask]
+        The tasks of the shard, in the original order.
+    """
+    index, n_shards = shard
+    return [task for task in tasks if shard_of(shard_key(task, shard_by), n_shards) == index]
+
+
+def manifest_name(base_name: str, shard: Optional[Tuple[int, int]]) -> str:
+    """Give every shard its own manifest name, such that the manifests can be collected
+    in one folder for the merge.
+    """
+    if shard is None:
+        return base_name
+    root, ext = os.path.splitext(base_name)
+    return f'{root}-shard-{shard[0]}-of-{shard[1]}{ext}'
+
+
+def find_manifests(paths: Iterable[str], base_name: str) -> List[str]:
+    """Expand the given manifest files and folders into a list of manifest files.
+    """
+    root, ext = os.path.splitext(base_name)
+    manifests = []
+    for path in paths:
+        if os.path.isdir(path):
+            manifests.extend(sorted(glob.glob(os.path.join(path, f'{root}*{ext}'))))
+        else:
+            manifests.append(path)
+    return manifests
+
+
+def merge_manifests(manifest_paths: Iterable[str], expected_uids: Set[str]) -> Dict:
+    """Merge the manifests of the shards and verify them against the full collection.
+    Parameters
+    ----------
+    manifest_paths : Iterable[str]
+        The manifest files of the shards.
+    expected_uids : Set[str]
+        The SeriesInstanceUIDs of the whole collection.
+    Returns
+    -------
+    Dict
+        A report with the coverage, the missing series and the series found in more than one shard.
+    """
+    owners: Dict[str, List[str]] = {}
+    for path in manifest_paths:
+        # the manifest drops the series whose last attempt failed the verification
+        for uid in Manifest(path):
+            owners.setdefault(uid, []).append(path)
+
+    completed = set(owners)
+    missing = sorted(expected_uids - completed)
+    return {
+        'manifests': list(manifest_paths),
+        'expected': len(expected_uids),
+        'completed': len(completed & expected_uids),
+        'complete': not missing,
+        'missing': missing,
+        'duplicates': {uid: paths for uid, paths in owners.items() if len(paths) > 1},
+        'unexpected': sorted(completed - expected_uids)
+        }
@@ -0,0 +1,199 @@
+"""
+This script contains the content-addressed store for the TAr api requester. Every extracted
+dicom file is kept once under the hash of its content, and the patient/study/series/sedesc
+trees of the datasets are built from hardlinks or symlinks into the store. A series that is
+pulled for a second collection, or again after its tree was removed, is linked from the
+store instead of being downloaded.
+"""
+# externals
+import os
+import json
+import errno
+import shutil
+import threading
+from typing import Any, Dict, NoReturn, Optional, Tuple
+# internals
+from config import config
+from config.logger import log
+from src.scheduler import SeriesTask
+from src.metrics import metrics
+from src.integrity import DownloadResult, ExtractResult, new_hasher
+
+
+def hash_file(path: os.PathLike) -> str:
+    """Hash a file in fixed chunks with the `HASH_ALGORITHM`.
+    """
+    hasher = new_hasher()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(config.CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class DicomStore:
+    """A content-addressed file store with one json index per series.
+    Attributes
+    ----------
+    root : os.PathLike
+        The folder of the store, the files go to `objects` and the series indexes to `series`.
+    link : str
+        Either `hardlink` or `symlink`, how the dataset trees point into the store.
+    """
+    def __init__(self, root: os.PathLike, link: str = config.STORE_LINK):
+        if link not in config.STORE_LINKS:
+            raise ValueError(f'the store link must be one of {config.STORE_LINKS}, got {link}')
+        self.root = root
+        self.link = link
+        self.objects = os.path.join(root, 'objects')
+        self.series = os.path.join(root, 'series')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.series, exist_ok=True)
+
+    def object_path(self, digest: str) -> os.PathLike:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def _index_path(self, series_uid: str) -> os.PathLike:
+        return os.path.join(self.series, f'{series_uid}.json')
+
+    def get_series(self, series_uid: str) -> Optional[Dict[str, Any]]:
+        """Return the index of a stored series, None if it is not stored.
+        """
+        try:
+            with open(self._index_path(series_uid), 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def is_current(task: SeriesTask, entry: Optional[Dict[str, Any]]) -> bool:
+        """Check that a series is stored in the version NBIA lists, a series whose image
+        count or release date changed has to be downloaded again.
+        """
+        if entry is None:
+            return False
+        if task.image_count and len(entry['files']) < task.image_count:
+            return False
+        if task.image_count and entry.get('ImageCount') and entry['ImageCount'] != task.image_count:
+            return False
+        return not (task.updated and entry.get('updated') and entry['updated'] != task.updated)
+
+    def _place(self, source: os.PathLike, dest: os.PathLike) -> NoReturn:
+        """Make `dest` a link to `source`, a hardlink across filesystems falls back to a
+        symlink. The link is made next to `dest` and renamed over it, such that a reader never
+        sees a missing or half written file.
+        """
+        try:
+            if os.path.samefile(source, dest):
+                # already linked, renaming a hardlink over the same inode would not remove it
+                return
+        except OSError:
+            pass
+        tmp = f'{dest}.{os.getpid()}-{threading.get_ident()}.tmp'
+        if self.link == 'hardlink':
+            try:
+                os.link(source, tmp)
+            except OSError as error:
+                if error.errno != errno.EXDEV:
+                    raise
+                os.symlink(os.path.abspath(source), tmp)
+        else:
+            os.symlink(os.path.abspath(source), tmp)
+        os.replace(tmp, dest)
+        if os.path.lexists(tmp):
+            # a rename onto a hardlink of the same file succeeds without removing the source
+            os.unlink(tmp)
+
+    def _store_file(self, path: os.PathLike) -> str:
+        """Move a single extracted file into the store and return its digest. A file whose
+        content is stored already is dropped in favour of the stored one.
+        """
+        if os.path.islink(path):
+            # a symlink from an earlier ingest already points at its object
+            return os.path.basename(os.readlink(path))
+        digest = hash_file(path)
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            try:
+                # the extracted file becomes the object, no byte is copied
+                os.link(path, obj)
+            except FileExistsError:
+                pass
+            except OSError as error:
+                if error.errno != errno.EXDEV:
+                    raise
+                tmp = f'{obj}.{os.getpid()}-{threading.get_ident()}.tmp'
+                shutil.copyfile(path, tmp)
+                os.replace(tmp, obj)
+        if self.link == 'symlink' or not os.path.samefile(path, obj):
+            self._place(obj, path)
+        return digest
+
+    def add_series(self, task: SeriesTask, sedesc_folder: os.PathLike, download: DownloadResult) -> NoReturn:
+        """Move the files of an extracted and verified series into the store and replace
+        them with links, then write the index of the series.
+        Parameters
+        ----------
+        task : SeriesTask
+            The series that was extracted.
+        sedesc_folder : os.PathLike
+            The folder the series was extracted to.
+        download : DownloadResult
+            The zip the series came in, its size and digest are kept in the index.
+        Returns
+        -------
+        NoReturn
+        """
+        with metrics.timed('store_seconds'):
+            files, n_bytes = {}, 0
+            with os.scandir(sedesc_folder) as entries:
+                for entry in entries:
+                    if not entry.is_file() or entry.name.endswith('.zip'):
+                        continue
+                    files[entry.name] = self._store_file(entry.path)
+                    n_bytes += entry.stat().st_size
+            index = {
+                'SeriesInstanceUID': task.series_uid,
+                'ImageCount': task.image_count,
+                'updated': task.updated,
+                'bytes': n_bytes,
+                'zip_bytes': download.n_bytes,
+                config.HASH_ALGORITHM: download.digest,
+                'files': files
+                }
+            path = self._index_path(task.series_uid)
+            tmp = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+            with open(tmp, 'w') as fp:
+                json.dump(index, fp)
+            os.replace(tmp, path)
+
+    def link_series(self, task: SeriesTask, sedesc_folder: os.PathLike) -> Optional[Tuple[DownloadResult, ExtractResult]]:
+        """Build the sedesc folder of a stored series from links into the store.
+        Parameters
+        ----------
+        task : SeriesTask
+            The series to link.
+        sedesc_folder : os.PathLike
+            The folder to link the files into.
+        Returns
+        -------
+        Optional[Tuple[DownloadResult, ExtractResult]]
+            The zip the series was stored from and the number of files and bytes linked, None
+            if the series is not stored in this version and has to be downloaded.
+        """
+        entry = self.get_series(task.series_uid)
+        if not self.is_current(task, entry):
+            return None
+        with metrics.timed('store_seconds'):
+            n_bytes = 0
+            for name, digest in entry['files'].items():
+                obj = self.object_path(digest)
+                try:
+                    n_bytes += os.path.getsize(obj)
+                    self._place(obj, os.path.join(sedesc_folder, name))
+                except FileNotFoundError:
+                    log.warning(f'the store lost a file of series {task.series_uid}, it is downloaded again')
+                    return None
+        log.info(f'linked series {task.series_uid} from the store')
+        download = DownloadResult(entry.get('zip_bytes', 0), entry.get(config.HASH_ALGORITHM, ''))
+        return download, ExtractResult(len(entry['files']), n_bytes)
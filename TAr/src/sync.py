@@ -0,0 +1,145 @@
+"""
+This script contains the incremental sync for the TAr api requester. The remote series list
+is diffed against the manifest and the local tree of a dataset, such that a refresh only
+downloads the series that are new on NBIA, that changed since they were fetched (image count
+or release date) or that went missing from the disk. The series that are gone from NBIA are
+reported, but never removed locally.
+"""
+# externals
+import os
+import shutil
+from typing import Dict, Iterable, List, NamedTuple, NoReturn, Optional, Set
+# internals
+from config.logger import log
+from src.scheduler import SeriesTask
+from src.manifest import Manifest
+from src.layout import series_folders
+
+
+class SyncDelta(NamedTuple):
+    """The difference between the remote series list and a local dataset.
+    Attributes
+    ----------
+    new : List[SeriesTask]
+        The series that were never downloaded.
+    changed : List[SeriesTask]
+        The series whose image count or release date differs from the manifest.
+    missing : List[SeriesTask]
+        The series in the manifest whose files are gone from the local tree.
+    unchanged : List[SeriesTask]
+        The series that are up to date.
+    removed : List[str]
+        The SeriesInstanceUIDs in the manifest that NBIA no longer lists.
+    """
+    new: List[SeriesTask]
+    changed: List[SeriesTask]
+    missing: List[SeriesTask]
+    unchanged: List[SeriesTask]
+    removed: List[str]
+
+    @property
+    def to_fetch(self) -> List[SeriesTask]:
+        return self.new + self.changed + self.missing
+
+    def report(self) -> Dict:
+        """Summarize the delta for the sync report, the tasks are given by their UIDs.
+        """
+        return {
+            'new': [task.series_uid for task in self.new],
+            'changed': [task.series_uid for task in self.changed],
+            'missing': [task.series_uid for task in self.missing],
+            'removed': self.removed,
+            'unchanged': len(self.unchanged)
+            }
+
+
+def count_files(folder: os.PathLike) -> int:
+    """Count the extracted files in a sedesc folder, a zip left behind by a crash is not counted.
+    """
+    try:
+        with os.scandir(folder) as entries:
+            return sum(1 for entry in entries if entry.is_file() and not entry.name.endswith('.zip'))
+    except FileNotFoundError:
+        return 0
+
+
+def is_changed(task: SeriesTask, entry: Dict) -> bool:
+    """Compare a remote series with its manifest entry. Entries written before the sync
+    existed have no image count, the number of extracted files stands in for it.
+    """
+    recorded_count = entry.get('ImageCount') or entry.get('files', 0)
+    if task.image_count and recorded_count and task.image_count != recorded_count:
+        return True
+    recorded_date = entry.get('updated')
+    return bool(task.updated and recorded_date and task.updated != recorded_date)
+
+
+def diff_series(
+            tasks: Iterable[SeriesTask],
+            manifest: Manifest,
+            data_path: os.PathLike,
+            remote_uids: Optional[Set[str]],
+            adopt: bool = True
+            ) -> SyncDelta:
+    """Diff the remote series against the manifest and the local tree of a dataset. A series
+    that is on disk with all its images but not in the manifest, e.g. from a run before the
+    manifest existed, is adopted into the manifest instead of being downloaded again. The
+    series written to tar shards are not looked for in the tree.
+    Parameters
+    ----------
+    tasks : Iterable[SeriesTask]
+        The remote series to sync.
+    manifest : Manifest
+        The manifest of the dataset.
+    data_path : os.PathLike
+        The root folder of the dataset.
+    remote_uids : Set[str]
+        All the SeriesInstanceUIDs NBIA lists for the collection, to find the removed series.
+        Nothing is reported as removed if None.
+    adopt : bool
+        Record the adopted series in the manifest, set it to false for a dry run such
+        that the manifest is left as it is. The series still count as unchanged.
+    Returns
+    -------
+    SyncDelta
+        The new, changed, missing, unchanged and removed series.
+    """
+    new, changed, missing, unchanged = [], [], [], []
+    for task in tasks:
+        sedesc_folder = series_folders(data_path, task.patient, task.study_uid, task.series_uid, task.description)[-1]
+        n_files = count_files(sedesc_folder)
+        entry = manifest.get(task.series_uid)
+        if entry is None:
+            if task.image_count and n_files == task.image_count:
+                if adopt:
+                    manifest.record(
+                                task.series_uid,
+                                PatientID=task.patient,
+                                StudyInstanceUID=task.study_uid,
+                                ImageCount=task.image_count,
+                                updated=task.updated,
+                                files=n_files,
+                                adopted=True
+                                )
+                unchanged.append(task)
+            else:
+                new.append(task)
+        elif is_changed(task, entry):
+            changed.append(task)
+        elif not entry.get('shard') and n_files < entry.get('files', 0):
+            missing.append(task)
+        else:
+            unchanged.append(task)
+    removed = [] if remote_uids is None else sorted(uid for uid in manifest if uid not in remote_uids)
+    return SyncDelta(new, changed, missing, unchanged, removed)
+
+
+def clear_series(tasks: Iterable[SeriesTask], data_path: os.PathLike) -> NoReturn:
+    """Remove the local files of the changed series, such that no stale image is left next
+    to the new ones when a series shrank.
+    """
+    for task in tasks:
+        sedesc_folder = series_folders(data_path, task.patient, task.study_uid, task.series_uid, task.description)[-1]
+        if os.path.isdir(sedesc_folder):
+            log.info(f'series {task.series_uid} changed on NBIA, removing the old files')
+            shutil.rmtree(sedesc_folder)
@@ -2,43 +2,60 @@
 This script contains helper functions for the TAr api requester.
 """
 # externals
+import io
 import os
 import sys
-from tqdm.contrib import tzip
-from tqdm import tqdm
-from zipfile import ZipFile, BadZipFile, LargeZipFile
-from typing import Dict, Union, NoReturn, List
+import concurrent.futures as cf
+from collections import deque
+from typing import Dict, Iterable, Iterator, Mapping, Union, NoReturn, List, Optional, Tuple
+from tempfile import SpooledTemporaryFile
+from requests.exceptions import RequestException
 # internals
 from config import config
 from config.logger import log
-from src.helpers import api_request, check_make_folder, timer
+from src.helpers import api_request, stream_to_file, stream_to_fileobj
+from src.scheduler import SeriesTask
+from src.manifest import Manifest
+from src.cache import MetadataCache, PATIENTS_KEY
+from src.metrics import metrics
+from src.extraction import ExtractionPool, extract_zip, extract_zip_file
+from src.integrity import DownloadResult, ExtractResult, check_response, new_hasher, verify_series
+from src.store import DicomStore
+from src.layout import make_series_folder
+from src.archive import TarShardWriter
+from src.catalog import Catalog
 
 
-@timer
-def get_series_list(dataset_name: str) -> Union[os.PathLike, Dict[str, str]]:
-    """Extract all the information about a series UUID in a specific dataset that lies
-    in the cancer imaging archive. The extractions are done over API requests. The information
-    from all the series UUIDs in the given dataset will extracted and placed in dict for subsequent
-    requests.
+def get_patient_list(
+                dataset_name: str,
+                cache: Optional[MetadataCache] = None,
+                offline: bool = False
+                ) -> List[Dict[str, str]]:
+    """Request the patient list of a dataset, from the metadata cache if it holds a fresh copy.
     Parameters
     ----------
     dataset_name : str
-        Specify which dataset to extract info for the series UUIDS from.
+        The name of the dataset.
+    cache : MetadataCache
+        The metadata cache to read from and write to, if any.
+    offline : bool
+        Set `offline` to true to only use the cache, expired entries included.
     Returns
     -------
-    Dict[str, str]
-        A nested dict containing information about the series uuids.
-    str
-        A string value for the name of the dataset
+    List[Dict[str, str]]
+        The getPatient response, one dict per patient.
     """
-    try:
-        # update the patient parameter dict
-        config.get_patient_params.update({'Collection': dataset_name})
+    patients = cache.get(dataset_name, PATIENTS_KEY, allow_stale=offline) if cache else None
+    if patients is not None:
+        return patients
+    if offline:
+        raise ValueError(f'the patient list for {dataset_name} is not in the metadata cache, run once with network first')
 
+    try:
         # who you gonna call
         resp = api_request(
                         url=config.URL_PATIENT,
-                        params=config.get_patient_params,
+                        params={**config.get_patient_params, 'Collection': dataset_name},
                         is_series=False
                         )
 
@@ -49,125 +66,308 @@ def get_series_list(dataset_name: str) -> Union[os.PathLike, Dict[str, str]]:
                 exc_info=True
                 )
         sys.exit(1)
+    except RequestException:
+        log.error(f'I tried request the patient list for the dataset {dataset_name}, but the request failed', exc_info=True)
+        sys.exit(1)
+
+    if cache and patients:
+        cache.put(dataset_name, PATIENTS_KEY, patients)
+    return patients
+
+
+def get_patient_series(
+                dataset_name: str,
+                patient: str,
+                cache: Optional[MetadataCache] = None,
+                offline: bool = False,
+                query: Optional[Dict[str, str]] = None
+                ) -> List[Dict[str, Union[str, int]]]:
+    """Request the series information for a single patient. The parameters are built per
+    request, such that the function can be called from several threads at once.
+    Parameters
+    ----------
+    dataset_name : str
+        The name of the dataset the `patient` belongs to.
+    patient : str
+        The PatientID to request the series for.
+    cache : MetadataCache
+        The metadata cache to read from and write to, if any.
+    offline : bool
+        Set `offline` to true to only use the cache, a patient missing from it has no series.
+    query : Dict[str, str]
+        Extra getSeries parameters that NBIA filters on, e.g. the Modality.
+    Returns
+    -------
+    List[Dict[str, Union[str, int]]]
+        The getSeries response, one dict per series.
+    """
+    query = query or {}
+    key = patient + ''.join(f'&{k}={v}' for k, v in sorted(query.items()))
+    series = cache.get(dataset_name, key, allow_stale=offline) if cache else None
+    if series is None and cache and query:
+        # the unfiltered response holds the filtered series too, the local filter drops the rest
+        series = cache.get(dataset_name, patient, allow_stale=offline)
+    if series is not None:
+        return series
+    if offline:
+        log.warning(f'patient {patient} is not in the metadata cache, skipping it')
+        return []
+
+    params = {**config.get_series_params, **query, 'PatientID': patient, 'Collection': dataset_name}
+    try:
+        # who you gonna call
+        series, _ = api_request(url=config.URL_SERIES, params=params)
+    except (RequestException, ValueError):
+        log.error(f'the series request for patient {patient} failed, the patient is skipped', exc_info=True)
+        return []
+    if cache:
+        cache.put(dataset_name, key, series)
+    return series
 
-    if patients:
-        for idx in tqdm(range(len(patients)), total=len(patients)):
-            patient = patients[idx].get('PatientId')
-            # update the series params with patient
-            config.get_series_params.update({
-                                            'PatientID': patient,
-                                            'Collection': dataset_name
-                                            })
-
-            # who you gonna call
-            series, collection = api_request(
-                                    url=config.URL_SERIES,
-                                    params=config.get_series_params
-                                    )
-            # NOTE: not sure if this suitable for concurrency (yet)
-            for idx, intances in enumerate(range(len(series))):
-                for uid_tag in config.SERIES_INSTANCES_LIST:
-                    uid = series[intances].get(uid_tag)
-                    uid = 'missing' if uid is None else uid
-                    if idx < 1:
-                        config.series_instances_dict[patient][uid_tag] = []
-                        config.series_instances_dict[patient][uid_tag].append(uid)
-                    else:
-                        config.series_instances_dict[patient][uid_tag].append(uid)
-    else:
-        log.error(f'response is empty, check if the dataset {dataset_name} limited or if patientID is listed', exc_info=True)
-        raise ValueError('can only process data that contains patientID')
 
-    # set some constants
+def dataset_path(dataset_name: str) -> os.PathLike:
+    """Return the folder a dataset is stored in.
+    """
     DATASETNAME = dataset_name.replace(" ", "-").lower()
-    DATA_PATH = config.DCM_RAW_DATASET_PATH.format(collection=DATASETNAME)
+    return config.DCM_RAW_DATASET_PATH.format(collection=DATASETNAME)
+
 
-    return DATA_PATH, config.series_instances_dict
+def iter_patient_series(
+                dataset_name: str,
+                patient_ids: Iterable[str],
+                workers: int = config.METADATA_WORKERS,
+                cache: Optional[MetadataCache] = None,
+                offline: bool = False,
+                query: Optional[Dict[str, str]] = None
+                ) -> Iterator[Tuple[str, List[Dict[str, Union[str, int]]]]]:
+    """Request the series information of many patients concurrently and yield it in the
+    patient order. At most twice `workers` requests are ahead of the consumer, such that
+    the responses are streamed instead of held for the whole collection.
+    Parameters
+    ----------
+    dataset_name : str
+        The name of the dataset the patients belong to.
+    patient_ids : Iterable[str]
+        The PatientIDs to request the series for.
+    workers : int
+        The number of patients to request the series information for concurrently.
+    cache : MetadataCache
+        The metadata cache to read from and write to, if any.
+    offline : bool
+        Set `offline` to true to only use the cache.
+    query : Dict[str, str]
+        Extra getSeries parameters that NBIA filters on, e.g. the Modality.
+    Returns
+    -------
+    Iterator[Tuple[str, List[Dict[str, Union[str, int]]]]]
+        The PatientID and its getSeries response.
+    """
+    workers = max(1, workers)
+    window = deque()
+    with cf.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tcia_meta') as executor:
+        try:
+            for patient in patient_ids:
+                window.append((patient, executor.submit(get_patient_series, dataset_name, patient, cache, offline, query)))
+                if len(window) >= 2 * workers:
+                    patient, future = window.popleft()
+                    yield patient, future.result()
+            while window:
+                patient, future = window.popleft()
+                yield patient, future.result()
+        finally:
+            # the consumer may stop early, the requests it will never read are dropped
+            for _, future in window:
+                future.cancel()
 
 
-@timer
-def get_instance_series(
-                siuid_list: List[str],
-                stuid_list: List[str],
-                sidesc_list: List[str],
-                patient: str,
-                data_path: os.PathLike
+def download_series(
+                task: SeriesTask,
+                data_path: os.PathLike,
+                manifest: Optional[Manifest] = None,
+                extract_mode: str = config.EXTRACT_MODE,
+                extraction_pool: Optional[ExtractionPool] = None,
+                store: Optional[DicomStore] = None,
+                layout: Optional[Mapping[Tuple[str, str], os.PathLike]] = None,
+                shards: Optional[TarShardWriter] = None,
+                catalog: Optional[Catalog] = None
                 ) -> NoReturn:
-    """This is a helper function that uses the infomation about the series UUIDs to extract the acutal dicom files. The dicom
-    files will be placed on the local storage in a specific hierarchy.
+    """Download a single series and extract the dicom files into its sedesc folder. This is
+    the unit of work handed to the workers by the request controller. The zip is hashed while
+    it is streamed and the series is verified before it is recorded.
     Parameters
     ----------
-    siuid_list : list
-        The `siuid_list` contains the SeriesUUIDs.
-    stuid_list : list
-        The `stuid_list` contains the StudyUUIDs.
-    sidesc_list : list
-        The `sidesc_list` conatains the SeriesDescriptionUUIDS.
-    patient : str
-        The `patient` string indicates which patient in the dataset to extract dicom
-        files for.
+    task : SeriesTask
+        The series to download.
     data_path : os.PathLike
         Specify the `data_path` to where you want the data to be placed.
+    manifest : Manifest
+        If given, the series is recorded in the `manifest` once it is extracted and verified.
+    extract_mode : str
+        With `spool` the zip is held in a spooled temp buffer and unpacked from there, with
+        `disk` it is written next to the dicom files first and removed after the extraction.
+    extraction_pool : ExtractionPool
+        If given, the zip is handed to the `extraction_pool` and the function returns as soon
+        as it is downloaded. The series is recorded in the manifest once it is extracted.
+    store : DicomStore
+        If given, a series in the `store` is linked from there instead of downloaded, and a
+        downloaded series is moved into the `store` once it is verified.
+    layout : Mapping[Tuple[str, str], os.PathLike]
+        The sedesc folders by collection and SeriesInstanceUID that were created up front,
+        the folder of a series that is not in the `layout` is built and created here.
+    shards : TarShardWriter
+        If given, the zip is spooled and its images are appended to the tar shards of the
+        collection instead of the tree, the `extract_mode`, `extraction_pool`, `store` and
+        `layout` are not used.
+    catalog : Catalog
+        If given, the headers of every verified series are read into the `catalog`.
     Returns
     -------
     NoReturn
     """
-    # define a mutable dict
-    # get_instance_params = {'SeriesInstanceUID': 'placeholder'}
-    # make sure the patient string is clean
-    patient = patient.replace(' ', '-').lower()
-    # Now make an API request for each SeriesInstance
-    for siUID, stUID, sdUID in tzip(siuid_list[0], stuid_list[0], sidesc_list[0]):
-
-        # update the SeriesInstanceUID parameter
-        # get_instance_params.update({'SeriesInstanceUID': f'{siUID}'})
-
+    siUID = task.series_uid
+    if shards is not None:
         resp = api_request(
                         config.URL_IMG,
                         params={'SeriesInstanceUID': siUID},
-                        is_series=False
+                        is_series=False,
+                        stream=True
+                        )
+        hasher = new_hasher()
+        with SpooledTemporaryFile(max_size=config.SPOOL_MAX_SIZE, dir=config.SPOOL_DIR) as spool:
+            n_bytes, elapsed = stream_to_fileobj(resp, spool, chunk_size=config.CHUNK_SIZE, hasher=hasher)
+            log_download_rate(siUID, n_bytes, elapsed)
+            download = DownloadResult(n_bytes, hasher.hexdigest(), check_response(resp.headers, n_bytes))
+            # an error page or a cut body is not written to the shard at all
+            extracted = ExtractResult(0, 0) if download.error else shards.write_series(task, spool)
+        record_series(manifest, task, download, extracted, sedesc_folder=shards.folder, catalog=catalog)
+        return
+
+    sedesc_folder = layout.get((task.collection, siUID)) if layout is not None else None
+    if sedesc_folder is None:
+        sedesc_folder = make_series_folder(data_path, task.patient, task.study_uid, siUID, task.description)
+    if store is not None:
+        stored = store.link_series(task, sedesc_folder)
+        if stored is not None:
+            record_series(manifest, task, *stored, sedesc_folder=sedesc_folder, catalog=catalog)
+            return
+
+    resp = api_request(
+                    config.URL_IMG,
+                    params={'SeriesInstanceUID': siUID},
+                    is_series=False,
+                    stream=True
+                    )
+    hasher = new_hasher()
+
+    if extraction_pool is not None:
+        # small zips travel to the extraction process in memory, the rest via the disk
+        if extract_mode == 'spool' and 0 < task.file_size <= config.SPOOL_MAX_SIZE:
+            buffer = io.BytesIO()
+            n_bytes, elapsed = stream_to_fileobj(resp, buffer, chunk_size=config.CHUNK_SIZE, hasher=hasher)
+            payload = buffer.getvalue()
+        else:
+            payload = os.path.join(sedesc_folder, f'uid{siUID[-9:]}.zip')
+            n_bytes, elapsed = stream_to_file(resp, payload, chunk_size=config.CHUNK_SIZE, hasher=hasher)
+        log_download_rate(siUID, n_bytes, elapsed)
+        download = DownloadResult(n_bytes, hasher.hexdigest(), check_response(resp.headers, n_bytes))
+        extraction_pool.submit(
+                        payload,
+                        sedesc_folder,
+                        name=siUID,
+                        on_done=lambda extracted: record_series(manifest, task, download, extracted, store, sedesc_folder, catalog)
                         )
+        return
+
+    if extract_mode == 'spool':
+        # keep the zip in memory below the threshold and unpack it straight into the folder
+        with SpooledTemporaryFile(max_size=config.SPOOL_MAX_SIZE, dir=config.SPOOL_DIR) as spool:
+            n_bytes, elapsed = stream_to_fileobj(resp, spool, chunk_size=config.CHUNK_SIZE, hasher=hasher)
+            log_download_rate(siUID, n_bytes, elapsed)
+            extracted = extract_zip(spool, sedesc_folder, name=siUID)
+    else:
+        # stream the zip file to the instance folder with a fixed buffer
+        zip_path = os.path.join(sedesc_folder, f'uid{siUID[-9:]}.zip')
+        n_bytes, elapsed = stream_to_file(resp, zip_path, chunk_size=config.CHUNK_SIZE, hasher=hasher)
+        log_download_rate(siUID, n_bytes, elapsed)
+
+        # Extract the zip file and delete it thereafter, its path is known so the folder is not listed
+        extracted = extract_zip_file(zip_path, sedesc_folder, name=siUID)
+    download = DownloadResult(n_bytes, hasher.hexdigest(), check_response(resp.headers, n_bytes))
+    record_series(manifest, task, download, extracted, store, sedesc_folder, catalog)
+
+
+def log_download_rate(siUID: str, n_bytes: int, elapsed: float) -> NoReturn:
+    """Log the size and the rate of a series download and observe them in the metrics.
+    """
+    metrics.observe('download_seconds', elapsed)
+    metrics.observe('download_bytes', n_bytes)
+    metrics.observe('download_mb_per_second', n_bytes / config.MEGABYTE / max(elapsed, 1e-6))
+    log.info(
+        f'downloaded {n_bytes / config.MEGABYTE:.2f} MB for series {siUID} '
+        f'at {n_bytes / config.MEGABYTE / max(elapsed, 1e-6):.2f} MB/s'
+        )
+
 
-        # define the stringnames for the folders and filepaths
-        study = f'{stUID[-10:]}'
-        series = f'{siUID[-10:]}'
-        # check if file is something else than zip
-        filename = f'uid{siUID[-9:]}.zip'
-        if not filename.endswith('.zip'):
-            raise ValueError(f'The filename {filename} is not a valid zipfile')
-
-        # clean dem strings
-        patient = patient.translate({ord(char): None for char in config.CHAR_TO_REMOVE})
-        sdUID = sdUID.translate({ord(char): None for char in config.CHAR_TO_REMOVE})
-        sdUID = sdUID.replace(' ', '-').lower()
-
-        # create a folder for the StudyInstance and SeriesInstance
-        patient_folder = os.path.join(data_path, 'patient-{patient}').format(patient=patient)
-        study_folder = os.path.join(patient_folder, 'study-{study}').format(study=study)
-        series_folder = os.path.join(study_folder, 'series-{series}').format(series=series)
-        sedesc_folder = os.path.join(series_folder, 'sedesc-{sedesc}').format(sedesc=sdUID)
-
-        check_make_folder(patient_folder)
-        check_make_folder(study_folder)
-        check_make_folder(sedesc_folder)
-
-        # If payloads come in different sizes then the chunk_size must adapt to it
-        chunk_size: int = config.MEGABYTE if len(resp.content) > config.MEGABYTE else 100
-
-        # download the zip files in the instance folder
-        filepath: os.PathLike = os.path.join(sedesc_folder, '{filename}')
-        with open(filepath.format(filename=filename), 'wb') as fp:
-            for chunk in resp.iter_content(chunk_size=chunk_size):
-                try:
-                    fp.write(chunk)
-                except IOError:
-                    log.error(f'writing chunk: {chunk} to folder failed', exc_info=True)
-
-        # Extract the zip file and delete it thereafter
-        for item in os.listdir(sedesc_folder):
-            if item.endswith('.zip'):
-                try:
-                    ZipFile(filepath.format(filename=item)).extractall(sedesc_folder)
-                    os.remove(os.path.join(sedesc_folder, item))
-                except (BadZipFile, LargeZipFile, ValueError):
-                    log.error(f'zipefile extraction failed for {item}', exc_info=True)
+def record_series(
+            manifest: Optional[Manifest],
+            task: SeriesTask,
+            download: DownloadResult,
+            extracted: ExtractResult,
+            store: Optional[DicomStore] = None,
+            sedesc_folder: Optional[os.PathLike] = None,
+            catalog: Optional[Catalog] = None
+            ) -> Optional[str]:
+    """Verify a series and record the result in the manifest. A verified series is recorded
+    as completed with its checksum, a failed one with the reason, such that it is queued again.
+    Parameters
+    ----------
+    manifest : Manifest
+        The manifest to record in, nothing is recorded if it is None.
+    task : SeriesTask
+        The series that was downloaded.
+    download : DownloadResult
+        The size, checksum and response check of the zip.
+    extracted : ExtractResult
+        The number of dicom files and bytes extracted, and the extraction error if any.
+    store : DicomStore
+        If given, a verified series is moved from its `sedesc_folder` into the `store`.
+    sedesc_folder : os.PathLike
+        The folder the series was extracted to, or the shard folder if it went to a tar shard.
+    catalog : Catalog
+        If given, the headers of a verified series are read into the `catalog`.
+    Returns
+    -------
+    Optional[str]
+        Why the series failed the verification, None if it passed.
+    """
+    error = verify_series(task, download, extracted)
+    if error:
+        metrics.inc('failed_series')
+        log.error(f'series {task.series_uid} failed the verification: {error}')
+    elif store is not None and sedesc_folder is not None:
+        store.add_series(task, sedesc_folder, download)
+    if not error and catalog is not None and sedesc_folder is not None:
+        # the files are in place, a series missing from the catalog is not downloaded again
+        try:
+            catalog.add_series(task, download, extracted, sedesc_folder)
+        except Exception:
+            log.error(f'could not catalog series {task.series_uid}', exc_info=True)
+    if manifest is None:
+        return error
+    info = {
+        'PatientID': task.patient,
+        'StudyInstanceUID': task.study_uid,
+        'ImageCount': task.image_count,
+        'updated': task.updated,
+        'files': extracted.n_files,
+        'bytes': extracted.n_bytes,
+        'zip_bytes': download.n_bytes,
+        config.HASH_ALGORITHM: download.digest
+        }
+    if extracted.shard:
+        info['shard'] = extracted.shard
+    if error:
+        manifest.record(task.series_uid, status='failed', error=error, **info)
+    else:
+        manifest.record(task.series_uid, status='ok', **info)
+    return error
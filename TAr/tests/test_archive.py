@@ -0,0 +1,58 @@
+"""
+Tests that a series which breaks half way is cut off its tar shard again, such that the
+shard stays readable for the sequential readers and the next series follow on from it.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import io
+import tarfile
+import zipfile
+# internals
+from src.archive import TarShardWriter, load_index
+from src.scheduler import SeriesTask
+
+N_IMAGES = 3
+
+
+def series_zip(series: int, corrupt: int = None) -> io.BytesIO:
+    """Build the zip of a series, the deflate stream of image `corrupt` is damaged."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for idx in range(N_IMAGES):
+            zf.writestr(f'1-{idx + 1:03d}.dcm', bytes([series, idx]) * 2048)
+    if corrupt is not None:
+        info = zipfile.ZipFile(buffer).infolist()[corrupt]
+        data = bytearray(buffer.getvalue())
+        # the local header is 30 bytes and the name, there is no extra field
+        data[info.header_offset + 30 + len(info.filename)] = 0xFF  # a reserved deflate block type
+        buffer = io.BytesIO(bytes(data))
+    buffer.seek(0)
+    return buffer
+
+
+def task_for(series: int) -> SeriesTask:
+    return SeriesTask('p', '1.2', f'1.2.3.{series}', 'd', image_count=N_IMAGES, collection='c')
+
+
+def test_corrupt_deflate_member_is_rolled_back(tmp_path):
+    writer = TarShardWriter(tmp_path, prefix='c')
+    assert writer.write_series(task_for(0), series_zip(0)).error is None
+    shard_path = tmp_path / 'c-000000.tar'
+    start = shard_path.stat().st_size
+
+    broken = writer.write_series(task_for(1), series_zip(1, corrupt=1))
+    assert broken.error is not None and broken.n_files == 0
+    assert shard_path.stat().st_size == start
+    with tarfile.open(shard_path) as tar:
+        assert len(tar.getnames()) == N_IMAGES
+
+    # the retry and the next series are appended where the broken one started
+    assert writer.write_series(task_for(1), series_zip(1)).error is None
+    writer.close()
+    with tarfile.open(shard_path) as tar:
+        names = tar.getnames()
+        assert len(names) == 2 * N_IMAGES
+        assert tar.extractfile('p/1.2.3.1/1-002.dcm').read() == bytes([1, 1]) * 2048
+    index = load_index(tmp_path)
+    assert index['1.2.3.1']['offset'] == start
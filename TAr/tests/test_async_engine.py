@@ -0,0 +1,88 @@
+"""
+Tests the asyncio engine against the mock NBIA server: a series that fails after its download
+is recorded as failed, while the other series of the run go on.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import os
+import time
+import pytest
+# internals
+from config import config
+from bench.mock_nbia import MockNBIA
+from src.records import SeriesRecord
+from src.manifest import Manifest
+from src.metrics import metrics
+from src import async_engine
+
+pytest.importorskip('aiohttp')
+
+
+@pytest.fixture
+def mock(monkeypatch):
+    with MockNBIA(patients=4, series=2, images=3, image_size=1024) as mock:
+        monkeypatch.setattr(config, 'URL_IMG', os.path.join(mock.base_url + '/v1', config.QUERY_IMGS))
+        yield mock
+
+
+def mock_tasks(mock):
+    return [
+        SeriesRecord.from_json(series).to_task(collection='c')
+        for patient in range(mock.patients)
+        for series in mock.series_list('c', patient)
+        ]
+
+
+def test_failed_extraction_does_not_stop_the_run(tmp_path, mock, monkeypatch):
+    tasks = mock_tasks(mock)
+    broken = tasks[1].series_uid
+    extract_zip = async_engine.extract_zip
+
+    def failing_extract(fp, folder, name):
+        if name == broken:
+            raise OSError(28, 'No space left on device')
+        return extract_zip(fp, folder, name)
+
+    monkeypatch.setattr(async_engine, 'extract_zip', failing_extract)
+    manifest = Manifest(tmp_path / 'manifest.jsonl')
+    async_engine.fetch_instances_async(tasks, {'c': (tmp_path, manifest)}, max_in_flight=2, extract_workers=2)
+    assert len(manifest) == len(tasks) - 1
+    assert broken not in manifest
+    assert 'No space left' in manifest.failed()[broken]['error']
+
+
+def test_downloaded_zips_are_bounded(tmp_path, mock, monkeypatch):
+    tasks = mock_tasks(mock)
+    held, peak = [0], [0]
+    download, extract_zip = async_engine._download, async_engine.extract_zip
+
+    async def counting_download(session, siUID, fp):
+        result = await download(session, siUID, fp)
+        held[0] += 1
+        peak[0] = max(peak[0], held[0])
+        return result
+
+    def slow_extract(fp, folder, name):
+        time.sleep(0.05)
+        result = extract_zip(fp, folder, name)
+        held[0] -= 1
+        return result
+
+    monkeypatch.setattr(async_engine, '_download', counting_download)
+    monkeypatch.setattr(async_engine, 'extract_zip', slow_extract)
+    manifest = Manifest(tmp_path / 'manifest.jsonl')
+    async_engine.fetch_instances_async(
+                                tasks, {'c': (tmp_path, manifest)},
+                                max_in_flight=2, extract_workers=1, extract_queue=1
+                                )
+    assert len(manifest) == len(tasks)
+    # the requests in flight and the zip in the extraction
+    assert peak[0] <= 2 + 1
+
+
+def test_image_requests_are_timed(tmp_path, mock):
+    tasks = mock_tasks(mock)
+    metrics.reset()
+    async_engine.fetch_instances_async(tasks, {'c': (tmp_path, Manifest(tmp_path / 'manifest.jsonl'))}, max_in_flight=2)
+    assert metrics.summary()['image_request_seconds']['count'] == len(tasks)
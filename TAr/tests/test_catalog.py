@@ -0,0 +1,69 @@
+"""
+Tests that the catalog rows of series written to tar shards carry their dicom headers, both
+when the headers are parsed while the images are copied and when they are read back from a
+shard that is still open.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import io
+import random
+import sqlite3
+import zipfile
+import pytest
+# internals
+from bench.mock_nbia import dicom_image
+from src.archive import TarShardWriter, read_image
+from src.scheduler import SeriesTask
+from src.integrity import DownloadResult
+
+pytest.importorskip('pydicom')
+from src.catalog import Catalog  # noqa: E402
+
+N_IMAGES = 3
+
+
+def series_zip(series: int) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for idx in range(N_IMAGES):
+            sop_uid = f'1.2.3.{series}.{idx + 1}'
+            zf.writestr(f'1-{idx + 1:03d}.dcm', dicom_image(sop_uid, idx + 1, 4096, random.Random(idx)))
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.mark.parametrize('read_headers', [True, False])
+def test_tar_catalog_rows_have_headers(tmp_path, read_headers):
+    writer = TarShardWriter(tmp_path / 'shards', prefix='c', read_headers=read_headers)
+    catalog = Catalog(tmp_path / 'catalog.sqlite', 'c')
+    for series in range(2):
+        task = SeriesTask('p', '1.2', f'1.2.3.{series}', 'd', image_count=N_IMAGES, collection='c')
+        extracted = writer.write_series(task, series_zip(series))
+        assert extracted.error is None and extracted.n_files == N_IMAGES
+        # the shard is still open, the catalog must see the whole series
+        catalog.add_series(task, DownloadResult(0, ''), extracted, writer.folder)
+    writer.close()
+    catalog.close()
+
+    db = sqlite3.connect(tmp_path / 'catalog.sqlite')
+    rows = db.execute(
+        'SELECT SeriesInstanceUID, name, data_offset, SOPInstanceUID, InstanceNumber, Rows, '
+        'PixelSpacing, TransferSyntaxUID FROM instances'
+        ).fetchall()
+    assert len(rows) == 2 * N_IMAGES
+    for series_uid, name, offset, *header in rows:
+        assert None not in header
+        assert header[0] == f'{series_uid}.{int(name[2:5])}'
+        assert offset is not None
+    assert db.execute('SELECT count(*) FROM series WHERE shard IS NULL').fetchone()[0] == 0
+
+
+def test_tar_index_offsets_read_images(tmp_path):
+    writer = TarShardWriter(tmp_path, prefix='c')
+    task = SeriesTask('p', '1.2', '1.2.3.0', 'd', image_count=N_IMAGES)
+    extracted = writer.write_series(task, series_zip(0))
+    writer.close()
+    with zipfile.ZipFile(series_zip(0)) as zf:
+        for name in extracted.members:
+            assert read_image(tmp_path, {'shard': extracted.shard, 'members': extracted.members}, name) == zf.read(name)
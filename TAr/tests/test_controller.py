@@ -0,0 +1,81 @@
+"""
+Tests the retry rounds of the request controller: a series counts as done only if it was
+recorded in the current round, an older entry of the manifest does not count.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import json
+# internals
+from config import config
+from api_request_controller import RequestController, CollectionState
+from src.manifest import Manifest
+from src.scheduler import SeriesTask
+
+
+def controller_for(tmp_path, uids, **options):
+    """A controller over one collection, the manifest holds an ok entry of an older run
+    for every series."""
+    with open(tmp_path / 'manifest.jsonl', 'w') as fp:
+        for uid in uids:
+            fp.write(json.dumps({'SeriesInstanceUID': uid, 'status': 'ok', 'completed': 0}) + '\n')
+    tasks = [SeriesTask('p', '1.2', uid, 'd', image_count=1, file_size=1, collection='c') for uid in uids]
+    controller = RequestController(dataset_name='c', resume=False, store=False, catalog=False, series_attempts=3, **options)
+    controller.collections = [CollectionState('c', tmp_path, tasks, Manifest(tmp_path / 'manifest.jsonl'))]
+    controller.collections_by_name = {'c': controller.collections[0]}
+    return controller
+
+
+def run_rounds(monkeypatch, controller, outcomes):
+    """Replace the downloads, `outcomes` gives per round the series that are recorded ok
+    and the ones recorded failed, the rest raised before they were recorded."""
+    rounds = []
+
+    def run_queue(tasks, max_workers):
+        ok, failed = outcomes[len(rounds)] if len(rounds) < len(outcomes) else ((), ())
+        rounds.append([task.series_uid for task in tasks])
+        manifest = controller.collections_by_name['c'].manifest
+        for task in tasks:
+            if task.series_uid in ok:
+                manifest.record(task.series_uid, status='ok')
+            elif task.series_uid in failed:
+                manifest.record(task.series_uid, status='failed', error='the zip is broken')
+
+    monkeypatch.setattr(controller, 'run_queue', run_queue)
+    controller.fetch_instances()
+    return rounds
+
+
+def test_series_that_raised_are_retried(tmp_path, monkeypatch):
+    controller = controller_for(tmp_path, ['a', 'b', 'c'])
+    rounds = run_rounds(monkeypatch, controller, [(('a',), ('b',)), (('b',), ()), (('c',), ())])
+    # c has an ok entry from an older run, but it raised in the first two rounds
+    assert rounds == [['a', 'b', 'c'], ['b', 'c'], ['c']]
+    assert controller.failed_series == []
+
+
+def test_series_failing_every_round_are_reported(tmp_path, monkeypatch):
+    controller = controller_for(tmp_path, ['a', 'b'])
+    rounds = run_rounds(monkeypatch, controller, [(('a',), ())])
+    assert rounds == [['a', 'b'], ['b'], ['b']]
+    assert controller.failed_series == ['b']
+
+
+def test_resume_skips_the_completed_series(tmp_path, monkeypatch):
+    controller = controller_for(tmp_path, ['a', 'b'])
+    controller.collections[0].manifest.record('b', status='failed', error='the zip is broken')
+    controller.resume = True
+    rounds = run_rounds(monkeypatch, controller, [(('b',), ())])
+    assert rounds == [['b']]
+    assert controller.failed_series == []
+
+
+def test_collection_names(tmp_path):
+    path = tmp_path / 'collections.txt'
+    path.write_text('# nightly\nB\nC\nA\n')
+    assert RequestController.from_args([]).collection_names() == [config.DATASET_NAME]
+    assert RequestController.from_args(['-d', 'A,B']).collection_names() == ['A', 'B']
+    assert RequestController.from_args(['-cf', str(path)]).collection_names() == ['B', 'C', 'A']
+    assert RequestController.from_args(['-d', 'A', '-cf', str(path)]).collection_names() == ['A', 'B', 'C']
+    # the default dataset given explicitly is not dropped next to the file
+    assert RequestController.from_args(['-d', config.DATASET_NAME, '-cf', str(path)]).collection_names()[0] == config.DATASET_NAME
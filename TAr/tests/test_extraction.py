@@ -0,0 +1,37 @@
+"""
+Tests that a broken series zip is extracted into a failed result, such that the series is
+recorded as failed and queued again instead of the error escaping to the worker.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import io
+import zipfile
+# internals
+from src.extraction import extract_zip
+
+
+def deflated_zip(corrupt: bool = False) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for idx in range(2):
+            zf.writestr(f'1-{idx + 1:03d}.dcm', bytes([idx]) * 4096)
+    if corrupt:
+        info = zipfile.ZipFile(buffer).infolist()[1]
+        data = bytearray(buffer.getvalue())
+        # the local header is 30 bytes and the name, there is no extra field
+        data[info.header_offset + 30 + len(info.filename)] = 0xFF  # a reserved deflate block type
+        buffer = io.BytesIO(bytes(data))
+    buffer.seek(0)
+    return buffer
+
+
+def test_extract_zip(tmp_path):
+    result = extract_zip(deflated_zip(), tmp_path, 'series')
+    assert result.error is None and result.n_files == 2 and result.n_bytes == 2 * 4096
+
+
+def test_corrupt_deflate_member_fails_the_series(tmp_path):
+    result = extract_zip(deflated_zip(corrupt=True), tmp_path, 'series')
+    assert result.n_files == 0
+    assert result.error.startswith('the zip is broken')
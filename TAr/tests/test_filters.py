@@ -0,0 +1,64 @@
+"""
+Tests the series selection: the filters on the getSeries metadata and the cap on the total
+size of the work queue.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# internals
+from config import config
+from src.filters import SeriesFilter, cap_total_size, split_list
+from src.records import SeriesRecord
+from src.scheduler import SeriesTask
+
+
+def record(patient: str, series: str, modality: str, description: str, mb: float) -> SeriesRecord:
+    return SeriesRecord.from_json({
+        'PatientID': patient, 'SeriesInstanceUID': series, 'Modality': modality,
+        'SeriesDescription': description, 'FileSize': int(mb * config.MEGABYTE)
+        })
+
+
+RECORDS = [
+    record('p1', '1', 'MR', 'T1 post', 10),
+    record('p1', '2', 'CT', 'chest', 10),
+    record('p1', '3', 'MR', 't1 POST contrast', 200),
+    record('p2', '4', 'mr', 'T2', 10),
+    record('p2', '5', 'MR', 't1 post', 10),
+    ]
+
+
+def kept(series_filter: SeriesFilter) -> list:
+    return [r.series_uid for r in series_filter.apply(RECORDS)]
+
+
+def test_no_filter_keeps_everything():
+    series_filter = SeriesFilter.from_args('', '', '', 0, 0)
+    assert not series_filter.active
+    assert kept(series_filter) == ['1', '2', '3', '4', '5']
+
+
+def test_filters():
+    assert kept(SeriesFilter.from_args(modality='MR')) == ['1', '3', '4', '5']
+    assert SeriesFilter.from_args(modality='MR').query() == {'Modality': 'MR'}
+    assert SeriesFilter.from_args(modality='MR,CT').query() == {}
+    assert kept(SeriesFilter.from_args(series_description='t1.*post')) == ['1', '3', '5']
+    assert kept(SeriesFilter.from_args(max_series_mb=50)) == ['1', '2', '4', '5']
+    assert kept(SeriesFilter.from_args(max_series_per_patient=1)) == ['1', '4']
+    # the series per patient are counted after the other filters
+    assert kept(SeriesFilter.from_args(modality='CT,MR', series_description='t1', max_series_per_patient=1)) == ['1', '5']
+    assert SeriesFilter.from_args(patients='p1, p2').patients == ['p1', 'p2']
+
+
+def test_split_list_reads_a_file(tmp_path):
+    path = tmp_path / 'patients.txt'
+    path.write_text('# the cohort\np1\n\np2\n')
+    assert split_list(str(path)) == ['p1', 'p2']
+    assert split_list('') == []
+
+
+def test_cap_total_size():
+    tasks = [SeriesTask('p', '1.2', str(idx), 'd', file_size=size) for idx, size in enumerate([5, 4, 3, 1])]
+    assert cap_total_size(tasks, 0) == tasks
+    # a series that does not fit is skipped, the smaller ones after it are tried
+    assert [task.series_uid for task in cap_total_size(tasks, 8)] == ['0', '2']
+    assert [task.series_uid for task in cap_total_size(tasks, 10)] == ['0', '1', '3']
@@ -0,0 +1,43 @@
+"""
+Tests the manifest a run resumes from: the last line of a series wins, a failed series does
+not count as completed and a line cut short by a crash is skipped.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import time
+# internals
+from src.manifest import Manifest
+
+
+def test_manifest_is_reloaded(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    manifest = Manifest(path)
+    manifest.record('a', status='ok', files=2)
+    manifest.record('b', status='failed', error='the zip is broken')
+    manifest.record('c', status='failed', error='the zip is broken')
+    manifest.record('c', status='ok', files=3)
+    with open(path, 'a') as fp:
+        fp.write('{"SeriesInstanceUID": "d", "sta')
+
+    reloaded = Manifest(path)
+    assert sorted(reloaded) == ['a', 'c']
+    assert 'b' not in reloaded and list(reloaded.failed()) == ['b']
+    assert reloaded.get('c')['files'] == 3
+    # the entries written before the status existed count as completed
+    with open(path, 'a') as fp:
+        fp.write('\n{"SeriesInstanceUID": "e"}\n')
+    assert 'e' in Manifest(path)
+
+
+def test_completed_since(tmp_path):
+    manifest = Manifest(tmp_path / 'manifest.jsonl')
+    manifest.record('old', status='ok')
+    time.sleep(0.01)
+    started = time.time()
+    manifest.record('new', status='ok')
+    manifest.record('broken', status='failed', error='the zip is broken')
+    assert manifest.completed_since('new', started)
+    assert not manifest.completed_since('old', started)
+    assert not manifest.completed_since('broken', started)
+    assert not manifest.completed_since('unknown', started)
@@ -0,0 +1,21 @@
+"""
+Tests the metrics registry: the phases are exported as histograms and the events as counters.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# internals
+from src.metrics import MetricsRegistry
+
+
+def test_counter_is_exported_as_a_total():
+    registry = MetricsRegistry()
+    registry.inc('failed_series')
+    registry.inc('failed_series', 2)
+    registry.observe('extract_seconds', 0.2)
+    text = registry.to_prometheus()
+    assert '# TYPE tar_failed_series_total counter\ntar_failed_series_total 3\n' in text
+    assert 'tar_failed_series_bucket' not in text
+    assert '# TYPE tar_extract_seconds histogram' in text
+    summary = registry.summary()
+    assert summary['failed_series'] == {'total': 3}
+    assert summary['extract_seconds']['count'] == 1
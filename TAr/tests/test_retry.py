@@ -0,0 +1,104 @@
+"""
+Tests the retries of the requests: the backoff and the Retry-After header, the adaptive
+token bucket (AIMD) and the retry loop around a request.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import io
+import pytest
+import requests
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+# internals
+from config import config
+from src import retry
+from src.retry import AdaptiveTokenBucket, backoff_delay, call_with_retry, retry_after_seconds
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    delays = []
+    monkeypatch.setattr(retry, 'sleep', delays.append)
+    retry.configure_retry(max_retries=2, rate_limit=0)
+    yield delays
+    retry.configure_retry(max_retries=config.MAX_RETRIES, rate_limit=config.RATE_LIMIT)
+
+
+def response(status: int, retry_after: str = '') -> requests.Response:
+    resp = requests.Response()
+    resp.status_code = status
+    resp.url = 'http://nbia/getImage'
+    resp.raw = io.BytesIO(b'')
+    if retry_after:
+        resp.headers['Retry-After'] = retry_after
+    return resp
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds({}) == 0.0
+    assert retry_after_seconds({'Retry-After': '7'}) == 7.0
+    assert retry_after_seconds({'Retry-After': '-3'}) == 0.0
+    assert retry_after_seconds({'Retry-After': 'soon'}) == 0.0
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < retry_after_seconds({'Retry-After': later}) <= 30
+
+
+def test_backoff_delay():
+    for attempt in range(10):
+        delay = backoff_delay(attempt)
+        assert 0 <= delay <= min(config.BACKOFF_MAX, config.BACKOFF_BASE * 2 ** attempt)
+    # never shorter than the Retry-After, but capped
+    assert backoff_delay(0, retry_after=20) >= 20
+    assert backoff_delay(0, retry_after=1e9) == config.RETRY_AFTER_MAX
+
+
+def test_bucket_shrinks_on_throttle_and_grows_back():
+    bucket = AdaptiveTokenBucket(max_rate=8, min_rate=1)
+    for _ in range(10):
+        bucket.on_throttle()
+    assert bucket.rate == 1
+    bucket.on_success()
+    assert bucket.rate == 1 + config.RATE_INCREASE
+    for _ in range(100):
+        bucket.on_success()
+    assert bucket.rate == 8
+
+
+def test_bucket_paces_the_requests():
+    bucket = AdaptiveTokenBucket(max_rate=10, min_rate=1)
+    waits = [bucket.reserve() for _ in range(20)]
+    # the burst is served at once, the rest is spaced by the rate
+    assert waits[:10] == [0.0] * 10
+    assert waits[-1] == pytest.approx(1.0, abs=0.05)
+    bucket.on_throttle(pause=5)
+    assert bucket.reserve() >= 4.9
+
+
+def test_call_with_retry_honors_retry_after(no_sleep):
+    responses = iter([response(429, '3'), response(503), response(200)])
+    assert call_with_retry(lambda: next(responses)).status_code == 200
+    assert len(no_sleep) == 2 and no_sleep[0] >= 3
+
+
+def test_call_with_retry_gives_up(no_sleep):
+    with pytest.raises(requests.HTTPError):
+        call_with_retry(lambda: response(503))
+    assert len(no_sleep) == 2
+    # a client error is not retried
+    with pytest.raises(requests.HTTPError):
+        call_with_retry(lambda: response(404))
+    assert len(no_sleep) == 2
+
+
+def test_call_with_retry_on_connection_errors(no_sleep):
+    attempts = []
+
+    def send():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise requests.ConnectionError('reset')
+        return response(200)
+
+    assert call_with_retry(send).status_code == 200
+    assert len(attempts) == 3
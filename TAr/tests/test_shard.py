@@ -0,0 +1,79 @@
+"""
+Tests the sharding of a collection over several nodes: every series lands in exactly one
+shard, and the merged manifests report the missing and the duplicated series.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import os
+import sys
+import json
+import argparse
+import subprocess
+import pytest
+# internals
+from src.shard import parse_shard, shard_of, filter_shard, manifest_name, find_manifests, merge_manifests
+from src.scheduler import SeriesTask
+
+TASKS = [
+    SeriesTask(f'p{patient}', '1.2', f'1.2.3.{patient}.{series}', 'd', collection='c')
+    for patient in range(20)
+    for series in range(5)
+    ]
+
+
+@pytest.mark.parametrize('n_shards', [1, 2, 3, 7])
+@pytest.mark.parametrize('shard_by', ['series', 'patient'])
+def test_every_series_lands_in_exactly_one_shard(n_shards, shard_by):
+    shards = [filter_shard(TASKS, (index, n_shards), shard_by) for index in range(n_shards)]
+    uids = [task.series_uid for shard in shards for task in shard]
+    assert sorted(uids) == sorted(task.series_uid for task in TASKS)
+    # the order of the work queue is kept within a shard
+    for shard in shards:
+        assert shard == [task for task in TASKS if task in shard]
+    if shard_by == 'patient':
+        for shard in shards:
+            patients = {task.patient for task in shard}
+            assert len(shard) == 5 * len(patients)
+
+
+def test_shard_of_is_stable_across_processes():
+    # a salted hash would move the series between the nodes
+    code = 'from src.shard import shard_of; print([shard_of(str(key), 1000) for key in range(50)])'
+    env = {**os.environ, 'PYTHONHASHSEED': '123'}
+    out = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, text=True, check=True).stdout
+    assert out.strip() == str([shard_of(str(key), 1000) for key in range(50)])
+    assert {shard_of(task.series_uid, 4) for task in TASKS} == {0, 1, 2, 3}
+
+
+def test_parse_shard():
+    assert parse_shard('') is None
+    assert parse_shard('1/4') == (1, 4)
+    for value in ('4/4', '-1/4', '1/0', '1-4'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(value)
+
+
+def write_manifest(path, uids, failed=()):
+    with open(path, 'w') as fp:
+        for uid in uids:
+            fp.write(json.dumps({'SeriesInstanceUID': uid, 'status': 'ok'}) + '\n')
+        for uid in failed:
+            fp.write(json.dumps({'SeriesInstanceUID': uid, 'status': 'failed'}) + '\n')
+
+
+def test_merge_manifests(tmp_path):
+    assert manifest_name('manifest.jsonl', (0, 2)) == 'manifest-shard-0-of-2.jsonl'
+    write_manifest(tmp_path / manifest_name('manifest.jsonl', (0, 2)), ['a', 'b'])
+    write_manifest(tmp_path / manifest_name('manifest.jsonl', (1, 2)), ['b', 'x'], failed=['c'])
+    manifests = find_manifests([str(tmp_path)], 'manifest.jsonl')
+    assert len(manifests) == 2
+
+    report = merge_manifests(manifests, {'a', 'b', 'c', 'd'})
+    assert report['expected'] == 4 and report['completed'] == 2
+    assert not report['complete']
+    assert report['missing'] == ['c', 'd']
+    assert list(report['duplicates']) == ['b']
+    assert report['unexpected'] == ['x']
+
+    assert merge_manifests(manifests, {'a', 'b'})['complete']
@@ -0,0 +1,78 @@
+"""
+Tests the content-addressed store: the files of a series are stored once and linked into
+every tree, and extracting a series again into a linked tree never writes into the store.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import io
+import os
+import zipfile
+import pytest
+# internals
+from src.store import DicomStore
+from src.scheduler import SeriesTask
+from src.extraction import extract_zip
+from src.integrity import DownloadResult
+
+N_IMAGES = 3
+
+
+def series_zip(fill: int) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for idx in range(N_IMAGES):
+            zf.writestr(f'1-{idx + 1:03d}.dcm', bytes([fill, idx]) * 512)
+    buffer.seek(0)
+    return buffer
+
+
+def stored_bytes(store: DicomStore) -> dict:
+    return {
+        name: open(os.path.join(folder, name), 'rb').read()
+        for folder, _, names in os.walk(store.objects)
+        for name in names
+        }
+
+
+@pytest.mark.parametrize('link', ['hardlink', 'symlink'])
+def test_series_is_linked_from_the_store(tmp_path, link):
+    store = DicomStore(tmp_path / 'store', link)
+    task = SeriesTask('p', '1.2', '1.2.3', 'd', image_count=N_IMAGES, collection='c')
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+    assert extract_zip(series_zip(1), first, 'series').n_files == N_IMAGES
+    store.add_series(task, first, DownloadResult(1, 'digest'))
+    assert len(stored_bytes(store)) == N_IMAGES
+
+    download, extracted = store.link_series(task, second)
+    assert download.digest == 'digest' and extracted.n_files == N_IMAGES
+    for name in os.listdir(first):
+        assert (second / name).read_bytes() == (first / name).read_bytes()
+        if link == 'hardlink':
+            assert os.path.samefile(second / name, first / name)
+        else:
+            assert (second / name).is_symlink()
+    # a changed task is not served from the store
+    assert store.link_series(task._replace(image_count=N_IMAGES + 1), second) is None
+
+
+@pytest.mark.parametrize('link', ['hardlink', 'symlink'])
+def test_extracting_into_a_linked_tree_keeps_the_store(tmp_path, link):
+    store = DicomStore(tmp_path / 'store', link)
+    task = SeriesTask('p', '1.2', '1.2.3', 'd', image_count=N_IMAGES, collection='c')
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+    extract_zip(series_zip(1), first, 'series')
+    store.add_series(task, first, DownloadResult(1, 'digest'))
+    store.link_series(task, second)
+    objects = stored_bytes(store)
+
+    # the series changed on NBIA and is extracted again over its links
+    assert extract_zip(series_zip(2), second, 'series').n_files == N_IMAGES
+    assert stored_bytes(store) == objects
+    assert (first / '1-001.dcm').read_bytes() == bytes([1, 0]) * 512
+    assert (second / '1-001.dcm').read_bytes() == bytes([2, 0]) * 512
+    assert not (second / '1-001.dcm').is_symlink()
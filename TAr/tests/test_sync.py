@@ -0,0 +1,79 @@
+"""
+Tests the sync diff of the remote series against the manifest and the local tree, every
+series lands in exactly one of the categories, and a dry run leaves the manifest untouched.
+Run them from the TAr folder:
+$ poetry run python -m pytest tests
+"""
+# externals
+import os
+# internals
+from src.sync import diff_series, is_changed
+from src.manifest import Manifest
+from src.layout import series_folders
+from src.scheduler import SeriesTask
+
+
+def task_for(series: str, image_count: int = 2, updated: str = '2021-01-01') -> SeriesTask:
+    return SeriesTask('p', '1.2', series, 'd', image_count=image_count, collection='c', updated=updated)
+
+
+def write_files(data_path, task: SeriesTask, n_files: int) -> None:
+    folder = series_folders(data_path, task.patient, task.study_uid, task.series_uid, task.description)[-1]
+    os.makedirs(folder, exist_ok=True)
+    for idx in range(n_files):
+        open(os.path.join(folder, f'{idx}.dcm'), 'wb').close()
+
+
+def record(manifest: Manifest, task: SeriesTask, **info) -> None:
+    manifest.record(task.series_uid, ImageCount=task.image_count, updated=task.updated, files=task.image_count, **info)
+
+
+def test_diff_categories(tmp_path):
+    manifest = Manifest(tmp_path / 'manifest.jsonl')
+    unchanged, recount, redate, missing, new, adopted, gone = (
+        task_for('unchanged'), task_for('recount'), task_for('redate'), task_for('missing'),
+        task_for('new'), task_for('adopted'), task_for('gone')
+        )
+    for task in (unchanged, recount, redate, missing, gone):
+        record(manifest, task)
+    for task in (unchanged, recount, redate, adopted):
+        write_files(tmp_path, task, task.image_count)
+    write_files(tmp_path, missing, 1)
+
+    remote = [unchanged, recount._replace(image_count=3), redate._replace(updated='2022-01-01'), missing, new, adopted]
+    delta = diff_series(remote, manifest, tmp_path, {task.series_uid for task in remote})
+    assert [task.series_uid for task in delta.new] == ['new']
+    assert [task.series_uid for task in delta.changed] == ['recount', 'redate']
+    assert [task.series_uid for task in delta.missing] == ['missing']
+    assert [task.series_uid for task in delta.unchanged] == ['unchanged', 'adopted']
+    assert delta.removed == ['gone']
+    assert [task.series_uid for task in delta.to_fetch] == ['new', 'recount', 'redate', 'missing']
+    # the series found complete on disk is adopted into the manifest
+    assert manifest.get('adopted')['adopted'] is True
+    assert Manifest(tmp_path / 'manifest.jsonl').get('adopted') is not None
+
+
+def test_diff_without_adoption_leaves_the_manifest(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    manifest = Manifest(path)
+    task = task_for('adopted')
+    write_files(tmp_path, task, task.image_count)
+    delta = diff_series([task], manifest, tmp_path, None, adopt=False)
+    assert delta.unchanged == [task] and delta.removed == []
+    assert 'adopted' not in manifest
+    assert not path.exists()
+
+
+def test_shard_series_are_not_missing(tmp_path):
+    manifest = Manifest(tmp_path / 'manifest.jsonl')
+    task = task_for('sharded')
+    record(manifest, task, shard='c-000000.tar')
+    delta = diff_series([task], manifest, tmp_path, None)
+    assert delta.unchanged == [task]
+
+
+def test_is_changed_falls_back_on_the_file_count():
+    task = task_for('s', image_count=3)
+    assert is_changed(task, {'files': 2})
+    assert not is_changed(task, {'files': 3})
+    assert not is_changed(task._replace(updated=''), {'ImageCount': 3, 'updated': '2020-01-01'})